@@ -2,16 +2,36 @@ import os
 import sqlite3
 import csv
 from io import BytesIO, StringIO
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from pathlib import Path
-from functools import wraps
+from functools import wraps, partial, lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+import re
+import bisect
+import unicodedata
+import uuid
+import zlib
+import json
+import hashlib
+import hmac
+import cProfile
+import pstats
+from urllib.parse import urlencode
+import urllib.request
+import urllib.error
 from flask import (
     Flask, request, redirect, url_for, render_template, flash, send_from_directory,
-    make_response, session
+    make_response, session, Response, jsonify
 )
 from werkzeug.utils import secure_filename
 import smtplib
+import socket
 import mimetypes
+import shutil
+import tempfile
+from contextlib import ExitStack, contextmanager
+from abc import ABC, abstractmethod
 from email.message import EmailMessage
 try:
     import pythoncom  # Inicializa COM por hilo cuando usamos Outlook
@@ -20,14 +40,58 @@ except Exception:
 from jinja2 import DictLoader
 import logging
 from logging.handlers import RotatingFileHandler
+import threading
+import time
+from collections import OrderedDict, namedtuple
+import click
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import ClosingIterator
+from markupsafe import Markup, escape
+import pdf_text
 
 # ------------------------------
 # Configuración básica
 # ------------------------------
 BASE_DIR = Path(__file__).resolve().parent
-DB_PATH = BASE_DIR / "tickets.db"
-UPLOAD_FOLDER = BASE_DIR / "uploads"
+DB_PATH = Path(os.getenv("DB_PATH", BASE_DIR / "tickets.db"))
+UPLOAD_FOLDER = Path(os.getenv("UPLOAD_FOLDER", BASE_DIR / "uploads"))
 UPLOAD_FOLDER.mkdir(exist_ok=True)
+# Almacenamiento de adjuntos: "local" (UPLOAD_FOLDER) o "s3" (S3/MinIO, requiere boto3)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_PREFIX = os.getenv("S3_PREFIX", "uploads/")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_REGION = os.getenv("S3_REGION") or None
+S3_PRESIGN_EXPIRES = int(os.getenv("S3_PRESIGN_EXPIRES", "300"))
+# Segundos que un writer espera el lock de SQLite antes de fallar (varios hilos/workers)
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "15"))
+# Tickets cerrados hace más de ARCHIVE_AFTER_DAYS se mueven a archive.db (flask archive-tickets)
+ARCHIVE_DB_PATH = Path(os.getenv("ARCHIVE_DB_PATH", BASE_DIR / "archive.db"))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+# Respaldos (flask backup): copia online de las bases de a BACKUP_PAGES_PER_STEP páginas y
+# sincronización incremental de adjuntos. BACKUP_INTERVAL_HOURS > 0 lo programa en los workers.
+BACKUP_DIR = Path(os.getenv("BACKUP_DIR", BASE_DIR / "backups"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_PAUSE = float(os.getenv("BACKUP_STEP_PAUSE", "0.01"))
+# Instantáneas de base que se conservan; 0 = todas (sin rotación)
+BACKUP_KEEP = max(0, int(os.getenv("BACKUP_KEEP", "7")))
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "0"))
+# Adjuntos huérfanos (flask sweep-uploads): PDF que ningún ticket referencia. Se ignoran los
+# modificados hace menos de ORPHAN_GRACE_HOURS (subidas en curso); ORPHAN_SWEEP_INTERVAL_HOURS > 0
+# programa el barrido con borrado en los workers.
+ORPHAN_GRACE_HOURS = float(os.getenv("ORPHAN_GRACE_HOURS", "24"))
+ORPHAN_SWEEP_BATCH = int(os.getenv("ORPHAN_SWEEP_BATCH", "500"))
+ORPHAN_SWEEP_INTERVAL_HOURS = float(os.getenv("ORPHAN_SWEEP_INTERVAL_HOURS", "0"))
+# Motor de base: "sqlite" (DB_PATH) o "postgresql" (DATABASE_URL, requiere psycopg y psycopg_pool)
+DB_ENGINE = os.getenv("DB_ENGINE", "sqlite").lower()
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+PG_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT", "30"))
+# Claves de idempotencia de /tickets/new (campo oculto o header Idempotency-Key): segundos que se recuerdan
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+# Segundos que un reintento espera a que termine la creación en curso con la misma clave
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", "10"))
 
 ALLOWED_EXTENSIONS = {"pdf"}
 
@@ -39,9 +103,52 @@ SMTP_PASS = os.getenv("SMTP_PASS", "")
 MAIL_FROM = os.getenv("MAIL_FROM", "noreply@telecom.com.ar")
 MAIL_CC_ON_CLOSE = os.getenv("MAIL_CC_ON_CLOSE", "iga-notify@telecom.com.ar")  # múltiples separados por coma
 USE_OUTLOOK = os.getenv("USE_OUTLOOK", "1").lower() in ("1", "true", "yes", "y", "on")
+# Envío en segundo plano: el request no espera a Outlook/SMTP
+MAIL_ASYNC = os.getenv("MAIL_ASYNC", "1").lower() in ("1", "true", "yes", "y", "on")
+# Con envío en segundo plano el aviso al usuario no puede prometer que el correo ya salió
+MAIL_QUEUED_NOTE = "La notificación por email quedó en cola de envío." if MAIL_ASYNC else "Se envió una notificación."
+MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", "2"))
+
+# Acciones masivas desde /search (cerrar, reasignar, borrar): máximo de tickets por operación
+BULK_MAX_TICKETS = int(os.getenv("BULK_MAX_TICKETS", "1000"))
+
+# Salud y apagado ordenado: /readyz reutiliza el chequeo de la base READY_CHECK_INTERVAL segundos;
+# con más de READY_MAIL_QUEUE_MAX correos pendientes el worker se declara no listo.
+READY_CHECK_INTERVAL = float(os.getenv("READY_CHECK_INTERVAL", "5"))
+READY_MAIL_QUEUE_MAX = int(os.getenv("READY_MAIL_QUEUE_MAX", "100"))
+# Al recibir SIGTERM: segundos como máximo para terminar envíos e indexación pendientes
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+
+# Perfilado de un request puntual (solo admin): con PROFILING_ENABLED=0 no se instala nada
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0").lower() in ("1", "true", "yes", "y", "on")
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", BASE_DIR / "profiles"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))  # perfiles guardados (los más viejos se borran)
+
+# Texto de los PDF adjuntos: extracción en segundo plano e índice FTS (requiere pypdf)
+PDF_INDEX_ENABLED = os.getenv("PDF_INDEX_ENABLED", "1").lower() in ("1", "true", "yes", "y", "on")
+PDF_INDEX_WORKERS = int(os.getenv("PDF_INDEX_WORKERS", "2"))
+PDF_TEXT_MAX_CHARS = int(os.getenv("PDF_TEXT_MAX_CHARS", "2000000"))
+
+# Compresión de respuestas según Accept-Encoding (brotli si está instalado, si no gzip)
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "1").lower() in ("1", "true", "yes", "y", "on")
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESS_BROTLI = os.getenv("COMPRESS_BROTLI", "1").lower() in ("1", "true", "yes", "y", "on")
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+COMPRESS_MIMETYPES = {"text/html", "text/csv", "text/plain", "text/css", "application/json", "application/javascript"}
 
 # Sistema externo (IGA/JIRA/Remedy/etc.)
 EXTERNAL_SYSTEM_NAME = os.getenv("EXTERNAL_SYSTEM_NAME", "IGA")
+# Sincronización de estado de casos desde su API (vacío = deshabilitada; ver iga_stub.py)
+IGA_API_URL = os.getenv("IGA_API_URL", "").rstrip("/")
+IGA_API_TOKEN = os.getenv("IGA_API_TOKEN", "")
+IGA_SYNC_BATCH = int(os.getenv("IGA_SYNC_BATCH", "200"))  # casos por pedido y por transacción
+IGA_SYNC_CONCURRENCY = int(os.getenv("IGA_SYNC_CONCURRENCY", "4"))  # pedidos en vuelo como máximo
+IGA_RATE_LIMIT = float(os.getenv("IGA_RATE_LIMIT", "5"))  # pedidos por segundo (0 = sin límite)
+IGA_TIMEOUT = float(os.getenv("IGA_TIMEOUT", "15"))
+IGA_MAX_RETRIES = int(os.getenv("IGA_MAX_RETRIES", "4"))
+IGA_SYNC_INTERVAL_MINUTES = float(os.getenv("IGA_SYNC_INTERVAL_MINUTES", "0"))  # 0 = solo `flask iga-sync`
+IGA_CLOSED_STATUSES = {s.strip().lower() for s in os.getenv("IGA_CLOSED_STATUSES", "cerrado,resuelto,closed,resolved").split(",") if s.strip()}
 
 # Adjuntos por correo
 ENABLE_CREATE_ATTACH_PDF = os.getenv("ENABLE_CREATE_ATTACH_PDF", "1").lower() in ("1","true","yes","y","on")
@@ -100,6 +207,8 @@ TEMPLATES = {
             <ul class="navbar-nav me-auto">
               <li class="nav-item"><a class="nav-link" href="{{ url_for('new_ticket') }}">Nuevo Ticket</a></li>
               <li class="nav-item"><a class="nav-link" href="{{ url_for('search') }}">Buscar</a></li>
+              <li class="nav-item"><a class="nav-link" href="{{ url_for('sites') }}">Sitios</a></li>
+              <li class="nav-item"><a class="nav-link" href="{{ url_for('reports') }}">Reportes</a></li>
               <li class="nav-item dropdown">
                 <a class="nav-link dropdown-toggle" data-bs-toggle="dropdown" href="#">Admin</a>
                 <ul class="dropdown-menu">
@@ -132,6 +241,84 @@ TEMPLATES = {
         {% block content %}{% endblock %}
       </div>
       <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js"></script>
+      <script>
+        // Autocompletado de sitios: inputs con data-site-suggest usan /api/sites/suggest
+        document.querySelectorAll('[data-site-suggest]').forEach(function(input, n) {
+          const list = document.createElement('datalist');
+          list.id = 'siteSuggest' + n;
+          document.body.appendChild(list);
+          input.setAttribute('list', list.id);
+          let timer = null;
+          input.addEventListener('input', function() {
+            clearTimeout(timer);
+            const prefix = input.value.trim();
+            if (prefix.length < 2 || /^#?\d+$/.test(prefix)) { list.innerHTML = ''; return; }
+            timer = setTimeout(function() {
+              fetch("{{ url_for('api_sites_suggest') }}?prefix=" + encodeURIComponent(prefix))
+                .then(function(r) { return r.ok ? r.json() : {sites: []}; })
+                .then(function(data) {
+                  list.innerHTML = '';
+                  data.sites.forEach(function(site) {
+                    const opt = document.createElement('option');
+                    opt.value = site;
+                    list.appendChild(opt);
+                  });
+                });
+            }, 150);
+          });
+        });
+
+        // Fragmentos: filtros, paginado y "Actualizar" reemplazan solo su región
+        // (sin volver a bajar el layout); sin JS, los mismos enlaces cargan la página completa.
+        function loadFragment(region, src, query) {
+          region.setAttribute('aria-busy', 'true');
+          return fetch(src + (query ? '?' + query : ''), {credentials: 'same-origin'})
+            .then(function(r) {
+              // Sesión vencida: el login redirige y se navega a la página completa
+              if (r.redirected) { location.href = r.url; return; }
+              if (!r.ok) throw new Error('HTTP ' + r.status);
+              return r.text().then(function(html) { region.innerHTML = html; });
+            })
+            .finally(function() { region.removeAttribute('aria-busy'); });
+        }
+        document.querySelectorAll('form[data-fragment-target]').forEach(function(form) {
+          const region = document.querySelector(form.dataset.fragmentTarget);
+          const src = form.dataset.fragmentSrc;
+          function show(query, push) {
+            if (push) history.pushState({query: query}, '', location.pathname + (query ? '?' + query : ''));
+            form.querySelectorAll('[data-keep-query]').forEach(function(a) {
+              a.href = a.href.split('?')[0] + (query ? '?' + query : '');
+            });
+            return loadFragment(region, src, query);
+          }
+          form.addEventListener('submit', function(e) {
+            e.preventDefault();
+            const params = new URLSearchParams();
+            new FormData(form).forEach(function(v, k) { if (v !== '') params.append(k, v); });
+            show(params.toString(), true);
+          });
+          form.querySelectorAll('select, input[type=checkbox]').forEach(function(el) {
+            el.addEventListener('change', function() { form.requestSubmit(); });
+          });
+          region.addEventListener('click', function(e) {
+            const link = e.target.closest('a[data-fragment-link]');
+            if (!link || link.closest('.disabled')) return;
+            e.preventDefault();
+            show(new URL(link.href).search.slice(1), true).then(function() { region.scrollIntoView(); });
+          });
+          window.addEventListener('popstate', function() { show(location.search.slice(1), false); });
+        });
+        document.querySelectorAll('[data-fragment-src]:not(form)').forEach(function(region) {
+          const refresh = function() { return loadFragment(region, region.dataset.fragmentSrc, ''); };
+          document.querySelectorAll('[data-fragment-refresh="#' + region.id + '"]').forEach(function(btn) {
+            btn.addEventListener('click', refresh);
+          });
+          const poll = parseInt(region.dataset.fragmentPoll || '0', 10);
+          if (poll > 0) {
+            setInterval(function() { if (!document.hidden) refresh(); }, poll * 1000);
+          }
+        });
+      </script>
     </body>
     </html>
     """,
@@ -164,11 +351,19 @@ TEMPLATES = {
         <h3 class="me-3">Resumen</h3>
         <a class="btn btn-sm btn-primary" href="{{ url_for('new_ticket') }}">Crear ticket</a>
         <div class="ms-auto d-flex gap-2">
+          <button class="btn btn-sm btn-outline-secondary" type="button" data-fragment-refresh="#homeSummary">Actualizar</button>
           <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('export_csv') }}">Exportar CSV</a>
           <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('export_xlsx') }}">Exportar Excel</a>
         </div>
       </div>
 
+      <div id="homeSummary" data-fragment-src="{{ url_for('home_summary_fragment') }}"
+           data-fragment-poll="{{ home_refresh_seconds }}">
+        {{ summary_html }}
+      </div>
+    {% endblock %}
+    """,
+    "_home_summary.html": r"""
       <div class="row g-3">
         {% for card in summary_cards %}
         <div class="col-md-4">
@@ -185,6 +380,22 @@ TEMPLATES = {
         {% endfor %}
       </div>
 
+      {% if top_sites %}
+      <hr class="my-4">
+      <div class="d-flex align-items-center mb-3">
+        <h4 class="mb-0">Sitios con más tickets abiertos</h4>
+        <a class="ms-auto small" href="{{ url_for('sites') }}">Ver todos</a>
+      </div>
+      <div class="list-group">
+        {% for s in top_sites %}
+          <a class="list-group-item list-group-item-action d-flex justify-content-between" href="{{ url_for('site_detail', code=s.code) }}">
+            <span>{{ s.name }}</span>
+            <span><span class="badge bg-primary">{{ s.open }} abiertos</span> <span class="badge bg-secondary">{{ s.total }}</span></span>
+          </a>
+        {% endfor %}
+      </div>
+      {% endif %}
+
       <hr class="my-4">
       <h4 class="mb-3">Últimos tickets</h4>
       <div class="list-group">
@@ -200,17 +411,18 @@ TEMPLATES = {
           <div class="text-muted">No hay tickets aún.</div>
         {% endfor %}
       </div>
-    {% endblock %}
     """,
     "new_ticket.html": r"""
     {% extends 'layout.html' %}
     {% block content %}
       <h3 class="mb-3">Nuevo Ticket</h3>
-      <form class="card p-4 shadow-sm" method="post" enctype="multipart/form-data">
+      <form class="card p-4 shadow-sm" method="post" enctype="multipart/form-data"
+            onsubmit="this.querySelector('button[type=submit]').disabled = true;">
+        <input type="hidden" name="idempotency_key" value="{{ idempotency_key }}" />
         <div class="row g-3">
           <div class="col-md-6">
             <label class="form-label">Nombre del sitio</label>
-            <input required type="text" name="site_name" class="form-control" placeholder="Ej: AMBA_UTN_MEDRANO" />
+            <input required type="text" name="site_name" class="form-control" placeholder="Ej: AMBA_UTN_MEDRANO" autocomplete="off" data-site-suggest />
           </div>
           <div class="col-md-6">
             <label class="form-label">Tipo de Modernización</label>
@@ -268,8 +480,11 @@ TEMPLATES = {
     {% extends 'layout.html' %}
     {% block content %}
       <div class="d-flex justify-content-between align-items-center mb-2">
-        <h3>Ticket #{{ t['id'] }} · {{ t['site_name'] }}</h3>
-        <span class="badge bg-{% if t['status']=='Cerrado' %}success{% else %}warning{% endif %} badge-status">{{ t['status'] }}</span>
+        <h3>Ticket #{{ t['id'] }} · {% if t['site_code'] %}<a href="{{ url_for('site_detail', code=t['site_code']) }}">{{ t['site_name'] }}</a>{% else %}{{ t['site_name'] }}{% endif %}</h3>
+        <span>
+          {% if t['archived'] %}<span class="badge bg-secondary badge-status">Archivado</span>{% endif %}
+          <span class="badge bg-{% if t['status']=='Cerrado' %}success{% else %}warning{% endif %} badge-status">{{ t['status'] }}</span>
+        </span>
       </div>
       <div class="card shadow-sm p-3 mb-3">
         <div class="row g-3">
@@ -296,6 +511,7 @@ TEMPLATES = {
             <input form="closeForm" class="form-control" type="url" name="iga_link" value="{{ t['iga_link'] or '' }}" {% if t['status']=='Cerrado' %}disabled{% endif %}>
             {% if t['iga_link'] %}<small><a href="{{ t['iga_link'] }}" target="_blank">Abrir {{ EXTSYS }}</a></small>{% endif %}
           </div>
+          {% if t['iga_status'] %}<div class="col-12 small text-muted">Estado en {{ EXTSYS }}: {{ t['iga_status'] }}</div>{% endif %}
         </div>
       </div>
 
@@ -312,6 +528,7 @@ TEMPLATES = {
         {% endif %}
         {% if t['status'] != 'Cerrado' %}
           <form id="closeForm" method="post" action="{{ url_for('close_ticket', ticket_id=t['id']) }}" onsubmit="return confirm('¿Cerrar el caso como COMPLETADO?');">
+            <input type="hidden" name="version" value="{{ t['version'] }}">
             <button class="btn btn-success" type="submit">Cerrar caso (Completado)</button>
           </form>
         {% endif %}
@@ -342,14 +559,234 @@ TEMPLATES = {
       </script>
     {% endblock %}
     
+    """,
+    "reports.html": r"""
+    {% extends 'layout.html' %}
+    {% block content %}
+      <h3 class="mb-3">Reportes</h3>
+      <form class="row g-2 mb-4" method="get">
+        <div class="col-md-3">
+          <label class="form-label">Desde</label>
+          <input type="date" class="form-control" name="from" value="{{ week_from }}">
+        </div>
+        <div class="col-md-3">
+          <label class="form-label">Hasta</label>
+          <input type="date" class="form-control" name="to" value="{{ week_to }}">
+        </div>
+        <div class="col-md-2">
+          <label class="form-label">Cierres por</label>
+          <select class="form-select" name="group">
+            <option value="assignee">Responsable</option>
+            <option value="type" {{ 'selected' if group=='type' }}>Tipo</option>
+          </select>
+        </div>
+        <div class="col-md-2">
+          <label class="form-label">Tiempos por</label>
+          <select class="form-select" name="ttc_group">
+            <option value="type">Tipo</option>
+            <option value="assignee" {{ 'selected' if ttc_group=='assignee' }}>Responsable</option>
+          </select>
+        </div>
+        <div class="col-md-2 d-flex align-items-end">
+          <button class="btn btn-primary w-100" type="submit">Ver</button>
+        </div>
+      </form>
+
+      <h5>Cierres por semana</h5>
+      <div class="table-responsive mb-4">
+        <table class="table table-sm table-hover">
+          <thead><tr><th>Semana</th>{% for n in names %}<th class="text-end">{{ n }}</th>{% endfor %}</tr></thead>
+          <tbody>
+            {% for w in weeks %}
+              <tr><td>{{ w }}</td>{% for n in names %}<td class="text-end">{{ closed.get((w, n), 0) }}</td>{% endfor %}</tr>
+            {% else %}
+              <tr><td class="text-muted">Sin movimientos en el rango.</td></tr>
+            {% endfor %}
+          </tbody>
+        </table>
+      </div>
+
+      <h5>Tiempo hasta el cierre (horas)</h5>
+      <table class="table table-sm mb-4">
+        <thead><tr><th></th><th class="text-end">Cerrados</th><th class="text-end">Mediana</th><th class="text-end">p90</th></tr></thead>
+        <tbody>
+          {% for r in ttc %}
+            <tr><td>{{ r.name }}</td><td class="text-end">{{ r.closed }}</td><td class="text-end">{{ r.p50_hours }}</td><td class="text-end">{{ r.p90_hours }}</td></tr>
+          {% else %}
+            <tr><td colspan="4" class="text-muted">Sin cierres en el rango.</td></tr>
+          {% endfor %}
+        </tbody>
+      </table>
+
+      <h5>Backlog abierto al final de cada semana</h5>
+      <table class="table table-sm">
+        <thead><tr><th>Semana</th><th class="text-end">Altas</th><th class="text-end">Cierres</th><th class="text-end">Abiertos</th><th style="width: 40%"></th></tr></thead>
+        <tbody>
+          {% for b in backlog %}
+            <tr>
+              <td>{{ b.week }}</td><td class="text-end">{{ b.opened }}</td><td class="text-end">{{ b.closed }}</td><td class="text-end">{{ b.backlog }}</td>
+              <td><div class="bg-primary" style="height: .8rem; width: {{ (100 * b.backlog / max_backlog)|round(1) if b.backlog > 0 else 0 }}%"></div></td>
+            </tr>
+          {% endfor %}
+        </tbody>
+      </table>
+      <small class="text-muted">JSON: {{ url_for('api_report_throughput') }}, {{ url_for('api_report_time_to_close') }}, {{ url_for('api_report_backlog') }} (parámetros from, to y group=assignee|type).</small>
+    {% endblock %}
+    """,
+    "sites.html": r"""
+    {% extends 'layout.html' %}
+    {% block content %}
+      <div class="d-flex align-items-center mb-3">
+        <h3 class="me-3">Sitios</h3>
+        <form class="form-check mb-0" method="get">
+          <input class="form-check-input" type="checkbox" name="include_archive" value="1" id="includeArchive" onchange="this.form.submit()" {{ 'checked' if include_archive }}>
+          <label class="form-check-label small" for="includeArchive">Incluir archivo</label>
+        </form>
+        <a class="btn btn-sm btn-outline-secondary ms-auto" href="{{ url_for('sites_export_csv', **request.args) }}">Exportar CSV</a>
+      </div>
+      <table class="table table-sm table-hover">
+        <thead><tr><th>Código</th><th>Nombre</th><th class="text-end">Abiertos</th><th class="text-end">Total</th></tr></thead>
+        <tbody>
+          {% for s in rows %}
+            <tr>
+              <td><a href="{{ url_for('site_detail', code=s.code) }}">{{ s.code }}</a></td>
+              <td>{{ s.name }}</td><td class="text-end">{{ s.open }}</td><td class="text-end">{{ s.total }}</td>
+            </tr>
+          {% else %}
+            <tr><td colspan="4" class="text-muted">No hay sitios aún.</td></tr>
+          {% endfor %}
+        </tbody>
+      </table>
+    {% endblock %}
+    """,
+    "site_detail.html": r"""
+    {% extends 'layout.html' %}
+    {% block content %}
+      <div class="d-flex align-items-center mb-3">
+        <h3 class="me-3">{{ site.name }}</h3>
+        <span class="badge bg-primary me-1">{{ counts.open }} abiertos</span>
+        <span class="badge bg-secondary">{{ counts.total }} en total</span>
+        <a class="btn btn-sm btn-outline-secondary ms-auto" href="{{ url_for('export_csv', site=site.code, include_archive=1) }}">Exportar CSV</a>
+      </div>
+      <p class="text-muted small">Código {{ site.code }} · registrado el {{ site.created_at }}</p>
+      <div class="list-group">
+        {% for t in rows %}
+          <a class="list-group-item list-group-item-action" href="{{ url_for('ticket_detail', ticket_id=t['id']) }}">
+            <div class="d-flex w-100 justify-content-between">
+              <h5 class="mb-1">#{{ t['id'] }} · {{ t['site_name'] }}</h5>
+              <small class="text-muted">{{ t['created_at'] }}</small>
+            </div>
+            <small>{{ t['modernization_type_name'] or '—' }} · {{ t['priority'] }} · {{ t['assignee_name'] }} · Estado: {{ t['status'] }}</small>
+          </a>
+        {% else %}
+          <div class="text-muted">Sin tickets para este sitio.</div>
+        {% endfor %}
+      </div>
+      {% if page > 1 or has_next %}
+        <nav class="mt-3">
+          <ul class="pagination">
+            <li class="page-item {{ 'disabled' if page <= 1 }}">
+              <a class="page-link" href="{{ url_for('site_detail', code=site.code, page=page-1) }}">Anterior</a>
+            </li>
+            <li class="page-item disabled"><span class="page-link">Página {{ page }}</span></li>
+            <li class="page-item {{ 'disabled' if not has_next }}">
+              <a class="page-link" href="{{ url_for('site_detail', code=site.code, page=page+1) }}">Siguiente</a>
+            </li>
+          </ul>
+        </nav>
+      {% endif %}
+    {% endblock %}
+    """,
+    "profiles.html": r"""
+    {% extends 'layout.html' %}
+    {% block content %}
+      <h3 class="mb-3">Perfiles de requests</h3>
+      <p class="text-muted small">Para perfilar un request enviá el header <code>X-Profile: &lt;password admin&gt;</code>
+        (p. ej. <code>curl -H "X-Profile: …" {{ request.host_url }}search</code>).</p>
+      <table class="table table-sm table-hover">
+        <thead><tr><th>Fecha</th><th>Request</th><th>Estado</th><th class="text-end">Total ms</th>
+          <th class="text-end">SQL</th><th class="text-end">Jinja</th><th class="text-end">pandas</th><th class="text-end">Python</th></tr></thead>
+        <tbody>
+          {% for p in profiles %}
+            <tr>
+              <td><a href="{{ url_for('debug_profile_detail', name=p.name) }}">{{ p.created_at }}</a></td>
+              <td>{{ p.method }} {{ p.path }}{% if p.query %}?{{ p.query }}{% endif %}</td>
+              <td>{{ p.status }}</td><td class="text-end">{{ p.wall_ms }}</td>
+              {% for k in ('sql', 'jinja', 'pandas', 'python') %}<td class="text-end">{{ p.categories_ms[k] }}</td>{% endfor %}
+            </tr>
+          {% else %}
+            <tr><td colspan="8" class="text-muted">No hay perfiles guardados.</td></tr>
+          {% endfor %}
+        </tbody>
+      </table>
+    {% endblock %}
+    """,
+    "profile_detail.html": r"""
+    {% extends 'layout.html' %}
+    {% block content %}
+      <div class="d-flex align-items-center mb-3">
+        <h3 class="me-3">{{ p.method }} {{ p.path }}</h3>
+        <a class="btn btn-sm btn-outline-secondary ms-auto" href="{{ url_for('debug_profile_detail', name=p.name, download=1) }}">Descargar .prof</a>
+      </div>
+      <p class="text-muted">{{ p.created_at }} · estado {{ p.status }} · {{ p.wall_ms }} ms de reloj, {{ p.total_ms }} ms perfilados · {{ p.sql_calls }} llamadas SQL</p>
+      <table class="table table-sm w-auto mb-4">
+        <tbody>
+          {% for k, v in p.categories_ms.items() %}<tr><th>{{ k }}</th><td class="text-end">{{ v }} ms</td></tr>{% endfor %}
+        </tbody>
+      </table>
+      <h5>SQL por función que la llama</h5>
+      <table class="table table-sm mb-4">
+        <thead><tr><th>Función</th><th class="text-end">Llamadas</th><th class="text-end">ms</th></tr></thead>
+        <tbody>
+          {% for r in p.sql_by_caller %}<tr><td><code>{{ r.func }}</code></td><td class="text-end">{{ r.calls }}</td><td class="text-end">{{ r.ms }}</td></tr>{% endfor %}
+        </tbody>
+      </table>
+      {% for title, key in (('Tiempo propio', 'top_tottime'), ('Tiempo acumulado', 'top_cumtime')) %}
+        <h5>{{ title }}</h5>
+        <table class="table table-sm mb-4">
+          <thead><tr><th>Función</th><th class="text-end">Llamadas</th><th class="text-end">Propio ms</th><th class="text-end">Acumulado ms</th></tr></thead>
+          <tbody>
+            {% for r in p[key] %}<tr><td><code>{{ r.func }}</code></td><td class="text-end">{{ r.calls }}</td><td class="text-end">{{ r.tottime_ms }}</td><td class="text-end">{{ r.cumtime_ms }}</td></tr>{% endfor %}
+          </tbody>
+        </table>
+      {% endfor %}
+    {% endblock %}
+    """,
+    "export_job.html": r"""
+    {% extends 'layout.html' %}
+    {% block content %}
+      <h3 class="mb-3">Exportación {{ job.format|upper }}</h3>
+      <div class="card shadow-sm p-3">
+        {% if job.status == 'listo' %}
+          <p class="mb-2">Lista: {{ job.rows_written }} filas, {{ '%.1f'|format(job.size / 1048576) }} MiB.</p>
+          <div><a class="btn btn-primary" href="{{ url_for('export_job_download', job_id=job.id) }}">Descargar</a></div>
+        {% elif job.status == 'error' %}
+          <p class="text-danger mb-2">La exportación falló: {{ job.error }}</p>
+          <div><a class="btn btn-outline-secondary" href="{{ retry_url }}">Reintentar</a></div>
+        {% else %}
+          <p class="mb-0"><span class="spinner-border spinner-border-sm me-2"></span>
+            {{ 'Procesando' if job.status == 'procesando' else 'En cola' }}{% if job.rows_written %}: {{ job.rows_written }} filas{% endif %}…
+            La página se actualiza sola.</p>
+          <script>setTimeout(function() { location.reload(); }, 2000);</script>
+        {% endif %}
+        <p class="text-muted small mt-3 mb-0">Pedida {{ job.created_at }}. El archivo se reutiliza para la misma consulta mientras no cambien los tickets.</p>
+      </div>
+    {% endblock %}
     """,
     "search.html": r"""
     {% extends 'layout.html' %}
     {% block content %}
       <h3 class="mb-3">Buscar Tickets</h3>
-      <form class="row g-2 mb-3" method="get">
+      <form class="row g-2 mb-3" method="get" data-fragment-target="#searchResults"
+            data-fragment-src="{{ url_for('search_results') }}">
         <div class="col-md-3">
-          <input type="text" class="form-control" name="q" placeholder="#ticket o Sitio" value="{{ request.args.get('q','') }}">
+          <div class="input-group">
+            <input type="text" class="form-control" name="q" placeholder="#ticket, Sitio o texto" value="{{ request.args.get('q','') }}" autocomplete="off" data-site-suggest>
+            <select class="form-select flex-grow-0 w-auto" name="mode" title="Buscar en">
+              <option value="site">Sitio</option>
+              <option value="doc" {{ 'selected' if request.args.get('mode')=='doc' }}>En documento</option>
+            </select>
+          </div>
         </div>
         <div class="col-md-2">
           <select class="form-select" name="status">
@@ -375,26 +812,83 @@ TEMPLATES = {
           </select>
         </div>
         <div class="col-md-3 d-grid gap-2 d-md-flex justify-content-md-end">
+          <div class="form-check align-self-center me-2">
+            <input class="form-check-input" type="checkbox" name="include_archive" value="1" id="includeArchive" {{ 'checked' if request.args.get('include_archive')=='1' }}>
+            <label class="form-check-label small" for="includeArchive">Incluir archivo</label>
+          </div>
           <button class="btn btn-primary" type="submit">Buscar</button>
-          <a class="btn btn-outline-secondary" href="{{ url_for('export_csv', **request.args) }}">CSV</a>
-          <a class="btn btn-outline-secondary" href="{{ url_for('export_xlsx', **request.args) }}">Excel</a>
+          <a class="btn btn-outline-secondary" href="{{ url_for('export_csv', **request.args) }}" data-keep-query>CSV</a>
+          <a class="btn btn-outline-secondary" href="{{ url_for('export_xlsx', **request.args) }}" data-keep-query>Excel</a>
         </div>
       </form>
 
+      <div id="searchResults">
+        {{ results_html }}
+      </div>
+    {% endblock %}
+    """,
+    "_search_results.html": r"""
+      {% set args = request.args.to_dict() %}
+      {% if results %}
+      <form id="bulkForm" class="card card-body p-2 mb-2" method="post" action="{{ url_for('bulk_tickets') }}"
+            onsubmit="return document.querySelectorAll('input[name=ids]:checked').length > 0 && (this.action.value !== 'delete' || confirm('¿Eliminar definitivamente los tickets seleccionados?'));">
+        <input type="hidden" name="next" value="{{ url_for('search', **args) }}">
+        <div class="row g-2 align-items-center">
+          <div class="col-auto form-check ms-2">
+            <input class="form-check-input" type="checkbox" id="selectAll"
+                   onchange="document.querySelectorAll('input[name=ids]').forEach(c => c.checked = this.checked)">
+            <label class="form-check-label small" for="selectAll">Todos</label>
+          </div>
+          <div class="col-md-2">
+            <select class="form-select form-select-sm" name="action"
+                    onchange="this.form.querySelectorAll('[data-action]').forEach(e => e.hidden = e.dataset.action !== this.value)">
+              <option value="close">Cerrar</option>
+              <option value="reassign">Reasignar</option>
+              <option value="delete">Eliminar</option>
+            </select>
+          </div>
+          <div class="col-md-2" data-action="close"><input class="form-control form-control-sm" name="iga_case_number" placeholder="N° caso {{ EXTSYS }}"></div>
+          <div class="col-md-3" data-action="close"><input class="form-control form-control-sm" name="iga_link" placeholder="Link {{ EXTSYS }}"></div>
+          <div class="col-md-3" data-action="reassign" hidden>
+            <select class="form-select form-select-sm" name="assignee_id">
+              {% for a in assignees %}<option value="{{ a['id'] }}">{{ a['name'] }}</option>{% endfor %}
+            </select>
+          </div>
+          <div class="col-md-2"><input class="form-control form-control-sm" type="password" name="admin_password" placeholder="Password admin" required></div>
+          <div class="col-auto"><button class="btn btn-sm btn-outline-primary" type="submit">Aplicar a seleccionados</button></div>
+        </div>
+      </form>
+      {% endif %}
       <div class="list-group">
         {% for t in results %}
-          <a class="list-group-item list-group-item-action" href="{{ url_for('ticket_detail', ticket_id=t['id']) }}">
-            <div class="d-flex w-100 justify-content-between">
-              <h5 class="mb-1">#{{ t['id'] }} · {{ t['site_name'] }}</h5>
-              <small class="text-muted">{{ t['created_at'] }}</small>
-            </div>
-            <small>{{ t['modernization_type_name'] or '—' }} · {{ t['priority'] }} · {{ t['assignee_name'] }} · Estado: {{ t['status'] }}</small>
-          </a>
+          <div class="d-flex align-items-start">
+            <input class="form-check-input mt-3 me-2" type="checkbox" name="ids" value="{{ t['id'] }}" form="bulkForm" aria-label="Seleccionar #{{ t['id'] }}">
+            <a class="list-group-item list-group-item-action" href="{{ url_for('ticket_detail', ticket_id=t['id']) }}">
+              <div class="d-flex w-100 justify-content-between">
+                <h5 class="mb-1">#{{ t['id'] }} · {{ t['site_name'] }}</h5>
+                <small class="text-muted">{{ t['created_at'] }}</small>
+              </div>
+              <small>{{ t['modernization_type_name'] or '—' }} · {{ t['priority'] }} · {{ t['assignee_name'] }} · Estado: {{ t['status'] }}</small>
+              {% if t.snippet %}<div class="small text-muted mt-1">{{ t.snippet }}</div>{% endif %}
+            </a>
+          </div>
         {% else %}
           <div class="text-muted">Sin resultados.</div>
         {% endfor %}
       </div>
-    {% endblock %}
+      {% if page > 1 or has_next %}
+        <nav class="mt-3">
+          <ul class="pagination">
+            <li class="page-item {{ 'disabled' if page <= 1 }}">
+              <a class="page-link" href="{{ url_for('search', **dict(args, page=page-1)) }}" data-fragment-link>Anterior</a>
+            </li>
+            <li class="page-item disabled"><span class="page-link">Página {{ page }}</span></li>
+            <li class="page-item {{ 'disabled' if not has_next }}">
+              <a class="page-link" href="{{ url_for('search', **dict(args, page=page+1)) }}" data-fragment-link>Siguiente</a>
+            </li>
+          </ul>
+        </nav>
+      {% endif %}
     """,
     "admin_types.html": r"""
     {% extends 'layout.html' %}
@@ -524,36 +1018,546 @@ def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+# ------------------------------
+# Almacenamiento de adjuntos
+# ------------------------------
+STORAGE_CHUNK_SIZE = 64 * 1024
+
+StoredObject = namedtuple("StoredObject", "name size mtime_ns")
+
+
+class LocalCopy:
+    """Ruta local de un adjunto mientras se usa (Outlook y pypdf necesitan archivo).
+    Si es una copia temporal, se borra al cerrar."""
+
+    def __init__(self, path: Path, temporary: bool = False):
+        self.path = path
+        self.temporary = temporary
+
+    def close(self):
+        if self.temporary:
+            shutil.rmtree(self.path.parent, ignore_errors=True)
+
+    def __enter__(self):
+        return self.path
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AttachmentStorage(ABC):
+    """Interfaz de almacenamiento de los PDF adjuntos. Los nombres son planos (secure_filename).
+
+    Un backend que no implemente todos los métodos abstractos falla al construirse.
+    """
+
+    @abstractmethod
+    def put(self, name: str, stream, content_type: str | None = None):
+        """Guarda ``stream`` (file-like) como ``name``, sin cargarlo entero en memoria."""
+
+    @abstractmethod
+    def get(self, name: str, start: int | None = None, end: int | None = None):
+        """Itera el contenido en bloques; ``start``/``end`` (inclusive) para lecturas parciales."""
+
+    @abstractmethod
+    def delete(self, name: str) -> bool:
+        """Borra el adjunto; True si existía."""
+
+    def delete_many(self, names: list[str]) -> list[str]:
+        """Borra varios adjuntos; devuelve los nombres que existían y se borraron."""
+        return [name for name in names if self.delete(name)]
+
+    def exists(self, name: str) -> bool:
+        return self.stat(name) is not None
+
+    @abstractmethod
+    def stat(self, name: str) -> StoredObject | None:
+        """Tamaño y mtime del adjunto, o None si no existe."""
+
+    @abstractmethod
+    def iter_objects(self):
+        """Recorre los adjuntos guardados sin materializar la lista completa."""
+
+    def iter_partial(self):
+        """Temporales de subidas que no llegaron a renombrarse (solo el backend local los deja)."""
+        return iter(())
+
+    def presigned_url(self, name: str, expires: int = S3_PRESIGN_EXPIRES) -> str | None:
+        """URL de descarga directa si el backend la soporta (None: la sirve la app)."""
+        return None
+
+    @abstractmethod
+    def local_copy(self, name: str) -> LocalCopy:
+        """Ruta local del adjunto (copia temporal si el backend es remoto)."""
+
+
+class LocalStorage(AttachmentStorage):
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, name: str) -> Path:
+        return self.root / name
+
+    def put(self, name: str, stream, content_type: str | None = None):
+        # Se escribe a un temporal y se renombra: nunca queda un PDF a medias con el nombre final
+        final = self.path(name)
+        tmp = final.with_name(f".{name}.part")
+        with open(tmp, "wb") as out:
+            shutil.copyfileobj(stream, out, STORAGE_CHUNK_SIZE)
+        os.replace(tmp, final)
+
+    def get(self, name: str, start: int | None = None, end: int | None = None):
+        with open(self.path(name), "rb") as f:
+            if start:
+                f.seek(start)
+            remaining = None if end is None else end - (start or 0) + 1
+            while remaining is None or remaining > 0:
+                chunk = f.read(STORAGE_CHUNK_SIZE if remaining is None else min(STORAGE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, name: str) -> bool:
+        try:
+            self.path(name).unlink()
+            return True
+        except FileNotFoundError:
+            return False
+
+    def stat(self, name: str) -> StoredObject | None:
+        try:
+            st = self.path(name).stat()
+        except FileNotFoundError:
+            return None
+        return StoredObject(name, st.st_size, st.st_mtime_ns)
+
+    def iter_objects(self):
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.startswith("."):
+                    st = entry.stat()
+                    yield StoredObject(entry.name, st.st_size, st.st_mtime_ns)
+
+    def iter_partial(self):
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.startswith(".") and entry.name.endswith(".part"):
+                    st = entry.stat()
+                    yield StoredObject(entry.name, st.st_size, st.st_mtime_ns)
+
+    def local_copy(self, name: str) -> LocalCopy:
+        return LocalCopy(self.path(name))
+
+
+class S3Storage(AttachmentStorage):
+    """Backend S3/MinIO. Subidas multipart en streaming (boto3 TransferConfig), lecturas por rango."""
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str | None = None, region: str | None = None):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise RuntimeError("STORAGE_BACKEND=s3 requiere boto3: pip install boto3") from e
+        if not bucket:
+            raise RuntimeError("STORAGE_BACKEND=s3 requiere S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self.transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                              multipart_chunksize=8 * 1024 * 1024)
+        self._client_error = ClientError
+
+    def key(self, name: str) -> str:
+        return f"{self.prefix}{name}"
+
+    def put(self, name: str, stream, content_type: str | None = None):
+        extra = {"ContentType": content_type} if content_type else None
+        self.client.upload_fileobj(stream, self.bucket, self.key(name), ExtraArgs=extra, Config=self.transfer_config)
+
+    def get(self, name: str, start: int | None = None, end: int | None = None):
+        kwargs = {"Bucket": self.bucket, "Key": self.key(name)}
+        if start is not None or end is not None:
+            kwargs["Range"] = f"bytes={start or 0}-{'' if end is None else end}"
+        body = self.client.get_object(**kwargs)["Body"]
+        try:
+            yield from body.iter_chunks(STORAGE_CHUNK_SIZE)
+        finally:
+            body.close()
+
+    def delete(self, name: str) -> bool:
+        existed = self.exists(name)
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+        return existed
+
+    def delete_many(self, names: list[str]) -> list[str]:
+        # S3 informa como "Deleted" también las claves que no existían: se cuentan antes con HEAD
+        # (en paralelo; el cliente de boto3 es thread-safe) y se borran solo las existentes
+        with ThreadPoolExecutor(max_workers=min(8, max(1, len(names))), thread_name_prefix="s3-stat") as pool:
+            names = [n for n, found in zip(names, pool.map(self.exists, names)) if found]
+        # DeleteObjects: hasta 1000 claves por llamada en vez de un request por archivo
+        by_key = {self.key(n): n for n in names}
+        deleted = []
+        for i in range(0, len(names), 1000):
+            resp = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": self.key(n)} for n in names[i:i + 1000]], "Quiet": False},
+            )
+            deleted.extend(by_key[d["Key"]] for d in resp.get("Deleted", []) if d.get("Key") in by_key)
+            for err in resp.get("Errors", []):
+                logger.warning(f"[S3] No se pudo borrar {err.get('Key')}: {err.get('Message')}")
+        return deleted
+
+    def stat(self, name: str) -> StoredObject | None:
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except self._client_error as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return StoredObject(name, head["ContentLength"], int(head["LastModified"].timestamp() * 1e9))
+
+    def iter_objects(self):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                name = obj["Key"][len(self.prefix):]
+                if name and "/" not in name:
+                    yield StoredObject(name, obj["Size"], int(obj["LastModified"].timestamp() * 1e9))
+
+    def presigned_url(self, name: str, expires: int = S3_PRESIGN_EXPIRES) -> str | None:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self.key(name),
+                    "ResponseContentDisposition": f'attachment; filename="{name}"'},
+            ExpiresIn=expires,
+        )
+
+    def local_copy(self, name: str) -> LocalCopy:
+        path = Path(tempfile.mkdtemp(prefix="portal_")) / name
+        with open(path, "wb") as f:
+            self.client.download_fileobj(self.bucket, self.key(name), f)
+        return LocalCopy(path, temporary=True)
+
+
+def make_storage() -> AttachmentStorage:
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_REGION)
+    return LocalStorage(UPLOAD_FOLDER)
+
+
+storage = make_storage()
+
+
+# ------------------------------
+# Acceso a datos: SQLite (por defecto) o PostgreSQL con pool
+# ------------------------------
+class SqliteConnection(sqlite3.Connection):
+    """sqlite3.Connection con la misma interfaz mínima que PgConnection."""
+
+    dialect = "sqlite"
+    readonly = False
+
+    def server_cursor(self):
+        # sqlite3 ya itera el resultado paso a paso; no hay cursor del lado del servidor
+        return self.cursor()
+
+
+class PgRow:
+    """Fila compatible con sqlite3.Row: índice, nombre de columna, keys() y dict(row)."""
+
+    __slots__ = ("_index", "_values")
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._values[self._index[key]]
+        return self._values[key]
+
+    def keys(self):
+        return list(self._index)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f"PgRow({dict(zip(self._index, self._values))!r})"
+
+
+_DEFAULT_ROWS = object()
+
+
+@lru_cache(maxsize=512)
+def _pg_sql(sql: str) -> str:
+    """Placeholders de sqlite3 (?) al estilo de psycopg (%s)."""
+    return sql.replace("%", "%%").replace("?", "%s")
+
+
+class PgCursor:
+    """Cursor de psycopg con la API de sqlite3 que usa el portal (?, row_factory, fetch*)."""
+
+    def __init__(self, raw):
+        self._raw = raw
+        # None -> tuplas (como sqlite3); por defecto PgRow
+        self.row_factory = _DEFAULT_ROWS
+        self._index = None
+
+    def execute(self, sql, params=()):
+        self._raw.execute(_pg_sql(sql), params)
+        self._index = None
+        return self
+
+    def executemany(self, sql, seq):
+        self._raw.executemany(_pg_sql(sql), seq)
+        return self
+
+    def _wrap(self, row):
+        if row is None or self.row_factory is None:
+            return row
+        if self._index is None:
+            self._index = {d.name: i for i, d in enumerate(self._raw.description)}
+        return PgRow(self._index, row)
+
+    def fetchone(self):
+        return self._wrap(self._raw.fetchone())
+
+    def fetchmany(self, size=1000):
+        return [self._wrap(r) for r in self._raw.fetchmany(size)]
+
+    def fetchall(self):
+        return [self._wrap(r) for r in self._raw.fetchall()]
+
+    def __iter__(self):
+        return (self._wrap(r) for r in self._raw)
+
+    @property
+    def rowcount(self):
+        return self._raw.rowcount
+
+    @property
+    def description(self):
+        return self._raw.description
+
+    def close(self):
+        self._raw.close()
+
+
+class PgConnection:
+    """Conexión de psycopg prestada por el pool, con la interfaz de sqlite3 que usa el portal.
+
+    close() la devuelve al pool (con rollback de lo no confirmado).
+    """
+
+    dialect = "postgresql"
+
+    def __init__(self, raw, pool=None, readonly=False):
+        self._raw = raw
+        self._pool = pool
+        self.readonly = readonly
+
+    def cursor(self):
+        return PgCursor(self._raw.cursor())
+
+    def server_cursor(self):
+        """Cursor con nombre (del lado del servidor): fetchmany trae de a lotes sin cargar todo."""
+        return PgCursor(self._raw.cursor(name=f"portal_{threading.get_ident()}_{time.monotonic_ns()}"))
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def close(self):
+        if self._raw is None:
+            return
+        raw, self._raw = self._raw, None
+        if raw.info.transaction_status != 0:  # lecturas sin commit: el pool no necesita avisarlo
+            raw.rollback()
+        if self._pool is not None:
+            self._pool.putconn(raw)
+        else:
+            raw.close()
+
+
+_pg_pool = None
+_pg_pool_lock = threading.Lock()
+
+
+def _pg_reset(raw):
+    # Al volver al pool: sin snapshot de solo lectura pegado a la conexión
+    raw.read_only = None
+    raw.isolation_level = None
+
+
+def get_pg_pool():
+    """Pool de conexiones PostgreSQL, creado al primer uso (después del fork de gunicorn)."""
+    global _pg_pool
+    if _pg_pool is None:
+        with _pg_pool_lock:
+            if _pg_pool is None:
+                try:
+                    from psycopg_pool import ConnectionPool
+                except ImportError as exc:
+                    raise RuntimeError(
+                        "DB_ENGINE=postgresql requiere psycopg y psycopg_pool. "
+                        "Instalar con: pip install 'psycopg[binary]' psycopg_pool"
+                    ) from exc
+                if not DATABASE_URL:
+                    raise RuntimeError("DB_ENGINE=postgresql requiere DATABASE_URL")
+                _pg_pool = ConnectionPool(
+                    DATABASE_URL,
+                    min_size=PG_POOL_MIN,
+                    max_size=PG_POOL_MAX,
+                    timeout=PG_POOL_TIMEOUT,
+                    reset=_pg_reset,
+                    name="portal",
+                    open=True,
+                )
+    return _pg_pool
+
+
+def db_integrity_errors() -> tuple:
+    """Excepciones de clave duplicada/FK de cualquiera de los dos motores."""
+    errors = (sqlite3.IntegrityError,)
+    if DB_ENGINE == "postgresql":
+        import psycopg
+        errors += (psycopg.IntegrityError,)
+    return errors
+
+
 def db_connect():
-    conn = sqlite3.connect(DB_PATH)
+    if DB_ENGINE == "postgresql":
+        pool = get_pg_pool()
+        return PgConnection(pool.getconn(), pool)
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, factory=SqliteConnection)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def db_connect_readonly(with_archive: bool = False):
+    """Conexión de solo lectura para lecturas largas (exportaciones, reportes).
+
+    Abre la transacción de entrada: en modo WAL la primera lectura fija una
+    foto de la base que se mantiene hasta cerrar la conexión, sin bloquear los
+    commits de new_ticket()/close_ticket(). ``with_archive`` adjunta archive.db
+    antes de abrir la transacción (ATTACH no se permite dentro de una).
+    En PostgreSQL la foto es una transacción REPEATABLE READ READ ONLY.
+    """
+    if DB_ENGINE == "postgresql":
+        from psycopg import IsolationLevel
+        pool = get_pg_pool()
+        raw = pool.getconn()
+        raw.read_only = True
+        raw.isolation_level = IsolationLevel.REPEATABLE_READ
+        return PgConnection(raw, pool, readonly=True)
+    uri = f"{Path(DB_PATH).resolve().as_uri()}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, timeout=DB_BUSY_TIMEOUT, isolation_level=None,
+                           factory=SqliteConnection)
     conn.row_factory = sqlite3.Row
+    conn.readonly = True
+    conn.execute("PRAGMA query_only = ON")
+    if with_archive:
+        attach_archive(conn, readonly=True)
+    conn.execute("BEGIN")
     return conn
 
 
+def sql_datetime(expr: str, fmt: str = "%d/%m/%Y %H:%M", dialect: str | None = None) -> str:
+    """Expresión SQL que formatea una fecha ISO guardada como TEXT (por defecto en el dialecto de DB_ENGINE)."""
+    if (dialect or DB_ENGINE) == "postgresql":
+        pg_fmt = fmt.replace("%d", "DD").replace("%m", "MM").replace("%Y", "YYYY") \
+                    .replace("%H", "HH24").replace("%M", "MI")
+        return f"to_char(({expr})::timestamp, '{pg_fmt}')"
+    return f"strftime('{fmt}', {expr})"
+
+
+def _gevent_active() -> bool:
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+def run_blocking(fn, *args, **kwargs):
+    """Ejecuta una llamada bloqueante (sqlite3, COM de Outlook) sin trabar el loop de gevent.
+
+    Con workers gevent se delega al threadpool nativo del hub; con gthread/sync
+    ya estamos en un hilo real y se llama directo.
+    """
+    if _gevent_active():
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
+
+
 def init_db():
     conn = db_connect()
+    try:
+        create_schema(conn)
+        conn.commit()
+        link_ticket_sites(conn)
+    finally:
+        conn.close()
+
+
+def create_schema(conn):
+    """Tablas, índices y triggers del portal en el dialecto de ``conn`` (idempotente)."""
+    pg = conn.dialect == "postgresql"
+    pk = "SERIAL PRIMARY KEY" if pg else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    bigint = "BIGINT" if pg else "INTEGER"
+    if not pg:
+        # WAL: los lectores (exports) ven un snapshot y no frenan a los writers
+        conn.execute("PRAGMA journal_mode=WAL")
     cur = conn.cursor()
     cur.execute(
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS modernization_types (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id {pk},
             name TEXT NOT NULL UNIQUE
         )
         """
     )
     cur.execute(
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS assignees (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id {pk},
             name TEXT NOT NULL UNIQUE,
             email TEXT
         )
         """
     )
+    # Registro de sitios: code = nombre normalizado (normalize_site_key), name = grafía principal
     cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS sites (
+            id {pk},
+            code TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
         """
+    )
+    cur.execute(
+        f"""
         CREATE TABLE IF NOT EXISTS tickets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id {pk},
             site_name TEXT NOT NULL,
             modernization_type_id INTEGER,
             request_date TEXT NOT NULL,
@@ -566,160 +1570,3345 @@ def init_db():
             status TEXT NOT NULL DEFAULT 'Abierto',
             created_at TEXT NOT NULL,
             updated_at TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            closed_at TEXT,
             FOREIGN KEY (modernization_type_id) REFERENCES modernization_types(id),
             FOREIGN KEY (assignee_id) REFERENCES assignees(id)
         )
         """
     )
+    # Versión de fila para cierres concurrentes (bases creadas antes de la columna)
+    _ensure_column(conn, "tickets", "version", "INTEGER NOT NULL DEFAULT 0")
+    _ensure_column(conn, "tickets", "closed_at", "TEXT")
+    _ensure_column(conn, "tickets", "site_id", "INTEGER REFERENCES sites(id)")
+    # Último estado informado por el sistema externo (sincronización con IGA)
+    _ensure_column(conn, "tickets", "iga_status", "TEXT")
+    # Historial y conteos por sitio salen de este índice (sin LIKE sobre site_name)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_site ON tickets(site_id, status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_pdf_filename ON tickets(pdf_filename)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_iga_case ON tickets(iga_case_number)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_updated_at ON tickets(updated_at)")
+    # Reservas de idempotencia de creación: ticket_id queda NULL mientras el request está en curso
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            ticket_id INTEGER,
+            created_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at)")
+    # Exportaciones grandes en segundo plano; cache_key = (filtros, formato, generación de tickets)
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id TEXT PRIMARY KEY,
+            cache_key TEXT NOT NULL,
+            format TEXT NOT NULL,
+            filters TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pendiente',
+            rows_written {bigint},
+            size {bigint},
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            finished_at TEXT,
+            owner TEXT
+        )
+        """
+    )
+    # Proceso que encoló el job ("host:pid"): mientras viva, el job pendiente sigue en su cola
+    _ensure_column(conn, "export_jobs", "owner", "TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_export_jobs_key ON export_jobs(cache_key, status)")
+    # Registro de cambios (solo se agrega): una fila por alta/cierre/edición/baja/archivado de ticket,
+    # en la misma transacción que el cambio; seq es el cursor del feed /api/changes
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS ticket_changes (
+            seq {"BIGSERIAL PRIMARY KEY" if pg else "INTEGER PRIMARY KEY AUTOINCREMENT"},
+            ticket_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            changed_at TEXT NOT NULL,
+            data TEXT
+        )
+        """
+    )
+    # Rollups para /reports: se actualizan en la misma transacción que cada alta/cierre/baja.
+    # week = lunes de la semana (ISO); tipo sin asignar = 0.
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rollup_weekly (
+            week TEXT NOT NULL,
+            assignee_id INTEGER NOT NULL,
+            modernization_type_id INTEGER NOT NULL,
+            opened INTEGER NOT NULL DEFAULT 0,
+            closed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (week, assignee_id, modernization_type_id)
+        )
+        """
+    )
+    # Histograma de horas hasta el cierre (CLOSE_HOURS_BUCKETS) por semana de cierre
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rollup_close_hist (
+            week TEXT NOT NULL,
+            assignee_id INTEGER NOT NULL,
+            modernization_type_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (week, assignee_id, modernization_type_id, bucket)
+        )
+        """
+    )
+    # Texto extraído de los PDF y estado de extracción por archivo
+    if pg:
+        # tsvector generado + GIN en lugar de FTS5
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pdf_text (
+                pdf_filename TEXT NOT NULL,
+                content TEXT,
+                tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED
+            )
+            """
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_pdf_text_filename ON pdf_text(pdf_filename)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_pdf_text_tsv ON pdf_text USING GIN (tsv)")
+    else:
+        cur.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS pdf_text USING fts5(
+                pdf_filename UNINDEXED,
+                content,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+            """
+        )
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS pdf_extraction (
+            pdf_filename TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            size {bigint},
+            mtime_ns {bigint},
+            pages INTEGER,
+            error TEXT,
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+    # Contadores de generación: cualquier escritura los incrementa (triggers) y
+    # las cachés de lectura los usan como parte de la clave.
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS portal_meta (
+            key TEXT PRIMARY KEY,
+            value {bigint} NOT NULL DEFAULT 0
+        )
+        """
+    )
+    cur.executemany("INSERT INTO portal_meta(key, value) VALUES (?, 0) ON CONFLICT(key) DO NOTHING",
+                    [("tickets_generation",), ("catalog_generation",)])
+    if pg:
+        _create_pg_generation_triggers(cur)
+        return
+    for op in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_tickets_generation_{op.lower()} AFTER {op} ON tickets
+            BEGIN
+                UPDATE portal_meta SET value = value + 1 WHERE key = 'tickets_generation';
+            END
+            """
+        )
+        # Los nombres de tipos/responsables/sitios se muestran en listados y detalle
+        for table in ("assignees", "modernization_types", "sites"):
+            cur.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_generation_{op.lower()} AFTER {op} ON {table}
+                BEGIN
+                    UPDATE portal_meta SET value = value + 1 WHERE key IN ('tickets_generation', 'catalog_generation');
+                END
+                """
+            )
+
+
+def _ensure_column(conn, table: str, column: str, ddl: str):
+    """ALTER TABLE ... ADD COLUMN para bases creadas antes de que existiera la columna."""
+    if conn.dialect == "postgresql":
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {ddl}")
+    elif column not in _table_columns(conn, "main", table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def _create_pg_generation_triggers(cur):
+    """Mismos contadores que los triggers de SQLite, a nivel sentencia."""
+    cur.execute(
+        """
+        CREATE OR REPLACE FUNCTION portal_bump_generation() RETURNS trigger AS $$
+        BEGIN
+            UPDATE portal_meta SET value = value + 1 WHERE key = ANY(TG_ARGV);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    keys = {
+        "tickets": "'tickets_generation'",
+        "assignees": "'tickets_generation', 'catalog_generation'",
+        "modernization_types": "'tickets_generation', 'catalog_generation'",
+        "sites": "'tickets_generation', 'catalog_generation'",
+    }
+    for table, args in keys.items():
+        cur.execute(f"DROP TRIGGER IF EXISTS trg_{table}_generation ON {table}")
+        cur.execute(
+            f"""
+            CREATE TRIGGER trg_{table}_generation
+            AFTER INSERT OR UPDATE OR DELETE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION portal_bump_generation({args})
+            """
+        )
+
+
+def get_generation(conn, key: str = "tickets_generation") -> int:
+    row = conn.execute("SELECT value FROM portal_meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else 0
+
+
+def bump_generation(conn, key: str = "tickets_generation"):
+    """Para escrituras que no pasan por los triggers de main (p. ej. borrar en archive.db)."""
+    conn.execute("UPDATE portal_meta SET value = value + 1 WHERE key=?", (key,))
+
+
+def get_type_name(conn, type_id):
+    if not type_id:
+        return None
+    cur = conn.cursor()
+    cur.execute("SELECT name FROM modernization_types WHERE id=?", (type_id,))
+    row = cur.fetchone()
+    return row["name"] if row else None
+
+
+def get_assignee(conn, assignee_id):
+    cur = conn.cursor()
+    cur.execute("SELECT id, name, email FROM assignees WHERE id=?", (assignee_id,))
+    row = cur.fetchone()
+    return dict(row) if row else None
+
+
+def list_modernization_types(conn) -> list[dict]:
+    return [dict(r) for r in conn.execute("SELECT id, name FROM modernization_types ORDER BY name ASC")]
+
+
+def add_modernization_type(conn, name: str) -> bool:
+    """Agrega el tipo; False si ya existía (la transacción queda limpia en ambos motores)."""
+    try:
+        conn.execute("INSERT INTO modernization_types(name) VALUES (?)", (name,))
+    except db_integrity_errors():
+        conn.rollback()
+        return False
+    return True
+
+
+def delete_modernization_type(conn, type_id: int) -> bool:
+    """False si hay tickets que lo referencian (solo lo impide PostgreSQL; SQLite no aplica FKs)."""
+    try:
+        conn.execute("DELETE FROM modernization_types WHERE id=?", (type_id,))
+    except db_integrity_errors():
+        conn.rollback()
+        return False
+    return True
+
+
+def list_assignees(conn) -> list[dict]:
+    return [dict(r) for r in conn.execute("SELECT id, name, email FROM assignees ORDER BY name ASC")]
+
+
+def upsert_assignee(conn, name: str, email: str):
+    try:
+        conn.execute("INSERT INTO assignees(name, email) VALUES(?, ?) ON CONFLICT(name) DO UPDATE SET email=excluded.email",
+                     (name, email))
+    except sqlite3.OperationalError:
+        # SQLite < 3.24 sin UPSERT
+        row = conn.execute("SELECT id FROM assignees WHERE name=?", (name,)).fetchone()
+        if row:
+            conn.execute("UPDATE assignees SET email=? WHERE id=?", (email, row["id"]))
+        else:
+            conn.execute("INSERT INTO assignees(name, email) VALUES(?, ?)", (name, email))
+
+
+def delete_assignee_row(conn, assignee_id: int) -> bool:
+    """False si tiene tickets asignados (ver delete_modernization_type)."""
+    try:
+        conn.execute("DELETE FROM assignees WHERE id=?", (assignee_id,))
+    except db_integrity_errors():
+        conn.rollback()
+        return False
+    return True
+
+
+def get_or_create_site(conn, site_name: str) -> int | None:
+    """Id del sitio cuyo código normalizado coincide con ``site_name`` (lo crea si no existe)."""
+    code = normalize_site_key(site_name)
+    if not code:
+        return None
+    row = conn.execute("SELECT id FROM sites WHERE code=?", (code,)).fetchone()
+    if row:
+        return row[0]
+    conn.execute("INSERT INTO sites (code, name, created_at) VALUES (?, ?, ?) ON CONFLICT(code) DO NOTHING",
+                 (code, site_name.strip(), datetime.now().isoformat(timespec='seconds')))
+    return conn.execute("SELECT id FROM sites WHERE code=?", (code,)).fetchone()[0]
+
+
+def get_site(conn, code: str):
+    row = conn.execute("SELECT id, code, name, created_at FROM sites WHERE code=?", (normalize_site_key(code),)).fetchone()
+    return dict(row) if row else None
+
+
+def site_summary(conn, include_archive: bool = False, limit: int | None = None, site_id: int | None = None) -> list[dict]:
+    """Tickets por sitio (total y abiertos), agrupando sobre idx_tickets_site."""
+    source = tickets_source(conn, include_archive)
+    where = "site_id = ?" if site_id is not None else "site_id IS NOT NULL"
+    params = [site_id] if site_id is not None else []
+    sql = f"""
+        SELECT s.code, s.name, c.total, c.open_count
+        FROM (SELECT site_id, COUNT(*) AS total, SUM(CASE WHEN status='Abierto' THEN 1 ELSE 0 END) AS open_count
+              FROM {source} t WHERE {where} GROUP BY site_id) c
+        JOIN sites s ON s.id = c.site_id
+        ORDER BY c.open_count DESC, c.total DESC, s.code
+    """
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    return [{"code": r[0], "name": r[1], "total": r[2], "open": r[3]} for r in conn.execute(sql, params)]
+
+
+def link_ticket_sites(conn, batch_size: int = 500, include_archive: bool = True) -> int:
+    """Completa tickets.site_id (y el del archivo) agrupando las grafías por código normalizado.
+
+    Migración de bases anteriores al registro de sitios; si no hay tickets sin
+    sitio no hace nada. El nombre de un sitio nuevo es la grafía más usada.
+    """
+    tables = ["tickets"]
+    if include_archive and attach_archive(conn):
+        _ensure_archive_schema(conn)
+        conn.commit()
+        tables.append("archive.tickets")
+    linked = 0
+    for table in tables:
+        if not conn.execute(f"SELECT 1 FROM {table} WHERE site_id IS NULL LIMIT 1").fetchone():
+            continue
+        variants = {}
+        for name, n in conn.execute(f"SELECT site_name, COUNT(*) FROM {table} WHERE site_id IS NULL GROUP BY site_name"):
+            variants.setdefault(normalize_site_key(name), []).append((n, name))
+        now_iso = datetime.now().isoformat(timespec='seconds')
+        for code, names in variants.items():
+            if not code:
+                continue
+            names.sort(key=lambda x: (-x[0], x[1]))
+            conn.execute("INSERT INTO sites (code, name, created_at) VALUES (?, ?, ?) ON CONFLICT(code) DO NOTHING",
+                         (code, names[0][1], now_iso))
+        conn.commit()
+        site_ids = {r[0]: r[1] for r in conn.execute("SELECT code, id FROM sites")}
+        pending = [(site_ids[code], name) for code, names in variants.items() if code for _, name in names]
+        for i in range(0, len(pending), batch_size):
+            conn.executemany(f"UPDATE {table} SET site_id=? WHERE site_name=? AND site_id IS NULL",
+                             pending[i:i + batch_size])
+            conn.commit()
+        linked += sum(n for names in variants.values() for n, _ in names)
+    if linked:
+        logger.info(f"[SITES] {linked} tickets vinculados al registro de sitios")
+    return linked
+
+
+def insert_ticket(conn, site_name, modernization_type_id, request_date, priority, assignee_id, creator_email,
+                  pdf_filename) -> int:
+    """Inserta un ticket abierto y devuelve su id."""
+    now_iso = datetime.now().isoformat(timespec='seconds')
+    sql = """
+        INSERT INTO tickets (site_name, site_id, modernization_type_id, request_date, priority, assignee_id, creator_email, pdf_filename, status, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'Abierto', ?, ?)
+    """
+    params = (site_name, get_or_create_site(conn, site_name), modernization_type_id, request_date, priority,
+              assignee_id, creator_email, pdf_filename, now_iso, now_iso)
+    if conn.dialect == "postgresql":
+        # psycopg no tiene lastrowid
+        ticket_id = conn.execute(sql + " RETURNING id", params).fetchone()[0]
+    else:
+        ticket_id = conn.execute(sql, params).lastrowid
+    rollup_ticket_opened(conn, now_iso, assignee_id, modernization_type_id)
+    row = conn.execute("SELECT * FROM tickets WHERE id=?", (ticket_id,)).fetchone()
+    log_ticket_changes(conn, "insert", [(ticket_id, _ticket_change_data(row))], now_iso)
+    return ticket_id
+
+
+def mark_ticket_closed(conn, ticket_id: int, iga_case_number, iga_link, expected_version=None) -> bool:
+    """Cierra el ticket solo si sigue abierto (y en ``expected_version``, si se indica).
+
+    Devuelve False si otro request lo cerró o modificó antes: el llamador no
+    repite el trabajo posterior (la notificación).
+    """
+    now_iso = datetime.now().isoformat(timespec='seconds')
+    sql = ("UPDATE tickets SET status='Cerrado', iga_case_number=?, iga_link=?, updated_at=?, closed_at=?, "
+           "version=version+1 WHERE id=? AND status='Abierto'")
+    params = [iga_case_number, iga_link, now_iso, now_iso, ticket_id]
+    if expected_version is not None:
+        sql += " AND version=?"
+        params.append(expected_version)
+    if conn.execute(sql, params).rowcount != 1:
+        return False
+    row = conn.execute("SELECT created_at, assignee_id, modernization_type_id, version FROM tickets WHERE id=?",
+                       (ticket_id,)).fetchone()
+    rollup_ticket_closed(conn, row["created_at"], now_iso, row["assignee_id"], row["modernization_type_id"])
+    log_ticket_changes(conn, "close", [(ticket_id, {
+        "status": "Cerrado", "iga_case_number": iga_case_number, "iga_link": iga_link,
+        "closed_at": now_iso, "updated_at": now_iso, "version": row["version"]})], now_iso)
+    return True
+
+
+def claim_idempotency_key(conn, key: str) -> tuple[bool, int | None]:
+    """Reserva ``key`` para crear un ticket (commitea).
+
+    (True, None): la reservó este request. (False, id): ya creó el ticket ``id``.
+    (False, None): otro request con la misma clave está en curso. Una reserva
+    sin ticket de hace más de IDEMPOTENCY_WAIT*6 s se toma como abandonada.
+    """
+    now = datetime.now()
+    now_iso = now.isoformat(timespec='seconds')
+    conn.execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (now_iso,))
+    cur = conn.execute(
+        """
+        INSERT INTO idempotency_keys (key, ticket_id, created_at, expires_at) VALUES (?, NULL, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET created_at=excluded.created_at, expires_at=excluded.expires_at
+        WHERE idempotency_keys.ticket_id IS NULL AND idempotency_keys.created_at < ?
+        """,
+        (key, now_iso, (now + timedelta(seconds=IDEMPOTENCY_TTL)).isoformat(timespec='seconds'),
+         (now - timedelta(seconds=IDEMPOTENCY_WAIT * 6)).isoformat(timespec='seconds')),
+    )
+    claimed = cur.rowcount == 1
+    row = None if claimed else conn.execute("SELECT ticket_id FROM idempotency_keys WHERE key=?", (key,)).fetchone()
     conn.commit()
-    conn.close()
+    return claimed, (row[0] if row else None)
+
+
+def complete_idempotency_key(conn, key: str, ticket_id: int):
+    """Asocia la clave al ticket creado; va en la misma transacción que el INSERT."""
+    conn.execute("UPDATE idempotency_keys SET ticket_id=? WHERE key=?", (ticket_id, key))
+
+
+def release_idempotency_key(conn, key: str):
+    """Libera una reserva que no llegó a crear ticket (error al guardar), para poder reintentar."""
+    conn.execute("DELETE FROM idempotency_keys WHERE key=? AND ticket_id IS NULL", (key,))
+    conn.commit()
+
+
+def _id_chunks(ids: list[int], size: int = 500):
+    # Tope de parámetros por sentencia (SQLITE_MAX_VARIABLE_NUMBER en versiones viejas: 999)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def _lock_tickets(conn, ids: list, table: str = "tickets", column: str = "id") -> list:
+    """Filas completas con ``column`` en ``ids`` y el lock de escritura tomado; la transacción queda abierta.
+
+    En SQLite abre BEGIN IMMEDIATE (si no hay una en curso) para que nadie cambie las
+    filas entre esta lectura y los UPDATE/DELETE; en PostgreSQL, SELECT ... FOR UPDATE.
+    """
+    if conn.dialect == "sqlite" and not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    suffix = " FOR UPDATE" if conn.dialect == "postgresql" else ""
+    rows = []
+    for chunk in _id_chunks(ids):
+        marks = ",".join("?" * len(chunk))
+        rows.extend(conn.execute(f"SELECT * FROM {table} WHERE {column} IN ({marks}){suffix}", chunk).fetchall())
+    return rows
+
+
+def bulk_close_tickets(conn, ids: list[int], iga_case_number, iga_link) -> list[dict]:
+    """Cierra los tickets abiertos de ``ids`` con los mismos datos de IGA. No commitea.
+
+    Devuelve los tickets que cerró (los ya cerrados o inexistentes se saltean).
+    """
+    rows = [r for r in _lock_tickets(conn, ids) if r["status"] == "Abierto"]
+    now_iso = datetime.now().isoformat(timespec='seconds')
+    for chunk in _id_chunks([r["id"] for r in rows]):
+        marks = ",".join("?" * len(chunk))
+        conn.execute(
+            "UPDATE tickets SET status='Cerrado', iga_case_number=?, iga_link=?, updated_at=?, closed_at=?, "
+            f"version=version+1 WHERE id IN ({marks})",
+            [iga_case_number, iga_link, now_iso, now_iso, *chunk],
+        )
+    for r in rows:
+        rollup_ticket_closed(conn, r["created_at"], now_iso, r["assignee_id"], r["modernization_type_id"])
+    log_ticket_changes(conn, "close", [(r["id"], {
+        "status": "Cerrado", "iga_case_number": iga_case_number, "iga_link": iga_link,
+        "closed_at": now_iso, "updated_at": now_iso, "version": r["version"] + 1}) for r in rows], now_iso)
+    return [dict(r) for r in rows]
+
+
+def bulk_reassign_tickets(conn, ids: list[int], assignee_id: int) -> list[dict]:
+    """Pasa los tickets de ``ids`` a ``assignee_id`` (solo tabla caliente). No commitea.
+
+    Devuelve los tickets que cambiaron, con el responsable anterior.
+    """
+    rows = [r for r in _lock_tickets(conn, ids) if r["assignee_id"] != assignee_id]
+    now_iso = datetime.now().isoformat(timespec='seconds')
+    for chunk in _id_chunks([r["id"] for r in rows]):
+        marks = ",".join("?" * len(chunk))
+        conn.execute(f"UPDATE tickets SET assignee_id=?, updated_at=?, version=version+1 WHERE id IN ({marks})",
+                     [assignee_id, now_iso, *chunk])
+    # Los rollups se agrupan por responsable: se mueve cada ticket de grupo
+    for r in rows:
+        rollup_ticket_removed(conn, r, prune=False)
+        rollup_ticket_added(conn, dict(r, assignee_id=assignee_id))
+    rollup_prune(conn)
+    log_ticket_changes(conn, "update", [(r["id"], {
+        "assignee_id": assignee_id, "updated_at": now_iso, "version": r["version"] + 1}) for r in rows], now_iso)
+    return [dict(r) for r in rows]
+
+
+def bulk_delete_tickets(conn, ids: list[int]) -> list[dict]:
+    """Borra los tickets de ``ids`` (tabla caliente o archive.db) y su texto indexado. No commitea.
+
+    Los PDF no se tocan: el llamador los borra después del commit (delete_files_async).
+    """
+    archived = attach_archive(conn)
+    rows = [("tickets", r) for r in _lock_tickets(conn, ids)]
+    found = {r["id"] for _, r in rows}
+    rest = [i for i in ids if i not in found]
+    if archived and rest:
+        rows += [("archive.tickets", r) for r in _lock_tickets(conn, rest, "archive.tickets")]
+    for table in ("tickets", "archive.tickets"):
+        for chunk in _id_chunks([r["id"] for t, r in rows if t == table]):
+            conn.execute(f"DELETE FROM {table} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+    for _, r in rows:
+        rollup_ticket_removed(conn, r, prune=False)
+        if r["pdf_filename"]:
+            forget_pdf_text(conn, r["pdf_filename"])
+    rollup_prune(conn)
+    log_ticket_changes(conn, "delete", [(r["id"], None) for _, r in rows])
+    if any(t == "archive.tickets" for t, _ in rows):
+        bump_generation(conn)
+    return [dict(r) for _, r in rows]
+
+
+def build_mail_message(subject: str, recipients: list[str], body_html: str, cc_list: list[str] | None = None, attachments: list[str] | None = None) -> EmailMessage:
+    """Arma el mensaje MIME (HTML + adjuntos) que usa el fallback SMTP."""
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = MAIL_FROM
+    msg["To"] = ", ".join([r for r in recipients if r])
+    if cc_list:
+        msg["Cc"] = ", ".join([c for c in cc_list if c])
+    msg.set_content("Este mensaje requiere un cliente compatible con HTML.")
+    msg.add_alternative(body_html, subtype="html")
+
+    for path in attachments or []:
+        try:
+            if path and os.path.exists(path):
+                ctype, encoding = mimetypes.guess_type(str(path))
+                if ctype is None:
+                    ctype = "application/octet-stream"
+                maintype, subtype = ctype.split("/", 1)
+                with open(path, "rb") as f:
+                    msg.add_attachment(
+                        f.read(), maintype=maintype, subtype=subtype, filename=os.path.basename(path)
+                    )
+        except Exception as e:
+            logger.warning(f"[MAIL] No se pudo adjuntar {path}: {e}")
+    return msg
+
+
+def send_mail(subject: str, to: str | list[str], body_html: str, cc: str | list[str] | None = None, attachments: list[str] | None = None):
+    logger.info(f"[MAIL] preparing subject={subject} to={to} cc={cc} attachments={attachments}")
+    recipients = [to] if isinstance(to, str) else list(to)
+    cc_list = []
+    if cc:
+        cc_list = [cc] if isinstance(cc, str) else list(cc)
+    attachments = attachments or []
+
+    # Intento Outlook
+    if USE_OUTLOOK:
+        try:
+            # Inicializa COM en el hilo actual (cada request puede usar un hilo distinto)
+            if pythoncom:
+                try:
+                    pythoncom.CoInitialize()
+                except Exception:
+                    pass
+            import win32com.client as win32
+            outlook = win32.Dispatch("Outlook.Application")
+            mail = outlook.CreateItem(0)  # olMailItem
+            mail.To = "; ".join([r for r in recipients if r])
+            if cc_list:
+                mail.CC = "; ".join([c for c in cc_list if c])
+            mail.Subject = subject
+            mail.HTMLBody = body_html
+            for path in attachments:
+                try:
+                    if path and os.path.exists(path):
+                        mail.Attachments.Add(str(path))
+                except Exception as e:
+                    logger.warning(f"[MAIL] No se pudo adjuntar {path} a Outlook: {e}")
+            # Seleccionar cuenta si coincide con MAIL_FROM
+            try:
+                if MAIL_FROM:
+                    session_out = outlook.Session
+                    for account in session_out.Accounts:
+                        try:
+                            smtp = account.SmtpAddress
+                        except Exception:
+                            smtp = None
+                        if smtp and smtp.lower() == MAIL_FROM.lower():
+                            mail._oleobj_.Invoke(64209, 0, 8, 0, account)  # PR_SEND_USING_ACCOUNT
+                            break
+            except Exception as e2:
+                logger.warning(f"[MAIL] No se pudo seleccionar la cuenta {MAIL_FROM}: {e2}")
+            mail.Send()
+            logger.info("[MAIL] Sent via Outlook")
+            _note_mail_result("outlook")
+            return
+        except ImportError:
+            logger.warning("[MAIL] pywin32 no instalado; usando SMTP fallback.")
+        except Exception as e:
+            logger.warning(f"[MAIL] Error enviando por Outlook: {e}; usando SMTP fallback.")
+
+    # SMTP fallback
+    msg = build_mail_message(subject, recipients, body_html, cc_list, attachments)
+
+    # Si no hay SMTP configurado, omitimos fallback
+    if not SMTP_HOST:
+        logger.warning("[MAIL] SMTP no configurado (SMTP_HOST vacío); se omite fallback. Email NO enviado.")
+        _note_mail_result("none", "SMTP no configurado")
+        return
+    try:
+        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as s:
+            s.starttls()
+            if SMTP_USER:
+                s.login(SMTP_USER, SMTP_PASS)
+            s.send_message(msg)
+            logger.info("[MAIL] Sent via SMTP")
+            _note_mail_result("smtp")
+    except Exception as e:
+        logger.warning(f"[MAIL] Error enviando por SMTP: {e}")
+        _note_mail_result("smtp", str(e))
+
+
+# Último resultado de envío, para /readyz (no hace falta lock: se reemplaza el dict entero)
+mail_status = {"transport": None, "last_ok_at": None, "last_error": None, "last_error_at": None}
+
+
+def _note_mail_result(transport: str, error: str | None = None):
+    global mail_status
+    now_iso = datetime.now().isoformat(timespec='seconds')
+    if error:
+        mail_status = dict(mail_status, transport=transport, last_error=error[:300], last_error_at=now_iso)
+    else:
+        mail_status = dict(mail_status, transport=transport, last_ok_at=now_iso)
+
+
+class InflightWork:
+    """Trabajo en curso por tipo ("upload", "mail", "pdf") para /readyz y el apagado ordenado."""
+
+    def __init__(self):
+        self._counts = {}
+        self._cond = threading.Condition()
+
+    def add(self, kind: str):
+        with self._cond:
+            self._counts[kind] = self._counts.get(kind, 0) + 1
+
+    def done(self, kind: str):
+        with self._cond:
+            self._counts[kind] -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def track(self, kind: str):
+        self.add(kind)
+        try:
+            yield
+        finally:
+            self.done(kind)
+
+    def count(self, kind: str) -> int:
+        return self._counts.get(kind, 0)
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return dict(self._counts)
+
+    def wait_idle(self, timeout: float, kinds=None) -> bool:
+        """Espera a que no quede trabajo (de ``kinds``, o de cualquier tipo). False si venció el plazo."""
+        def idle():
+            return not any(n for k, n in self._counts.items() if kinds is None or k in kinds)
+        with self._cond:
+            return self._cond.wait_for(idle, timeout=max(timeout, 0))
+
+
+inflight = InflightWork()
+_draining = threading.Event()
+
+_mail_executor = ThreadPoolExecutor(max_workers=MAIL_WORKERS, thread_name_prefix="mail")
+_mail_jobs = {}  # future -> (asunto, destinatarios) de los envíos encolados
+_mail_jobs_lock = threading.Lock()
+
+
+def _send_mail_with_stored(subject, to, body_html, cc, stored_attachments):
+    """Envía adjuntando PDFs del storage (copia local temporal si el backend es remoto)."""
+    with ExitStack() as stack:
+        paths = []
+        for name in stored_attachments or []:
+            try:
+                paths.append(str(stack.enter_context(storage.local_copy(name))))
+            except Exception as e:
+                logger.warning(f"[MAIL] No se pudo obtener el adjunto {name}: {e}")
+        send_mail(subject, to=to, body_html=body_html, cc=cc, attachments=paths)
+
+
+def _send_mail_job(subject, to, body_html, cc, stored_attachments):
+    try:
+        run_blocking(_send_mail_with_stored, subject, to, body_html, cc, stored_attachments)
+    except Exception as e:
+        logger.warning(f"[MAIL] Error en envío en segundo plano subject={subject}: {e}")
+
+
+def send_mail_async(subject: str, to: str | list[str], body_html: str, cc: str | list[str] | None = None, stored_attachments: list[str] | None = None):
+    """Encola el envío en el pool de correo; con MAIL_ASYNC=0 envía en el request.
+
+    ``stored_attachments`` son nombres de adjuntos en el storage, no rutas.
+    """
+    if not MAIL_ASYNC:
+        return _send_mail_with_stored(subject, to, body_html, cc, stored_attachments)
+    try:
+        future = _mail_executor.submit(_send_mail_job, subject, to, body_html, cc, stored_attachments)
+    except RuntimeError:
+        # Pool cerrado (el worker está saliendo): se envía en el request para no perder el aviso
+        return _send_mail_with_stored(subject, to, body_html, cc, stored_attachments)
+    inflight.add("mail")
+    with _mail_jobs_lock:
+        _mail_jobs[future] = (subject, to)
+    future.add_done_callback(_mail_job_done)
+
+
+def _mail_job_done(future):
+    with _mail_jobs_lock:
+        _mail_jobs.pop(future, None)
+    inflight.done("mail")
+
+
+# Borrado de adjuntos fuera del request (acciones masivas). Si algo queda sin borrar
+# (error, apagado) es un huérfano más para el barrido del storage.
+_cleanup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cleanup")
+
+
+def _delete_files_job(names: list[str]):
+    try:
+        deleted = run_blocking(storage.delete_many, names)
+        logger.info(f"[CLEANUP] {len(deleted)}/{len(names)} adjuntos borrados")
+    except Exception as e:
+        logger.warning(f"[CLEANUP] Error borrando {len(names)} adjuntos: {e}")
+    finally:
+        inflight.done("cleanup")
+
+
+def delete_files_async(names: list[str]):
+    """Encola el borrado de adjuntos del storage; el request no espera los unlink/DELETE."""
+    if not names:
+        return
+    inflight.add("cleanup")
+    try:
+        _cleanup_executor.submit(_delete_files_job, list(names))
+    except RuntimeError:
+        # Pool cerrado (apagando): se borra en el request
+        _delete_files_job(list(names))
+
+
+def human_date(d: str) -> str:
+    try:
+        return datetime.strptime(d, "%Y-%m-%d").strftime("%d/%m/%Y")
+    except Exception:
+        return d
+
+
+# Proyecciones por vista: los listados traen solo las columnas que muestran, como
+# tuplas con nombre (sin dict por fila) y con las fechas ya formateadas por la base.
+TicketListRow = namedtuple(
+    "TicketListRow", "id site_name created_at modernization_type_name priority assignee_name status")
+TicketExportRow = namedtuple(
+    "TicketExportRow", "id site_name modernization_type request_date priority assignee assignee_email "
+                       "creator_email iga_case_number iga_link status created_at updated_at")
+
+TICKET_VIEWS = {
+    "list": (TicketListRow, "t.id, t.site_name, {created_at}, mt.name, t.priority, a.name, t.status"),
+    "export": (TicketExportRow, "t.id, t.site_name, mt.name, t.request_date, t.priority, a.name, a.email, "
+                                "t.creator_email, t.iga_case_number, t.iga_link, t.status, t.created_at, t.updated_at"),
+}
+FULL_TICKET_COLUMNS = "t.*, mt.name AS modernization_type_name, a.name AS assignee_name, a.email AS assignee_email"
+
+
+def ticket_view(conn, view: str):
+    """(tipo de fila, columnas) de una proyección, con el formato de fechas del dialecto de ``conn``."""
+    row_type, columns = TICKET_VIEWS[view]
+    return row_type, columns.format(created_at=sql_datetime("t.created_at", dialect=conn.dialect))
+
+
+def _tickets_query(conn, q=None, status=None, priority=None, assignee_id=None, source="tickets", limit=None,
+                   offset=0, columns=FULL_TICKET_COLUMNS, site=None):
+    """SQL y parámetros del listado filtrado, en el dialecto de ``conn``."""
+    sql = (
+        f"SELECT {columns} "
+        f"FROM {source} t "
+        "LEFT JOIN modernization_types mt ON mt.id = t.modernization_type_id "
+        "LEFT JOIN assignees a ON a.id = t.assignee_id "
+        "WHERE 1=1 "
+    )
+    params = []
+    if q:
+        if q.isdigit():
+            sql += "AND t.id = ? "
+            params.append(int(q))
+        else:
+            # ILIKE: en PostgreSQL LIKE distingue mayúsculas (en SQLite no)
+            sql += "AND t.site_name ILIKE ? " if conn.dialect == "postgresql" else "AND t.site_name LIKE ? "
+            params.append(f"%{q}%")
+    if status:
+        sql += "AND t.status = ? "
+        params.append(status)
+    if priority:
+        sql += "AND t.priority = ? "
+        params.append(priority)
+    if assignee_id:
+        sql += "AND t.assignee_id = ? "
+        params.append(int(assignee_id))
+    if site:
+        # Por código de sitio: usa idx_tickets_site en vez de comparar nombres
+        sql += "AND t.site_id = (SELECT id FROM sites WHERE code = ?) "
+        params.append(normalize_site_key(site))
+    sql += "ORDER BY t.id DESC"
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params.extend([int(limit), int(offset)])
+    return sql, params
+
+
+def query_tickets(conn, q=None, status=None, priority=None, assignee_id=None, include_archive=False, limit=None, offset=0,
+                  view=None, site=None):
+    """Tickets filtrados. Sin ``view`` devuelve dicts con todas las columnas;
+    con ``view`` ("list", "export") devuelve tuplas con nombre de esa proyección."""
+    source = tickets_source(conn, include_archive)
+    if view is None:
+        sql, params = _tickets_query(conn, q, status, priority, assignee_id, source=source, limit=limit, offset=offset,
+                                     site=site)
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        return [dict(r) for r in cur.fetchall()]
+    row_type, columns = ticket_view(conn, view)
+    sql, params = _tickets_query(conn, q, status, priority, assignee_id, source=source, limit=limit, offset=offset,
+                                 columns=columns, site=site)
+    cur = conn.cursor()
+    cur.row_factory = None
+    cur.execute(sql, params)
+    return list(map(row_type._make, cur.fetchall()))
+
+
+# ------------------------------
+# Caché de resultados (búsqueda, inicio, detalle)
+# ------------------------------
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "50"))
+# Primer nivel, en memoria de cada proceso
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "30"))
+# Segundo nivel, compartido entre los workers de gunicorn: un archivo SQLite local en WAL
+SHARED_CACHE_ENABLED = os.getenv("SHARED_CACHE_ENABLED", "1").lower() in ("1", "true", "yes", "y", "on")
+SHARED_CACHE_PATH = Path(os.getenv("SHARED_CACHE_PATH", BASE_DIR / "cache.db"))
+SHARED_CACHE_MAX_ENTRIES = int(os.getenv("SHARED_CACHE_MAX_ENTRIES", "5000"))
+SHARED_CACHE_TTL = float(os.getenv("SHARED_CACHE_TTL", "120"))
+SHARED_CACHE_MAX_VALUE = 1024 * 1024  # valores más grandes quedan solo en el primer nivel
+
+
+class LRUCache:
+    """LRU acotada con TTL, segura entre hilos. La clave incluye la generación de
+    tickets, así que una escritura deja obsoletas todas las entradas de inmediato."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedCache:
+    """Caché de dos niveles: LRUCache por proceso delante de un archivo SQLite compartido.
+
+    Las claves van con espacio de nombres y generación (``namespace:generación:hash``):
+    una escritura incrementa la generación y las entradas anteriores dejan de leerse;
+    el TTL y el desalojo LRU (por ``accessed_at``) las borran después. Cualquier error
+    del archivo cuenta como fallo de caché: nunca rompe el request.
+
+    Los valores se guardan como JSON (no pickle: leer el archivo no ejecuta código) y el
+    archivo es 0600 del usuario del portal: el HTML cacheado se sirve como Markup.
+    """
+
+    TOUCH_INTERVAL = 5.0  # segundos: accessed_at no se reescribe en cada acierto
+    EVICT_EVERY = 64  # escrituras entre barridos de vencidos/excedentes
+
+    def __init__(self, path: Path | None, max_entries: int, ttl: float, local: LRUCache):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local = local
+        self._tls = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.stats = {}  # namespace -> {"local": aciertos L1, "shared": aciertos L2, "miss": fallos}
+
+    def _key(self, namespace: str, generation, key) -> str:
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return f"{namespace}:{generation}:{digest}"
+
+    def _conn(self):
+        if self.path is None:
+            return None
+        conn = getattr(self._tls, "conn", None)
+        # Conexión por hilo y por proceso (un fork hereda la del padre: no se reutiliza)
+        if conn is not None and self._tls.pid == os.getpid():
+            return conn
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if not self._owned_by_us(self.path):
+                logger.warning(f"[CACHE] {self.path} pertenece a otro usuario: caché compartida desactivada")
+                self.path = None
+                return None
+            conn = sqlite3.connect(self.path, timeout=0.2, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                         "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_accessed ON cache_entries(accessed_at)")
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"[CACHE] No se pudo abrir {self.path}: {e}")
+            return None
+        self._tls.conn = conn
+        self._tls.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _owned_by_us(path: Path) -> bool:
+        """Crea el archivo 0600 (los -wal/-shm heredan el modo) y verifica que sea del usuario del proceso."""
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_RDONLY, 0o600)
+        except PermissionError:
+            return False
+        try:
+            return not hasattr(os, "getuid") or os.fstat(fd).st_uid == os.getuid()
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _dumps(value) -> bytes:
+        # Lo cacheado es HTML ya renderizado (Markup/str) o tuplas de dicts y primitivos
+        if isinstance(value, Markup):
+            doc = {"markup": str(value)}
+        elif isinstance(value, tuple):
+            doc = {"tuple": list(value)}
+        else:
+            doc = {"value": value}
+        return json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    @staticmethod
+    def _loads(blob: bytes):
+        doc = json.loads(blob)
+        if "markup" in doc:
+            return Markup(doc["markup"])
+        if "tuple" in doc:
+            return tuple(doc["tuple"])
+        return doc["value"]
+
+    def _count(self, namespace: str, kind: str):
+        with self._lock:
+            self.stats.setdefault(namespace, {"local": 0, "shared": 0, "miss": 0})[kind] += 1
+
+    def get(self, namespace: str, generation, key):
+        k = self._key(namespace, generation, key)
+        value = self.local.get(k)
+        if value is not None:
+            self._count(namespace, "local")
+            return value
+        conn = self._conn()
+        if conn is not None:
+            now = time.time()
+            try:
+                row = conn.execute("SELECT value, expires_at, accessed_at FROM cache_entries WHERE key=?",
+                                   (k,)).fetchone()
+                if row is not None and row[1] > now:
+                    value = self._loads(row[0])
+                    if now - row[2] > self.TOUCH_INTERVAL:
+                        conn.execute("UPDATE cache_entries SET accessed_at=? WHERE key=?", (now, k))
+            except (sqlite3.Error, ValueError, KeyError, TypeError):
+                # Incluye entradas de un formato anterior: cuentan como fallo y se reescriben
+                value = None
+            if value is not None:
+                self.local.set(k, value)
+                self._count(namespace, "shared")
+                return value
+        self._count(namespace, "miss")
+        return None
+
+    def set(self, namespace: str, generation, key, value):
+        k = self._key(namespace, generation, key)
+        self.local.set(k, value)
+        conn = self._conn()
+        if conn is None:
+            return
+        try:
+            blob = self._dumps(value)
+            if len(blob) > SHARED_CACHE_MAX_VALUE:
+                return
+            now = time.time()
+            conn.execute("INSERT INTO cache_entries (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT(key) DO UPDATE SET value=excluded.value, expires_at=excluded.expires_at, "
+                         "accessed_at=excluded.accessed_at", (k, blob, now + self.ttl, now))
+            with self._lock:
+                self._writes += 1
+                evict = self._writes % self.EVICT_EVERY == 0
+            if evict:
+                self.evict(conn)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.debug(f"[CACHE] No se guardó {namespace}: {e}")
+
+    def evict(self, conn=None):
+        """Borra vencidos y, si sobran, los menos usados hasta SHARED_CACHE_MAX_ENTRIES."""
+        conn = conn or self._conn()
+        if conn is None:
+            return
+        conn.execute("DELETE FROM cache_entries WHERE expires_at < ?", (time.time(),))
+        excess = conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0] - self.max_entries
+        if excess > 0:
+            conn.execute("DELETE FROM cache_entries WHERE key IN "
+                         "(SELECT key FROM cache_entries ORDER BY accessed_at LIMIT ?)", (excess,))
+
+    def get_or_set(self, namespace: str, generation, key, compute):
+        value = self.get(namespace, generation, key)
+        if value is None:
+            value = compute()
+            self.set(namespace, generation, key, value)
+        return value
+
+    def clear(self):
+        self.local.clear()
+        conn = self._conn()
+        if conn is not None:
+            try:
+                conn.execute("DELETE FROM cache_entries")
+            except sqlite3.Error:
+                pass
+
+    def hit_rates(self) -> dict:
+        """Por namespace: pedidos y proporción de aciertos en cada nivel."""
+        with self._lock:
+            out = {}
+            for ns, c in self.stats.items():
+                total = c["local"] + c["shared"] + c["miss"]
+                out[ns] = {"requests": total, "local": c["local"] / total, "shared": c["shared"] / total,
+                           "hit": (c["local"] + c["shared"]) / total}
+            return out
+
+
+result_cache = SharedCache(SHARED_CACHE_PATH if SHARED_CACHE_ENABLED else None, SHARED_CACHE_MAX_ENTRIES,
+                           SHARED_CACHE_TTL, LRUCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL))
+
+
+# ------------------------------
+# Autocompletado de sitios (índice de prefijos en memoria)
+# ------------------------------
+SITE_SUGGEST_LIMIT = 10
+# Cada cuánto (s) se mira si hay tickets nuevos de otros workers; la reconstrucción
+# completa (para olvidar sitios de tickets borrados) es cada SITE_INDEX_REBUILD segundos.
+SITE_INDEX_CHECK_INTERVAL = float(os.getenv("SITE_INDEX_CHECK_INTERVAL", "2"))
+SITE_INDEX_REBUILD = float(os.getenv("SITE_INDEX_REBUILD", "600"))
+
+
+def normalize_site_key(text: str) -> str:
+    """Clave de comparación: sin acentos, en mayúsculas y con espacios/guiones/puntos como "_"."""
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[\s\-_.]+", "_", text.strip().upper()).strip("_")
+
+
+class SiteIndex:
+    """Nombres de sitio ordenados por clave normalizada; las búsquedas son un bisect.
+
+    Se indexa también cada sufijo que empieza en una palabra, así "medrano"
+    encuentra AMBA_UTN_MEDRANO. Se arma desde el registro ``sites`` (un nombre
+    por código) al primer uso en cada worker y se completa con los sitios
+    nuevos (id > último visto).
+    """
+
+    def __init__(self):
+        self._keys = []      # claves ordenadas
+        self._names = []     # nombre original, paralelo a _keys
+        self._known = set()  # códigos normalizados
+        self._max_id = None
+        self._checked_at = 0.0
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+
+    def _entries(self, name: str):
+        key = normalize_site_key(name)
+        if not key:
+            return
+        parts = key.split("_")
+        for i in range(len(parts)):
+            yield "_".join(parts[i:]), name
+
+    def _build(self, names, max_id):
+        entries = sorted(e for n in set(names) for e in self._entries(n))
+        self._keys = [k for k, _ in entries]
+        self._names = [n for _, n in entries]
+        self._known = {normalize_site_key(n) for n in names}
+        self._max_id = max_id
+        self._built_at = self._checked_at = time.monotonic()
+
+    def add(self, name: str):
+        """Agrega un sitio recién cargado (alta de ticket en este worker)."""
+        with self._lock:
+            code = normalize_site_key(name)
+            if self._max_id is None or code in self._known:
+                return
+            self._known.add(code)
+            for key, n in self._entries(name):
+                i = bisect.bisect_left(self._keys, key)
+                self._keys.insert(i, key)
+                self._names.insert(i, n)
+
+    def _refresh(self, conn):
+        now = time.monotonic()
+        if self._max_id is not None and now - self._checked_at < SITE_INDEX_CHECK_INTERVAL:
+            return
+        if self._max_id is None or now - self._built_at > SITE_INDEX_REBUILD:
+            max_id = conn.execute("SELECT MAX(id) FROM sites").fetchone()[0] or 0
+            names = [r[0] for r in conn.execute("SELECT name FROM sites")]
+            with self._lock:
+                self._build(names, max_id)
+            return
+        self._checked_at = now
+        new = conn.execute("SELECT id, name FROM sites WHERE id > ? ORDER BY id", (self._max_id,)).fetchall()
+        for row in new:
+            self.add(row[1])
+        if new:
+            self._max_id = new[-1][0]
+
+    def suggest(self, prefix: str, limit: int = SITE_SUGGEST_LIMIT, conn=None) -> list[str]:
+        if conn is not None:
+            self._refresh(conn)
+        key = normalize_site_key(prefix)
+        if not key:
+            return []
+        with self._lock:
+            i = bisect.bisect_left(self._keys, key)
+            found = []
+            seen = set()
+            # Tope de lectura: varias claves pueden apuntar al mismo nombre
+            while i < len(self._keys) and self._keys[i].startswith(key) and len(found) < limit * 4:
+                name = self._names[i]
+                if name not in seen:
+                    seen.add(name)
+                    found.append(name)
+                i += 1
+        # Primero los que empiezan con el prefijo, después los que lo tienen en otra palabra
+        found.sort(key=lambda n: (not normalize_site_key(n).startswith(key), n))
+        return found[:limit]
+
+    def __len__(self):
+        return len(self._known)
+
+
+site_index = SiteIndex()
+
+
+# ------------------------------
+# Índice de texto de los PDF adjuntos
+# ------------------------------
+def _pdf_state(conn, filename: str, status: str, stat=None, pages=None, error=None):
+    conn.execute(
+        """
+        INSERT INTO pdf_extraction (pdf_filename, status, size, mtime_ns, pages, error, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(pdf_filename) DO UPDATE SET status=excluded.status, size=excluded.size,
+            mtime_ns=excluded.mtime_ns, pages=excluded.pages, error=excluded.error, updated_at=excluded.updated_at
+        """,
+        (filename, status, stat.size if stat else None, stat.mtime_ns if stat else None, pages, error,
+         datetime.now().isoformat(timespec='seconds')),
+    )
+
+
+def forget_pdf_text(conn, filename: str):
+    conn.execute("DELETE FROM pdf_text WHERE pdf_filename=?", (filename,))
+    conn.execute("DELETE FROM pdf_extraction WHERE pdf_filename=?", (filename,))
+
+
+class PdfIndexer:
+    """Extrae el texto de los PDF en un pool de procesos (fuera del request) y lo guarda en pdf_text.
+
+    El estado por archivo queda en pdf_extraction: ``flask index-pdfs`` retoma lo
+    pendiente o con error y saltea lo ya indexado (mismo tamaño y mtime).
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._pool = None
+        self._stager = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def available() -> bool:
+        import importlib.util
+        return importlib.util.find_spec("pypdf") is not None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn: los hijos importan solo pdf_text, y no heredan hilos del worker web
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def _get_stager(self):
+        with self._lock:
+            if self._stager is None:
+                self._stager = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pdf-stage")
+            return self._stager
+
+    def submit(self, filename: str, stat: StoredObject | None = None):
+        """Encola el PDF; no toca el storage en el hilo que llama (en S3, HEAD y descarga van en el fondo)."""
+        inflight.add("pdf")
+        # Se completa recién cuando el resultado quedó guardado en la base
+        stored = Future()
+        try:
+            staged = self._get_stager().submit(self._stage, filename, stat, stored)
+        except Exception:
+            inflight.done("pdf")
+            raise
+        staged.add_done_callback(lambda f: self._staged(filename, f, stored))
+        return stored
+
+    def _staged(self, filename: str, staged: Future, stored: Future):
+        # Apagado antes de preparar el archivo: queda para la próxima corrida de ``flask index-pdfs``
+        if staged.cancelled():
+            self._finish(filename, stored)
+
+    def _stage(self, filename: str, stat: StoredObject | None, stored: Future):
+        local = None
+        try:
+            stat = stat or storage.stat(filename)
+            conn = db_connect()
+            try:
+                _pdf_state(conn, filename, "pending", stat)
+                conn.commit()
+            finally:
+                conn.close()
+            local = storage.local_copy(filename)
+            future = self._get_pool().submit(pdf_text.extract_text, str(local.path), PDF_TEXT_MAX_CHARS)
+        except Exception as e:
+            try:
+                if local is not None:
+                    local.close()
+                logger.warning(f"[PDF] No se pudo preparar {filename} para indexar: {e}")
+                self._record_error(filename, stat, e)
+            finally:
+                self._finish(filename, stored)
+            return
+        future.add_done_callback(lambda f: self._done(filename, stat, f, stored, local))
+
+    @staticmethod
+    def _record_error(filename: str, stat, error: Exception, conn=None):
+        """Deja el archivo en "error". Si la base tampoco responde queda como estaba
+        (pending o sin fila) y lo retoma ``flask index-pdfs``; nunca lanza."""
+        own = conn is None
+        try:
+            if own:
+                conn = db_connect()
+            # En PostgreSQL la sentencia fallida abortó la transacción: sin rollback no se graba nada
+            conn.rollback()
+            _pdf_state(conn, filename, "error", stat, error=str(error)[:500])
+            conn.commit()
+        except Exception as e:
+            logger.error(f"[PDF] No se pudo registrar el error de {filename}: {e}")
+        finally:
+            if own and conn is not None:
+                conn.close()
+
+    @staticmethod
+    def _finish(filename: str, stored: Future):
+        inflight.done("pdf")
+        stored.set_result(filename)
+
+    @property
+    def pending(self) -> int:
+        return inflight.count("pdf")
+
+    def shutdown(self):
+        """Cierra el pool sin esperar; lo que quede en "pending" lo retoma ``flask index-pdfs``."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+            stager, self._stager = self._stager, None
+        for executor in (stager, pool):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def _done(self, filename: str, stat, future, stored: Future, local: LocalCopy):
+        # _finish siempre: si no, el contador "pdf" no baja (el drenaje espera hasta su plazo)
+        # y ``stored`` no se resuelve (``flask index-pdfs`` espera para siempre)
+        try:
+            local.close()
+            if future.cancelled():
+                # Apagado del worker: el archivo queda "pending" para la próxima corrida
+                return
+            conn = None
+            try:
+                text, pages = future.result()
+                conn = db_connect()
+                conn.execute("DELETE FROM pdf_text WHERE pdf_filename=?", (filename,))
+                conn.execute("INSERT INTO pdf_text (pdf_filename, content) VALUES (?, ?)", (filename, text))
+                _pdf_state(conn, filename, "done", stat, pages=pages)
+                bump_generation(conn)  # invalida búsquedas "en documento" cacheadas
+                conn.commit()
+            except Exception as e:
+                logger.warning(f"[PDF] No se pudo extraer texto de {filename}: {e}")
+                self._record_error(filename, stat, e, conn)
+            finally:
+                if conn is not None:
+                    conn.close()
+        finally:
+            self._finish(filename, stored)
+
+
+pdf_indexer = PdfIndexer(PDF_INDEX_WORKERS)
+
+
+def index_pdf_async(filename: str):
+    """Encola un PDF recién subido para indexar; nunca falla el request."""
+    if not PDF_INDEX_ENABLED or not PdfIndexer.available():
+        return
+    try:
+        pdf_indexer.submit(filename)
+    except Exception as e:
+        logger.warning(f"[PDF] No se pudo encolar {filename} para indexar: {e}")
+
+
+def index_pdf_backlog(retry_errors: bool = False, limit: int | None = None) -> dict:
+    """Indexa los PDF del storage que falten. Reanudable: el estado se commitea por archivo."""
+    conn = db_connect()
+    known = {r["pdf_filename"]: r for r in conn.execute("SELECT pdf_filename, status, size, mtime_ns FROM pdf_extraction")}
+    conn.close()
+    stats = {"submitted": 0, "skipped": 0}
+    in_flight = set()
+    max_in_flight = max(1, pdf_indexer.workers * 2)
+    for obj in storage.iter_objects():
+        if not allowed_file(obj.name):
+            continue
+        prev = known.get(obj.name)
+        if prev and prev["size"] == obj.size and prev["mtime_ns"] == obj.mtime_ns and (
+                prev["status"] == "done" or (prev["status"] == "error" and not retry_errors)):
+            stats["skipped"] += 1
+            continue
+        if limit is not None and stats["submitted"] >= limit:
+            break
+        in_flight.add(pdf_indexer.submit(obj.name, obj))
+        stats["submitted"] += 1
+        if len(in_flight) >= max_in_flight:
+            _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+    wait(in_flight)
+    return stats
+
+
+@app.cli.command("index-pdfs")
+@click.option("--retry-errors", is_flag=True, help="Reintenta los PDF que fallaron antes.")
+@click.option("--limit", type=int, default=None, help="Máximo de PDF a procesar en esta corrida.")
+def index_pdfs_command(retry_errors, limit):
+    """Extrae e indexa el texto de los PDF ya guardados (reanudable)."""
+    if not PdfIndexer.available():
+        raise click.ClickException("Falta pypdf: pip install pypdf")
+    stats = index_pdf_backlog(retry_errors=retry_errors, limit=limit)
+    click.echo(f"{stats['submitted']} PDF procesados, {stats['skipped']} ya indexados.")
+
+
+def _fts_query(q: str) -> str:
+    """Términos del usuario como frases FTS5 entre comillas (AND implícito, sin sintaxis especial)."""
+    terms = re.findall(r"\w+", q)
+    return " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+TicketDocRow = namedtuple("TicketDocRow", TicketListRow._fields + ("snippet",))
+
+
+def _highlight(snippet: str) -> Markup:
+    return Markup(str(escape(snippet or "")).replace("\x02", "<mark>").replace("\x03", "</mark>"))
+
+
+def search_documents(conn, q, status=None, priority=None, assignee_id=None, include_archive=False, limit=None, offset=0):
+    """Tickets cuyo PDF contiene ``q``, ordenados por relevancia, con fragmento resaltado."""
+    match = _fts_query(q or "")
+    if not match:
+        return []
+    source = tickets_source(conn, include_archive)
+    if conn.dialect == "postgresql":
+        # tsvector + GIN; ts_headline marca con los mismos separadores que snippet() de FTS5
+        sql = (
+            f"SELECT {ticket_view(conn, 'list')[1]}, ts_headline('simple', pdf_text.content, query, "
+            "'StartSel=' || chr(2) || ', StopSel=' || chr(3) || ', MaxWords=16, MinWords=6') "
+            "FROM pdf_text "
+            "CROSS JOIN plainto_tsquery('simple', ?) AS query "
+            f"JOIN {source} t ON t.pdf_filename = pdf_text.pdf_filename "
+            "LEFT JOIN modernization_types mt ON mt.id = t.modernization_type_id "
+            "LEFT JOIN assignees a ON a.id = t.assignee_id "
+            "WHERE pdf_text.tsv @@ query "
+        )
+        params = [" ".join(re.findall(r"\w+", q))]
+        order = "ORDER BY ts_rank(pdf_text.tsv, query) DESC"
+    else:
+        sql = (
+            f"SELECT {ticket_view(conn, 'list')[1]}, snippet(pdf_text, 1, char(2), char(3), '…', 16) "
+            "FROM pdf_text "
+            f"JOIN {source} t ON t.pdf_filename = pdf_text.pdf_filename "
+            "LEFT JOIN modernization_types mt ON mt.id = t.modernization_type_id "
+            "LEFT JOIN assignees a ON a.id = t.assignee_id "
+            "WHERE pdf_text MATCH ? "
+        )
+        params = [match]
+        order = "ORDER BY pdf_text.rank"
+    if status:
+        sql += "AND t.status = ? "
+        params.append(status)
+    if priority:
+        sql += "AND t.priority = ? "
+        params.append(priority)
+    if assignee_id:
+        sql += "AND t.assignee_id = ? "
+        params.append(int(assignee_id))
+    sql += order
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params.extend([int(limit), int(offset)])
+    cur = conn.cursor()
+    cur.row_factory = None
+    cur.execute(sql, params)
+    return [TicketDocRow(*r[:-1], _highlight(r[-1])) for r in cur.fetchall()]
+
+
+# ------------------------------
+# Archivo de tickets cerrados (archive.db)
+# ------------------------------
+def _is_attached(conn, name: str = "archive") -> bool:
+    return any(row[1] == name for row in conn.execute("PRAGMA database_list"))
+
+
+def attach_archive(conn, readonly: bool = False, create: bool = False) -> bool:
+    """Adjunta archive.db como esquema ``archive``. Devuelve False si no existe (y no se pide crearla).
+
+    archive.db es propio de SQLite: con PostgreSQL no hay archivo y se consulta solo ``tickets``.
+    """
+    if conn.dialect != "sqlite":
+        return False
+    if _is_attached(conn):
+        return True
+    if not create and not ARCHIVE_DB_PATH.exists():
+        return False
+    if readonly:
+        conn.execute("ATTACH DATABASE ? AS archive", (f"{ARCHIVE_DB_PATH.resolve().as_uri()}?mode=ro",))
+    else:
+        conn.execute("ATTACH DATABASE ? AS archive", (str(ARCHIVE_DB_PATH),))
+    return True
+
+
+def _table_columns(conn, schema: str, table: str = "tickets") -> list[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _ensure_archive_schema(conn):
+    """Crea/actualiza archive.tickets con las mismas columnas que main.tickets (sin FKs)."""
+    info = list(conn.execute("PRAGMA main.table_info(tickets)"))
+    existing = set(_table_columns(conn, "archive"))
+    if not existing:
+        cols = []
+        for _, name, ctype, notnull, default, pk in info:
+            col = f"{name} {ctype}"
+            if pk:
+                col += " PRIMARY KEY"
+            elif notnull:
+                col += " NOT NULL"
+            if default is not None:
+                col += f" DEFAULT {default}"
+            cols.append(col)
+        conn.execute(f"CREATE TABLE archive.tickets ({', '.join(cols)})")
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_tickets_updated ON tickets(updated_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_tickets_site ON tickets(site_id, status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_tickets_pdf ON tickets(pdf_filename)")
+        return
+    for _, name, ctype, notnull, default, pk in info:
+        if name not in existing:
+            col = f"{name} {ctype}"
+            if default is not None:
+                col += f" DEFAULT {default}"
+            conn.execute(f"ALTER TABLE archive.tickets ADD COLUMN {col}")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_tickets_site ON tickets(site_id, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_tickets_pdf ON tickets(pdf_filename)")
+
+
+def tickets_source(conn, include_archive: bool = False) -> str:
+    """Origen de filas para las consultas: solo la tabla caliente o la unión con el archivo.
+
+    Un ticket puede quedar un instante en ambas tablas si el job se corta entre
+    copiar y borrar; la unión prioriza la copia de main.
+    """
+    if not include_archive or not attach_archive(conn, readonly=_is_readonly(conn)):
+        return "tickets"
+    main_cols = _table_columns(conn, "main")
+    archive_cols = set(_table_columns(conn, "archive"))
+    cols = ", ".join(c for c in main_cols if c in archive_cols)
+    return (
+        f"(SELECT {cols} FROM main.tickets UNION ALL "
+        f"SELECT {cols} FROM archive.tickets WHERE id NOT IN (SELECT id FROM main.tickets))"
+    )
+
+
+def _is_readonly(conn) -> bool:
+    return conn.readonly
+
+
+def fetch_ticket(conn, ticket_id: int):
+    """Ticket con nombres de tipo/responsable; busca en archive.db si ya no está en la tabla caliente.
+
+    Devuelve (fila, archivado) o (None, False).
+    """
+    sql = """
+        SELECT t.*, mt.name as modernization_type_name, a.name as assignee_name, a.email as assignee_email,
+               s.code as site_code
+        FROM {source} t
+        LEFT JOIN modernization_types mt ON mt.id = t.modernization_type_id
+        LEFT JOIN assignees a ON a.id = t.assignee_id
+        LEFT JOIN sites s ON s.id = t.site_id
+        WHERE t.id=?
+    """
+    cur = conn.cursor()
+    cur.execute(sql.format(source="tickets"), (ticket_id,))
+    row = cur.fetchone()
+    if row:
+        return row, False
+    if attach_archive(conn, readonly=_is_readonly(conn)):
+        cur.execute(sql.format(source="archive.tickets"), (ticket_id,))
+        row = cur.fetchone()
+        if row:
+            return row, True
+    return None, False
+
+
+_archive_count_cache = {"key": None, "counts": (0, 0)}
+
+
+def archived_counts(conn) -> tuple[int, int]:
+    """(cerrados, total) en archive.db, cacheado por mtime/tamaño del archivo (solo cambia al archivar/borrar)."""
+    if conn.dialect != "sqlite":
+        return 0, 0
+    try:
+        st = ARCHIVE_DB_PATH.stat()
+    except FileNotFoundError:
+        return 0, 0
+    key = (st.st_mtime_ns, st.st_size)
+    if _archive_count_cache["key"] != key:
+        if not attach_archive(conn, readonly=_is_readonly(conn)):
+            return 0, 0
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*), SUM(status='Cerrado') FROM archive.tickets")
+        total, closed = cur.fetchone()
+        _archive_count_cache.update(key=key, counts=(closed or 0, total or 0))
+    return _archive_count_cache["counts"]
+
+
+def archive_closed_tickets(older_than_days: int = ARCHIVE_AFTER_DAYS, batch_size: int = 500) -> int:
+    """Mueve a archive.db los tickets cerrados sin cambios hace más de ``older_than_days`` días.
+
+    Por lote: copia a archive (INSERT OR REPLACE, idempotente) y commitea, después
+    borra de main y commitea. Si se corta en el medio, la próxima corrida lo completa.
+    El borrado vuelve a exigir cerrado y sin cambios: un ticket modificado entre las
+    dos transacciones (sincronización con IGA, reasignación) queda en main y se
+    descarta su copia vieja en archive; lo archiva de nuevo una corrida posterior.
+    """
+    if DB_ENGINE != "sqlite":
+        raise RuntimeError("archive.db solo aplica con DB_ENGINE=sqlite")
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).isoformat(timespec='seconds')
+    conn = db_connect()
+    attach_archive(conn, create=True)
+    _ensure_archive_schema(conn)
+    conn.commit()
+    cols = ", ".join(_table_columns(conn, "main"))
+    moved = 0
+    cur = conn.cursor()
+    try:
+        while True:
+            cur.execute(
+                "SELECT id FROM main.tickets WHERE status='Cerrado' AND updated_at < ? ORDER BY id LIMIT ?",
+                (cutoff, batch_size),
+            )
+            ids = [r[0] for r in cur.fetchall()]
+            if not ids:
+                break
+            marks = ",".join("?" * len(ids))
+            cur.execute(f"INSERT OR REPLACE INTO archive.tickets ({cols}) SELECT {cols} FROM main.tickets WHERE id IN ({marks})", ids)
+            conn.commit()
+            # Lock de escritura antes de releer: entre esta lectura y el DELETE nadie cambia las filas
+            if not conn.in_transaction:
+                cur.execute("BEGIN IMMEDIATE")
+            still = f"id IN ({marks}) AND status='Cerrado' AND updated_at < ?"
+            deleted = [r[0] for r in cur.execute(f"SELECT id FROM main.tickets WHERE {still}", [*ids, cutoff])]
+            cur.execute(f"DELETE FROM main.tickets WHERE {still}", [*ids, cutoff])
+            # Los que cambiaron después de la copia siguen vivos en main: fuera la copia vieja
+            changed = sorted(set(ids) - set(deleted))
+            if changed:
+                cur.execute(f"DELETE FROM archive.tickets WHERE id IN ({','.join('?' * len(changed))})", changed)
+            log_ticket_changes(conn, "archive", [(i, None) for i in deleted])
+            conn.commit()
+            moved += len(deleted)
+    finally:
+        conn.close()
+    logger.info(f"[ARCHIVE] {moved} tickets cerrados antes de {cutoff} movidos a {ARCHIVE_DB_PATH.name}")
+    return moved
+
+
+@app.cli.command("archive-tickets")
+@click.option("--days", default=ARCHIVE_AFTER_DAYS, show_default=True, help="Antigüedad mínima (días desde el último cambio).")
+@click.option("--batch-size", default=500, show_default=True)
+def archive_tickets_command(days, batch_size):
+    """Mueve tickets cerrados antiguos a archive.db."""
+    try:
+        moved = archive_closed_tickets(days, batch_size)
+    except RuntimeError as exc:
+        raise click.ClickException(str(exc))
+    click.echo(f"{moved} tickets archivados en {ARCHIVE_DB_PATH}")
+
+# ------------------------------
+# Registro de cambios de tickets (feed incremental)
+# ------------------------------
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", "500"))
+CHANGES_MAX_PAGE = int(os.getenv("CHANGES_MAX_PAGE", "5000"))
+CHANGE_OPS = ("snapshot", "insert", "update", "close", "delete", "archive")
+
+
+def _ticket_change_data(row) -> dict:
+    """Fila completa del ticket (sin el id) para las entradas ``insert``/``snapshot``."""
+    return {k: row[k] for k in row.keys() if k != "id"}
+
+
+def log_ticket_changes(conn, op: str, changes: list[tuple[int, dict | None]], changed_at: str | None = None):
+    """Agrega cambios a ticket_changes en la transacción en curso. No commitea.
+
+    ``changes`` son pares (ticket_id, datos): la fila completa en ``insert``, solo las
+    columnas que cambiaron en ``update``/``close`` y None en ``delete``/``archive``.
+    """
+    if not changes:
+        return
+    if conn.dialect == "postgresql":
+        # seq sale de una secuencia: sin serializar hasta el commit, una transacción con un
+        # seq menor podría commitear después de que un consumidor ya avanzó su cursor
+        conn.execute("SELECT pg_advisory_xact_lock(hashtext('ticket_changes'))")
+    changed_at = changed_at or datetime.now().isoformat(timespec='seconds')
+    conn.executemany(
+        "INSERT INTO ticket_changes (ticket_id, op, changed_at, data) VALUES (?, ?, ?, ?)",
+        [(ticket_id, op, changed_at, json.dumps(data, ensure_ascii=False) if data is not None else None)
+         for ticket_id, data in changes],
+    )
+
+
+def backfill_ticket_changes(batch_size: int = 5000):
+    """Primera vez con el registro (base existente): una entrada ``snapshot`` por ticket (incluido archive.db).
+
+    Así un consumidor que arranca con since=0 reconstruye todo desde el feed. Toma el lock
+    de escritura como backfill_rollups; si el registro ya tiene filas no hace nada.
+    """
+    conn = db_connect()
+    try:
+        # Chequeo sin lock primero: cada worker pasa por acá al arrancar
+        if conn.execute("SELECT 1 FROM ticket_changes LIMIT 1").fetchone():
+            return None
+        if conn.dialect == "sqlite":
+            conn.rollback()
+            if attach_archive(conn):
+                _ensure_archive_schema(conn)
+                conn.commit()
+            conn.execute("BEGIN IMMEDIATE")
+        else:
+            conn.execute("LOCK TABLE tickets IN SHARE MODE")
+        if conn.execute("SELECT 1 FROM ticket_changes LIMIT 1").fetchone():
+            conn.rollback()
+            return None
+        source = tickets_source(conn, include_archive=True)
+        cur = conn.server_cursor()
+        cur.execute(f"SELECT * FROM {source} t ORDER BY id")
+        now_iso = datetime.now().isoformat(timespec='seconds')
+        total = 0
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            log_ticket_changes(conn, "snapshot", [(r["id"], _ticket_change_data(r)) for r in rows], now_iso)
+            total += len(rows)
+        cur.close()
+        conn.commit()
+    finally:
+        conn.close()
+    if total:
+        logger.info(f"[CHANGES] Registro de cambios iniciado con {total} tickets existentes")
+    return total
+
+
+def read_ticket_changes(conn, since: int, limit: int) -> dict:
+    """Página del feed: cambios con seq > ``since`` en orden; ``next`` es el cursor para el siguiente pedido."""
+    rows = conn.execute(
+        "SELECT seq, ticket_id, op, changed_at, data FROM ticket_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+        (since, limit + 1),
+    ).fetchall()
+    page = rows[:limit]
+    head = conn.execute("SELECT MAX(seq) FROM ticket_changes").fetchone()[0] or 0
+    return {
+        "changes": [
+            {"seq": r["seq"], "ticket_id": r["ticket_id"], "op": r["op"], "changed_at": r["changed_at"],
+             "data": json.loads(r["data"]) if r["data"] else None}
+            for r in page
+        ],
+        "next": page[-1]["seq"] if page else since,
+        "has_more": len(rows) > limit,
+        "head": head,
+    }
+
+
+@app.route("/api/changes")
+@login_required
+def api_changes():
+    """Cambios de tickets desde ``since`` (seq), paginados: seguir pidiendo con since=next mientras has_more.
+
+    Si ``since`` es mayor que ``head`` la base se restauró de un respaldo: el consumidor
+    debe volver a sincronizar desde 0.
+    """
+    since = max(request.args.get("since", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", CHANGES_PAGE_SIZE, type=int), 1), CHANGES_MAX_PAGE)
+    conn = db_connect()
+    try:
+        data = read_ticket_changes(conn, since, limit)
+    finally:
+        conn.close()
+    resp = jsonify(data)
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+# ------------------------------
+# Migración SQLite → PostgreSQL
+# ------------------------------
+# (tabla, clave por la que se recorre el origen en orden). "archive.tickets" (archive.db) va
+# a la misma tabla tickets de destino: en PostgreSQL no hay base de archivo aparte
+MIGRATION_TABLES = (
+    ("modernization_types", "id"),
+    ("assignees", "id"),
+    ("sites", "id"),
+    ("tickets", "id"),
+    ("archive.tickets", "id"),
+    ("pdf_extraction", "pdf_filename"),
+    ("pdf_text", "rowid"),
+    ("ticket_changes", "seq"),
+)
+
+
+def _migration_orphans(src) -> list[str]:
+    """Referencias colgadas en SQLite (sin FKs activas) que PostgreSQL rechazaría."""
+    problems = []
+    checks = (
+        ("assignee_id", "assignees"),
+        ("modernization_type_id", "modernization_types"),
+        ("site_id", "sites"),
+    )
+    sources = ["main.tickets"] + (["archive.tickets"] if _is_attached(src) else [])
+    for source in sources:
+        cols = _table_columns(src, *source.split("."))
+        for col, table in checks:
+            if col not in cols:
+                continue
+            ids = [r[0] for r in src.execute(
+                f"SELECT DISTINCT {col} FROM {source} WHERE {col} IS NOT NULL "
+                f"AND {col} NOT IN (SELECT id FROM main.{table})")]
+            if ids:
+                problems.append(f"{source}.{col} sin fila en {table}: {', '.join(map(str, ids[:20]))}")
+    return problems
+
+
+def migrate_sqlite_to_postgres(source_path, target_url: str, batch_size: int = 5000, progress=None,
+                               archive_path=ARCHIVE_DB_PATH) -> dict:
+    """Copia una tickets.db (y su archive.db, si existe) a PostgreSQL en lotes reanudables.
+    Devuelve filas leídas por tabla de origen.
+
+    Cada lote se inserta y, en la misma transacción, se guarda la última clave
+    copiada en ``portal_migration``: si se corta, la próxima corrida sigue desde
+    ahí sin duplicar. Los tickets archivados van a ``tickets``; si un id está en
+    las dos bases gana el de main. Al final ajusta las secuencias al máximo id copiado.
+    """
+    import psycopg
+
+    src = sqlite3.connect(f"{Path(source_path).resolve().as_uri()}?mode=ro", uri=True)
+    if archive_path and Path(archive_path).exists():
+        src.execute("ATTACH DATABASE ? AS archive", (f"{Path(archive_path).resolve().as_uri()}?mode=ro",))
+    dst = PgConnection(psycopg.connect(target_url))
+    copied = {}
+    try:
+        problems = _migration_orphans(src)
+        if problems:
+            raise RuntimeError("Corregir antes de migrar: " + "; ".join(problems))
+        create_schema(dst)
+        dst.execute(
+            """
+            CREATE TABLE IF NOT EXISTS portal_migration (
+                table_name TEXT PRIMARY KEY,
+                last_key TEXT,
+                rows_copied BIGINT NOT NULL DEFAULT 0
+            )
+            """
+        )
+        dst.commit()
+        for table, key in MIGRATION_TABLES:
+            schema, _, dst_table = table.rpartition(".")
+            if schema and not _is_attached(src, schema):
+                continue  # sin archive.db
+            src_cols = _table_columns(src, schema or "main", dst_table)
+            if not src_cols:
+                continue  # base vieja sin esa tabla
+            dst_cols = {r[0] for r in dst.execute(
+                "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = ?",
+                (dst_table,))}
+            cols = [c for c in src_cols if c in dst_cols]
+            numeric_key = key in ("id", "rowid", "seq")
+            state = dst.execute("SELECT last_key, rows_copied FROM portal_migration WHERE table_name=?", (table,)).fetchone()
+            if state is None and not schema:
+                if dst.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                    raise RuntimeError(f"La tabla {table} de destino ya tiene datos; migrar sobre una base vacía")
+                last, count = None, 0
+            elif state is None:
+                last, count = None, 0
+            else:
+                last = int(state[0]) if numeric_key and state[0] is not None else state[0]
+                count = state[1]
+            insert = (f"INSERT INTO {dst_table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+                      "ON CONFLICT DO NOTHING")
+            while True:
+                where = f"WHERE {key} > ? " if last is not None else ""
+                rows = src.execute(
+                    f"SELECT {key}, {', '.join(cols)} FROM {table} {where}ORDER BY {key} LIMIT ?",
+                    ((last,) if last is not None else ()) + (batch_size,),
+                ).fetchall()
+                if not rows:
+                    break
+                dst.executemany(insert, [r[1:] for r in rows])
+                last = rows[-1][0]
+                count += len(rows)
+                dst.execute(
+                    """
+                    INSERT INTO portal_migration (table_name, last_key, rows_copied) VALUES (?, ?, ?)
+                    ON CONFLICT (table_name) DO UPDATE SET last_key=excluded.last_key, rows_copied=excluded.rows_copied
+                    """,
+                    (table, str(last), count),
+                )
+                dst.commit()
+                if progress:
+                    progress(table, count)
+            copied[table] = count
+        for table, column in (("modernization_types", "id"), ("assignees", "id"), ("sites", "id"), ("tickets", "id"),
+                              ("ticket_changes", "seq")):
+            dst.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), COALESCE(MAX({column}), 1), "
+                f"MAX({column}) IS NOT NULL) FROM {table}"
+            )
+        dst.commit()
+    finally:
+        src.close()
+        dst.close()
+    logger.info(f"[MIGRATE] {Path(source_path).name} -> PostgreSQL: {copied}")
+    return copied
+
+
+@app.cli.command("migrate-to-postgres")
+@click.option("--source", default=str(DB_PATH), show_default=True, type=click.Path(exists=True, dir_okay=False),
+              help="Base SQLite de origen.")
+@click.option("--target", default=lambda: DATABASE_URL, help="URL de PostgreSQL (por defecto DATABASE_URL).")
+@click.option("--archive", default=str(ARCHIVE_DB_PATH), show_default=True, type=click.Path(dir_okay=False),
+              help="archive.db de origen (se omite si no existe); sus tickets van a la tabla tickets.")
+@click.option("--batch-size", default=5000, show_default=True)
+def migrate_to_postgres_command(source, target, archive, batch_size):
+    """Copia tickets.db y archive.db a PostgreSQL (reanudable: volver a correr sigue donde quedó)."""
+    if not target:
+        raise click.ClickException("Indicar --target o DATABASE_URL")
+    try:
+        import psycopg  # noqa: F401
+    except ImportError:
+        raise click.ClickException("Falta psycopg: pip install 'psycopg[binary]' psycopg_pool")
+    try:
+        copied = migrate_sqlite_to_postgres(source, target, batch_size,
+                                            progress=lambda table, n: click.echo(f"  {table}: {n} filas"),
+                                            archive_path=archive)
+    except RuntimeError as exc:
+        raise click.ClickException(str(exc))
+    for table, n in copied.items():
+        click.echo(f"{table}: {n} filas copiadas")
+
+# ------------------------------
+# Respaldos: bases (API de backup de SQLite) y adjuntos incrementales
+# ------------------------------
+# BACKUP_DIR/db/<fecha>/tickets.db (+ archive.db): una instantánea por corrida, se guardan BACKUP_KEEP.
+# BACKUP_DIR/uploads/: espejo de los adjuntos; manifest.json registra tamaño, mtime y sha256 de
+# cada uno, así la próxima corrida copia solo los nuevos o modificados.
+BACKUP_RETRY_SECONDS = 900  # si falla un respaldo programado, se reintenta en 15 minutos
+BACKUP_MAX_RESTARTS = 3  # reinicios de la copia por pasos antes de pasar a una sola pasada
+
+
+class _BackupRestarting(Exception):
+    pass
+
+
+def backup_sqlite_file(src_path: Path, dest_path: Path, pages: int = BACKUP_PAGES_PER_STEP,
+                       pause: float = BACKUP_STEP_PAUSE) -> int:
+    """Copia online con la API de backup de SQLite, de a ``pages`` páginas; devuelve los pasos.
+
+    Entre paso y paso se suelta el lock de lectura, así que new_ticket()/close_ticket()
+    siguen escribiendo; si la base cambia, SQLite retoma la copia y el resultado es
+    igual un instante consistente. La copia se verifica con quick_check antes de renombrarla.
+    """
+    tmp = dest_path.with_name(f".{dest_path.name}.part")
+    tmp.unlink(missing_ok=True)
+    steps = 0
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal steps, restarts, last_remaining
+        steps += 1
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > BACKUP_MAX_RESTARTS:
+                raise _BackupRestarting()
+        last_remaining = remaining
+        if remaining and pause:
+            time.sleep(pause)
+
+    src = sqlite3.connect(src_path, timeout=DB_BUSY_TIMEOUT)
+    dst = sqlite3.connect(tmp)
+    try:
+        try:
+            src.backup(dst, pages=pages, progress=progress)
+        except _BackupRestarting:
+            # Muchas escrituras: cada una reinicia la copia por pasos. En WAL una sola
+            # pasada lee un instante fijo sin frenar a los writers.
+            logger.info(f"[BACKUP] {src_path.name}: {restarts} reinicios por escrituras, se copia en una pasada")
+            src.backup(dst)
+            steps += 1
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    if check != "ok":
+        tmp.unlink(missing_ok=True)
+        raise RuntimeError(f"La copia de {src_path.name} no pasó quick_check: {check}")
+    os.replace(tmp, dest_path)
+    return steps
+
+
+def _load_backup_manifest() -> dict:
+    try:
+        return json.loads((BACKUP_DIR / "manifest.json").read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return {"files": {}}
+
+
+def _save_backup_manifest(manifest: dict):
+    tmp = BACKUP_DIR / ".manifest.json.part"
+    tmp.write_text(json.dumps(manifest, indent=1, sort_keys=True), encoding="utf-8")
+    os.replace(tmp, BACKUP_DIR / "manifest.json")
+
+
+def sync_uploads_backup(manifest: dict) -> dict:
+    """Copia a BACKUP_DIR/uploads los adjuntos nuevos o cambiados (tamaño o mtime distintos).
+
+    Lo borrado del storage no se borra del respaldo: se informa en ``missing_in_source``.
+    """
+    dest = BACKUP_DIR / "uploads"
+    dest.mkdir(parents=True, exist_ok=True)
+    files = manifest.setdefault("files", {})
+    stats = {"copied": 0, "unchanged": 0, "bytes": 0}
+    seen = set()
+    for obj in storage.iter_objects():
+        seen.add(obj.name)
+        prev = files.get(obj.name)
+        if prev and prev["size"] == obj.size and prev["mtime_ns"] == obj.mtime_ns and (dest / obj.name).exists():
+            stats["unchanged"] += 1
+            continue
+        digest = hashlib.sha256()
+        tmp = dest / f".{obj.name}.part"
+        size = 0
+        with open(tmp, "wb") as out:
+            for chunk in storage.get(obj.name):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        os.replace(tmp, dest / obj.name)
+        files[obj.name] = {"size": size, "mtime_ns": obj.mtime_ns, "sha256": digest.hexdigest()}
+        stats["copied"] += 1
+        stats["bytes"] += size
+    stats["missing_in_source"] = len(files.keys() - seen)
+    return stats
+
+
+def _backup_snapshots() -> list[Path]:
+    root = BACKUP_DIR / "db"
+    return sorted(p for p in root.iterdir() if p.is_dir() and not p.name.startswith(".")) if root.exists() else []
+
+
+def run_backup(include_uploads: bool = True) -> dict:
+    """Instantánea de tickets.db/archive.db y sincronización de adjuntos. Devuelve un resumen."""
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    result = {"snapshot": None}
+    t0 = time.perf_counter()
+    if DB_ENGINE == "sqlite":
+        # Microsegundos + pid: dos respaldos en el mismo segundo (CLI y programado) no chocan;
+        # el nombre sigue ordenando cronológicamente junto a los viejos (YYYYmmdd_HHMMSS)
+        name = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}"
+        work = BACKUP_DIR / "db" / f".{name}"
+        work.mkdir(parents=True)
+        try:
+            steps = backup_sqlite_file(Path(DB_PATH), work / "tickets.db")
+            if ARCHIVE_DB_PATH.exists():
+                steps += backup_sqlite_file(ARCHIVE_DB_PATH, work / "archive.db")
+            os.replace(work, BACKUP_DIR / "db" / name)
+        except BaseException:
+            shutil.rmtree(work, ignore_errors=True)
+            raise
+        result.update(snapshot=name, steps=steps)
+        for old in (_backup_snapshots()[:-BACKUP_KEEP] if BACKUP_KEEP else []):
+            shutil.rmtree(old, ignore_errors=True)
+    else:
+        logger.info("[BACKUP] Con PostgreSQL la base se respalda con pg_dump; solo se copian adjuntos")
+    if include_uploads:
+        manifest = _load_backup_manifest()
+        result["uploads"] = sync_uploads_backup(manifest)
+        manifest["updated_at"] = datetime.now().isoformat(timespec='seconds')
+        _save_backup_manifest(manifest)
+    result["seconds"] = round(time.perf_counter() - t0, 2)
+    logger.info(f"[BACKUP] {result}")
+    return result
+
+
+def claim_periodic_run(conn, key: str, interval_seconds: float) -> bool:
+    """Toma el turno de una tarea programada si pasó el intervalo (un solo worker/proceso lo gana).
+
+    ``key`` es la fila de portal_meta con el epoch del último turno tomado.
+    """
+    now = int(time.time())
+    conn.execute("INSERT INTO portal_meta(key, value) VALUES (?, 0) ON CONFLICT(key) DO NOTHING", (key,))
+    cur = conn.execute("UPDATE portal_meta SET value=? WHERE key=? AND value <= ?",
+                       (now, key, now - int(interval_seconds)))
+    conn.commit()
+    return cur.rowcount == 1
+
+
+def run_backup_if_due(interval_seconds: float | None = None) -> dict | None:
+    interval_seconds = interval_seconds if interval_seconds is not None else BACKUP_INTERVAL_HOURS * 3600
+    conn = db_connect()
+    try:
+        if not claim_periodic_run(conn, "backup_claimed_at", interval_seconds):
+            return None
+    finally:
+        conn.close()
+    try:
+        return run_backup()
+    except Exception:
+        # Se adelanta el próximo turno para reintentar antes que el intervalo completo
+        conn = db_connect()
+        conn.execute("UPDATE portal_meta SET value=? WHERE key='backup_claimed_at'",
+                     (int(time.time() - interval_seconds + BACKUP_RETRY_SECONDS),))
+        conn.commit()
+        conn.close()
+        raise
+
+
+def start_backup_scheduler(check_every: float = 60):
+    """Hilo que revisa cada ``check_every`` s si toca respaldar (lo llama gunicorn.conf.py)."""
+    if BACKUP_INTERVAL_HOURS <= 0:
+        return None
+
+    def loop():
+        while not _draining.wait(check_every):
+            try:
+                run_backup_if_due()
+            except Exception as e:
+                logger.error(f"[BACKUP] Falló el respaldo programado: {e}")
+
+    thread = threading.Thread(target=loop, name="backup-scheduler", daemon=True)
+    thread.start()
+    return thread
+
+
+def _digest_chunks(chunks) -> tuple[int, str]:
+    """(tamaño, sha256) de un contenido que llega en bloques."""
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        size += len(chunk)
+    return size, digest.hexdigest()
+
+
+def verify_backup(db_path: Path, archive_path: Path | None, read_file) -> dict:
+    """Chequea integridad de la base y que cada PDF referenciado exista con el contenido esperado.
+
+    ``read_file(nombre)`` itera el adjunto en el destino por bloques (None si falta); se compara
+    tamaño y sha256 contra el manifiesto: un PDF del mismo tamaño pero distinto no pasa.
+    """
+    manifest_files = _load_backup_manifest().get("files", {})
+    conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        integrity = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        sources = ["main.tickets"]
+        if archive_path and Path(archive_path).exists():
+            conn.execute("ATTACH DATABASE ? AS archive", (f"{Path(archive_path).resolve().as_uri()}?mode=ro",))
+            sources.append("archive.tickets")
+        tickets = sum(conn.execute(f"SELECT COUNT(*) FROM {src}").fetchone()[0] for src in sources)
+        referenced = set()
+        for src in sources:
+            referenced.update(r[0] for r in conn.execute(f"SELECT pdf_filename FROM {src} WHERE pdf_filename IS NOT NULL"))
+    finally:
+        conn.close()
+    missing, mismatched = [], []
+    for name in sorted(referenced):
+        chunks = read_file(name)
+        if chunks is None:
+            missing.append(name)
+            continue
+        expected = manifest_files.get(name)
+        if expected is None:
+            continue  # subido después del último respaldo de adjuntos: no hay contra qué comparar
+        if _digest_chunks(chunks) != (expected["size"], expected["sha256"]):
+            mismatched.append(name)
+    return {
+        "ok": integrity == "ok" and not missing and not mismatched,
+        "integrity": integrity,
+        "tickets": tickets,
+        "pdfs": len(referenced),
+        "missing": missing,
+        "content_mismatch": mismatched,
+        "unreferenced": len(manifest_files.keys() - referenced),
+    }
+
+
+def _backup_snapshot_dir(snapshot: str) -> Path:
+    snapshots = _backup_snapshots()
+    if not snapshots:
+        raise RuntimeError(f"No hay respaldos en {BACKUP_DIR / 'db'}")
+    if snapshot == "latest":
+        return snapshots[-1]
+    path = BACKUP_DIR / "db" / secure_filename(snapshot)
+    if path not in snapshots:
+        raise RuntimeError(f"No existe el respaldo {snapshot}")
+    return path
+
+
+def _backup_file_chunks(name: str):
+    path = BACKUP_DIR / "uploads" / name
+    if not path.exists():
+        return None
+
+    def chunks():
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(STORAGE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    return chunks()
+
+
+def _restore_sqlite_file(src_path: Path, dest_path: Path):
+    # Por la API de backup sobre la conexión destino: respeta su WAL (copiar el archivo encima no)
+    src = sqlite3.connect(f"{src_path.resolve().as_uri()}?mode=ro", uri=True)
+    dst = sqlite3.connect(dest_path, timeout=DB_BUSY_TIMEOUT)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def restore_backup(snapshot: str = "latest") -> dict:
+    """Restaura tickets.db/archive.db desde una instantánea y repone los PDF que falten o difieran.
+
+    Pensado con la app detenida. Un PDF se repone si falta o si su sha256 no es el del
+    manifiesto (el tamaño solo descarta rápido los distintos). Al final verifica la base
+    restaurada contra el storage.
+    """
+    if DB_ENGINE != "sqlite":
+        raise RuntimeError("La restauración de la base solo aplica con DB_ENGINE=sqlite (usar pg_restore)")
+    src = _backup_snapshot_dir(snapshot)
+    _restore_sqlite_file(src / "tickets.db", Path(DB_PATH))
+    if (src / "archive.db").exists():
+        _restore_sqlite_file(src / "archive.db", ARCHIVE_DB_PATH)
+    restored = 0
+    for name, meta in _load_backup_manifest().get("files", {}).items():
+        copy = BACKUP_DIR / "uploads" / name
+        if not copy.exists():
+            continue
+        current = storage.stat(name)
+        if current is None or current.size != meta["size"] or \
+                _digest_chunks(storage.get(name)) != (meta["size"], meta["sha256"]):
+            with open(copy, "rb") as f:
+                storage.put(name, f, content_type="application/pdf")
+            restored += 1
+
+    def stored_chunks(name):
+        return storage.get(name) if storage.exists(name) else None
+
+    report = verify_backup(Path(DB_PATH), ARCHIVE_DB_PATH, stored_chunks)
+    report.update(snapshot=src.name, restored_files=restored)
+    return report
+
+
+@app.cli.command("backup")
+@click.option("--no-uploads", is_flag=True, help="Solo las bases, sin sincronizar adjuntos.")
+@click.option("--if-due", is_flag=True, help="Solo si pasó BACKUP_INTERVAL_HOURS desde el último (para cron).")
+def backup_command(no_uploads, if_due):
+    """Respalda tickets.db/archive.db sin frenar escrituras y copia los adjuntos nuevos."""
+    try:
+        if if_due:
+            result = run_backup_if_due(max(BACKUP_INTERVAL_HOURS, 1) * 3600)
+            if result is None:
+                click.echo("Todavía no corresponde un respaldo.")
+                return
+        else:
+            result = run_backup(include_uploads=not no_uploads)
+    except (RuntimeError, OSError, sqlite3.Error) as exc:
+        raise click.ClickException(str(exc))
+    up = result.get("uploads")
+    click.echo(f"Respaldo {result['snapshot'] or '(sin base)'} en {BACKUP_DIR} ({result['seconds']}s)"
+               + (f"; adjuntos: {up['copied']} copiados, {up['unchanged']} sin cambios" if up else ""))
+
+
+def _echo_verify(report: dict):
+    click.echo(f"Integridad: {report['integrity']} · {report['tickets']} tickets · {report['pdfs']} PDF referenciados")
+    for name in report["missing"][:20]:
+        click.echo(f"  falta: {name}")
+    for name in report["content_mismatch"][:20]:
+        click.echo(f"  contenido distinto (tamaño o sha256): {name}")
+    if report["unreferenced"]:
+        click.echo(f"  {report['unreferenced']} PDF del respaldo sin ticket (borrados o huérfanos)")
+
+
+@app.cli.command("backup-verify")
+@click.option("--snapshot", default="latest", show_default=True)
+def backup_verify_command(snapshot):
+    """Verifica una instantánea: integridad y PDF de cada ticket presentes en el respaldo."""
+    try:
+        src = _backup_snapshot_dir(snapshot)
+    except RuntimeError as exc:
+        raise click.ClickException(str(exc))
+    report = verify_backup(src / "tickets.db", src / "archive.db", _backup_file_chunks)
+    _echo_verify(report)
+    if not report["ok"]:
+        raise click.ClickException(f"El respaldo {src.name} no es consistente")
+
+
+@app.cli.command("backup-restore")
+@click.option("--snapshot", default="latest", show_default=True)
+@click.option("--yes", is_flag=True, help="Confirma que se reemplazan DB_PATH y ARCHIVE_DB_PATH.")
+def backup_restore_command(snapshot, yes):
+    """Restaura una instantánea (con la app detenida) y verifica tickets contra PDF."""
+    if not yes:
+        raise click.ClickException(f"Reemplaza {DB_PATH} y {ARCHIVE_DB_PATH}: repetir con --yes")
+    try:
+        report = restore_backup(snapshot)
+    except (RuntimeError, OSError, sqlite3.Error) as exc:
+        raise click.ClickException(str(exc))
+    click.echo(f"Restaurado {report['snapshot']}; {report['restored_files']} PDF repuestos")
+    _echo_verify(report)
+    if not report["ok"]:
+        raise click.ClickException("La restauración terminó con inconsistencias")
+
+
+# ------------------------------
+# Reportes: rollups incrementales
+# ------------------------------
+# Límites superiores (horas) de los buckets del histograma de tiempo hasta el cierre;
+# el último bucket (índice len) es "más de 180 días".
+CLOSE_HOURS_BUCKETS = (1, 2, 4, 8, 12, 24, 36, 48, 72, 96, 120, 168, 240, 336, 504, 720, 1080, 1440, 2160, 4320)
+
+
+def _week_of(iso_ts: str) -> str:
+    d = date.fromisoformat(iso_ts[:10])
+    return (d - timedelta(days=d.weekday())).isoformat()
+
+
+def _close_bucket(created_at: str, closed_at: str) -> int:
+    hours = (datetime.fromisoformat(closed_at) - datetime.fromisoformat(created_at)).total_seconds() / 3600
+    return bisect.bisect_right(CLOSE_HOURS_BUCKETS, max(hours, 0))
+
+
+def _rollup_add(conn, week, assignee_id, type_id, opened=0, closed=0):
+    conn.execute(
+        """
+        INSERT INTO rollup_weekly (week, assignee_id, modernization_type_id, opened, closed) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(week, assignee_id, modernization_type_id)
+        DO UPDATE SET opened = rollup_weekly.opened + excluded.opened, closed = rollup_weekly.closed + excluded.closed
+        """,
+        (week, assignee_id or 0, type_id or 0, opened, closed),
+    )
+
+
+def _hist_add(conn, week, assignee_id, type_id, bucket, n=1):
+    conn.execute(
+        """
+        INSERT INTO rollup_close_hist (week, assignee_id, modernization_type_id, bucket, count) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(week, assignee_id, modernization_type_id, bucket)
+        DO UPDATE SET count = rollup_close_hist.count + excluded.count
+        """,
+        (week, assignee_id or 0, type_id or 0, bucket, n),
+    )
+
+
+def rollup_ticket_opened(conn, created_at, assignee_id, type_id, n=1):
+    _rollup_add(conn, _week_of(created_at), assignee_id, type_id, opened=n)
+
+
+def rollup_ticket_closed(conn, created_at, closed_at, assignee_id, type_id, n=1):
+    week = _week_of(closed_at)
+    _rollup_add(conn, week, assignee_id, type_id, closed=n)
+    _hist_add(conn, week, assignee_id, type_id, _close_bucket(created_at, closed_at), n)
+
+
+def rollup_ticket_removed(conn, ticket, prune: bool = True):
+    """Descuenta de los rollups un ticket que se borra (fila completa de tickets).
+
+    Con ``prune=False`` (operaciones masivas) el llamador limpia las filas en cero al final.
+    """
+    _rollup_ticket(conn, ticket, -1)
+    if prune:
+        rollup_prune(conn)
+
+
+def rollup_ticket_added(conn, ticket):
+    """Suma a los rollups un ticket completo (alta y, si está cerrado, cierre); p. ej. tras reasignarlo."""
+    _rollup_ticket(conn, ticket, 1)
+
+
+def _rollup_ticket(conn, ticket, n):
+    rollup_ticket_opened(conn, ticket["created_at"], ticket["assignee_id"], ticket["modernization_type_id"], n=n)
+    if ticket["status"] == "Cerrado":
+        closed_at = _ticket_closed_at(ticket)
+        rollup_ticket_closed(conn, ticket["created_at"], closed_at, ticket["assignee_id"],
+                             ticket["modernization_type_id"], n=n)
+
+
+def rollup_prune(conn):
+    conn.execute("DELETE FROM rollup_weekly WHERE opened=0 AND closed=0")
+    conn.execute("DELETE FROM rollup_close_hist WHERE count=0")
+
+
+def _ticket_closed_at(ticket) -> str:
+    # Tickets cerrados antes de existir closed_at: el cierre era la última modificación
+    try:
+        closed_at = ticket["closed_at"]
+    except (IndexError, KeyError):
+        closed_at = None
+    return closed_at or ticket["updated_at"]
+
+
+def backfill_rollups(force: bool = True, batch_size: int = 5000):
+    """Reconstruye rollup_weekly/rollup_close_hist desde tickets (+ archive.db). Devuelve tickets leídos.
+
+    Toma el lock de escritura durante el recálculo (las altas/cierres esperan, como
+    mucho DB_BUSY_TIMEOUT) para que ningún incremento se pierda entre la lectura y
+    el reemplazo. Con ``force=False`` no hace nada si ya se corrió alguna vez.
+    """
+    conn = db_connect()
+    try:
+        if conn.dialect == "sqlite":
+            # ATTACH y el ALTER del archivo van antes de abrir la transacción
+            if attach_archive(conn):
+                _ensure_archive_schema(conn)
+                conn.commit()
+            conn.execute("BEGIN IMMEDIATE")
+        else:
+            conn.execute("LOCK TABLE tickets IN SHARE MODE")
+        if not force and conn.execute("SELECT 1 FROM portal_meta WHERE key='rollups_built_at'").fetchone():
+            conn.rollback()
+            return None
+        weekly = {}
+        hist = {}
+        source = tickets_source(conn, include_archive=True)
+        cur = conn.server_cursor()
+        cur.row_factory = None
+        cur.execute(f"SELECT created_at, closed_at, updated_at, status, assignee_id, "
+                    f"COALESCE(modernization_type_id, 0) FROM {source} t")
+        total = 0
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for created_at, closed_at, updated_at, status, assignee_id, type_id in rows:
+                key = (_week_of(created_at), assignee_id, type_id)
+                weekly.setdefault(key, [0, 0])[0] += 1
+                if status == "Cerrado":
+                    closed_at = closed_at or updated_at
+                    week = _week_of(closed_at)
+                    weekly.setdefault((week, assignee_id, type_id), [0, 0])[1] += 1
+                    hkey = (week, assignee_id, type_id, _close_bucket(created_at, closed_at))
+                    hist[hkey] = hist.get(hkey, 0) + 1
+            total += len(rows)
+        cur.close()
+        conn.execute("DELETE FROM rollup_weekly")
+        conn.execute("DELETE FROM rollup_close_hist")
+        conn.executemany("INSERT INTO rollup_weekly (week, assignee_id, modernization_type_id, opened, closed) "
+                         "VALUES (?, ?, ?, ?, ?)", [k + tuple(v) for k, v in weekly.items()])
+        conn.executemany("INSERT INTO rollup_close_hist (week, assignee_id, modernization_type_id, bucket, count) "
+                         "VALUES (?, ?, ?, ?, ?)", [k + (v,) for k, v in hist.items()])
+        conn.execute("INSERT INTO portal_meta(key, value) VALUES ('rollups_built_at', ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value=excluded.value", (int(time.time()),))
+        conn.commit()
+    finally:
+        conn.close()
+    logger.info(f"[ROLLUPS] Recalculados desde {total} tickets")
+    return total
+
+
+@app.cli.command("rollups-backfill")
+def rollups_backfill_command():
+    """Recalcula los rollups de /reports desde todos los tickets (incluido archive.db)."""
+    t0 = time.perf_counter()
+    total = backfill_rollups(force=True)
+    click.echo(f"Rollups recalculados desde {total} tickets en {time.perf_counter() - t0:.1f}s")
+
+
+def _hist_percentile(counts: list[int], p: float):
+    """Percentil ``p`` (0-1) en horas, interpolando dentro del bucket; None si no hay datos."""
+    total = sum(counts)
+    if total <= 0:
+        return None
+    target = p * total
+    seen = 0
+    for i, n in enumerate(counts):
+        if n <= 0:
+            continue
+        if seen + n >= target:
+            lower = CLOSE_HOURS_BUCKETS[i - 1] if i > 0 else 0
+            if i >= len(CLOSE_HOURS_BUCKETS):
+                return float(lower)  # bucket abierto: cota inferior
+            return round(lower + (CLOSE_HOURS_BUCKETS[i] - lower) * (target - seen) / n, 1)
+        seen += n
+    return float(CLOSE_HOURS_BUCKETS[-1])
+
+
+REPORT_GROUPS = {"assignee": "assignee_id", "type": "modernization_type_id"}
+
+
+def _report_names(conn, group: str) -> dict:
+    if group == "assignee":
+        names = {a["id"]: a["name"] for a in list_assignees(conn)}
+    else:
+        names = {t["id"]: t["name"] for t in list_modernization_types(conn)}
+        names[0] = "Sin tipo"
+    return names
+
+
+def report_throughput(conn, week_from: str, week_to: str, group: str = "assignee") -> list[dict]:
+    """Altas y cierres por semana y responsable/tipo."""
+    col = REPORT_GROUPS[group]
+    names = _report_names(conn, group)
+    rows = conn.execute(
+        f"SELECT week, {col}, SUM(opened), SUM(closed) FROM rollup_weekly "
+        f"WHERE week >= ? AND week <= ? GROUP BY week, {col} ORDER BY week, {col}",
+        (week_from, week_to),
+    ).fetchall()
+    return [{"week": r[0], "id": r[1], "name": names.get(r[1], f"#{r[1]} (eliminado)"),
+             "opened": r[2], "closed": r[3]} for r in rows]
+
+
+def report_time_to_close(conn, week_from: str, week_to: str, group: str = "type") -> list[dict]:
+    """Cantidad, mediana y p90 de horas hasta el cierre por responsable/tipo (cierres en el rango)."""
+    col = REPORT_GROUPS[group]
+    names = _report_names(conn, group)
+    per_key = {}
+    for key, bucket, n in conn.execute(
+        f"SELECT {col}, bucket, SUM(count) FROM rollup_close_hist "
+        f"WHERE week >= ? AND week <= ? GROUP BY {col}, bucket",
+        (week_from, week_to),
+    ).fetchall():
+        per_key.setdefault(key, [0] * (len(CLOSE_HOURS_BUCKETS) + 1))[bucket] += n
+    out = []
+    for key, counts in per_key.items():
+        if sum(counts) <= 0:
+            continue
+        out.append({"id": key, "name": names.get(key, f"#{key} (eliminado)"), "closed": sum(counts),
+                    "p50_hours": _hist_percentile(counts, 0.5), "p90_hours": _hist_percentile(counts, 0.9),
+                    "histogram": counts})
+    out.sort(key=lambda r: r["name"])
+    return out
+
+
+def report_backlog(conn, week_from: str, week_to: str) -> list[dict]:
+    """Tickets abiertos al final de cada semana (acumulado de altas menos cierres)."""
+    backlog = 0
+    out = []
+    for week, opened, closed in conn.execute(
+        "SELECT week, SUM(opened), SUM(closed) FROM rollup_weekly WHERE week <= ? GROUP BY week ORDER BY week",
+        (week_to,),
+    ).fetchall():
+        backlog += opened - closed
+        if week >= week_from:
+            out.append({"week": week, "opened": opened, "closed": closed, "backlog": backlog})
+    return out
+
+
+# ------------------------------
+# Barrido de adjuntos huérfanos
+# ------------------------------
+# Un corte entre storage.put() y el INSERT de new_ticket(), o un borrado que falló, deja
+# PDF que ningún ticket referencia. El barrido recorre el almacenamiento en streaming
+# (os.scandir / paginado de S3) y resuelve cada lote con un IN sobre idx_tickets_pdf_filename
+# (y el de archive.db): nunca se carga la lista de archivos ni la tabla completa.
+
+def _referenced_pdfs(conn, names: list[str], with_archive: bool) -> set[str]:
+    marks = ",".join("?" * len(names))
+    found = {r[0] for r in conn.execute(f"SELECT pdf_filename FROM tickets WHERE pdf_filename IN ({marks})", names)}
+    rest = [n for n in names if n not in found]
+    if with_archive and rest:
+        marks = ",".join("?" * len(rest))
+        found.update(r[0] for r in conn.execute(
+            f"SELECT pdf_filename FROM archive.tickets WHERE pdf_filename IN ({marks})", rest))
+    return found
+
+
+def sweep_orphan_uploads(reclaim: bool = False, grace_hours: float = ORPHAN_GRACE_HOURS,
+                         batch_size: int = ORPHAN_SWEEP_BATCH, progress=None) -> dict:
+    """Busca (y con ``reclaim`` borra) adjuntos sin ticket. Devuelve el informe de la corrida.
+
+    Solo considera archivos con extensión permitida y modificados antes del período de
+    gracia; también cuenta los temporales ``.part`` viejos de subidas interrumpidas.
+    """
+    cutoff_ns = time.time_ns() - int(grace_hours * 3600 * 1e9)
+    report = {"scanned": 0, "recent": 0, "orphans": 0, "orphan_bytes": 0, "partial": 0, "partial_bytes": 0,
+              "reclaimed": 0, "reclaimed_bytes": 0, "partial_reclaimed": 0, "partial_reclaimed_bytes": 0,
+              "sample": []}
+    conn = db_connect()
+    try:
+        with_archive = attach_archive(conn)
+        if with_archive:
+            _ensure_archive_schema(conn)  # índice por pdf_filename en archive.db
+            conn.commit()
+
+        def flush(batch):
+            referenced = _referenced_pdfs(conn, [o.name for o in batch], with_archive)
+            orphans = [o for o in batch if o.name not in referenced]
+            report["orphans"] += len(orphans)
+            report["orphan_bytes"] += sum(o.size for o in orphans)
+            report["sample"].extend(o.name for o in orphans[:20 - len(report["sample"])])
+            if reclaim and orphans:
+                removed = set(storage.delete_many([o.name for o in orphans]))
+                # Solo lo que de verdad se borró (otro proceso pudo llevárselo antes)
+                report["reclaimed"] += len(removed)
+                report["reclaimed_bytes"] += sum(o.size for o in orphans if o.name in removed)
+                for o in orphans:
+                    forget_pdf_text(conn, o.name)
+                conn.commit()
+            if progress:
+                progress(report)
+
+        batch = []
+        for obj in storage.iter_objects():
+            if not allowed_file(obj.name):
+                continue
+            report["scanned"] += 1
+            if obj.mtime_ns > cutoff_ns:
+                report["recent"] += 1
+                continue
+            batch.append(obj)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+        partial = [o for o in storage.iter_partial() if o.mtime_ns <= cutoff_ns]
+        report["partial"] = len(partial)
+        report["partial_bytes"] = sum(o.size for o in partial)
+        if reclaim and partial:
+            removed = set(storage.delete_many([o.name for o in partial]))
+            report["partial_reclaimed"] = len(removed)
+            report["partial_reclaimed_bytes"] = sum(o.size for o in partial if o.name in removed)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    logger.info(f"[SWEEP] {report['scanned']} adjuntos revisados, {report['orphans']} huérfanos "
+                f"({report['orphan_bytes'] / 2**20:.1f} MiB), {report['partial']} temporales; "
+                f"{'liberados' if reclaim else 'sin borrar'} "
+                f"{(report['reclaimed_bytes'] + report['partial_reclaimed_bytes']) / 2**20:.1f} MiB")
+    return report
+
+
+def start_orphan_sweeper(check_every: float = 300):
+    """Hilo que barre y borra huérfanos cada ORPHAN_SWEEP_INTERVAL_HOURS (lo llama gunicorn.conf.py)."""
+    if ORPHAN_SWEEP_INTERVAL_HOURS <= 0:
+        return None
+    interval = ORPHAN_SWEEP_INTERVAL_HOURS * 3600
+
+    def loop():
+        while not _draining.wait(min(check_every, interval)):
+            try:
+                conn = db_connect()
+                try:
+                    due = claim_periodic_run(conn, "orphan_sweep_claimed_at", interval)
+                finally:
+                    conn.close()
+                if due:
+                    sweep_orphan_uploads(reclaim=True)
+            except Exception as e:
+                logger.error(f"[SWEEP] Falló el barrido programado de adjuntos: {e}")
+
+    thread = threading.Thread(target=loop, name="orphan-sweeper", daemon=True)
+    thread.start()
+    return thread
+
+
+@app.cli.command("sweep-uploads")
+@click.option("--reclaim", is_flag=True, help="Borrar los huérfanos (por defecto solo informa).")
+@click.option("--grace-hours", default=ORPHAN_GRACE_HOURS, show_default=True, type=float,
+              help="Ignorar archivos modificados hace menos de estas horas.")
+@click.option("--batch-size", default=ORPHAN_SWEEP_BATCH, show_default=True, type=int)
+def sweep_uploads_command(reclaim, grace_hours, batch_size):
+    """Informa (o borra con --reclaim) los adjuntos que ningún ticket referencia."""
+    report = sweep_orphan_uploads(reclaim=reclaim, grace_hours=grace_hours, batch_size=batch_size,
+                                  progress=lambda r: click.echo(f"\r{r['scanned']} revisados, {r['orphans']} huérfanos",
+                                                                nl=False))
+    click.echo(f"\n{report['scanned']} adjuntos revisados ({report['recent']} dentro del período de gracia)")
+    click.echo(f"Huérfanos: {report['orphans']} ({report['orphan_bytes'] / 2**20:.1f} MiB); "
+               f"temporales .part viejos: {report['partial']} ({report['partial_bytes'] / 2**20:.1f} MiB)")
+    for name in report["sample"]:
+        click.echo(f"  {name}")
+    if reclaim:
+        click.echo(f"Liberados {report['reclaimed_bytes'] / 2**20:.1f} MiB ({report['reclaimed']} adjuntos)")
+        if report["partial_reclaimed"]:
+            click.echo(f"Liberados {report['partial_reclaimed_bytes'] / 2**20:.1f} MiB "
+                       f"({report['partial_reclaimed']} temporales .part)")
+    elif report["orphans"] or report["partial"]:
+        click.echo("Nada se borró; correr con --reclaim para liberar el espacio")
+
+
+# ------------------------------
+# Sincronización de casos con IGA (sistema externo)
+# ------------------------------
+# Contrato del API (lo implementa iga_stub.py para pruebas):
+#   GET {IGA_API_URL}/cases/changes?since=<cursor>&limit=<n>
+#       -> {"cases": [...], "next": <cursor>, "has_more": bool}   feed ordenado por cursor
+#   GET {IGA_API_URL}/cases?ticket_ids=1,2,3
+#       -> {"cases": [...], "head": <cursor>}                      consulta por tickets del portal
+#   caso: {"case_number": str, "ticket_id": int | null, "status": str, "link": str | null}
+# El cursor (entero) se guarda en portal_meta 'iga_cursor' en la misma transacción que
+# aplica cada página: si la sincronización se corta, la próxima sigue desde ahí.
+
+class IgaError(RuntimeError):
+    pass
+
+
+class RateLimiter:
+    """Token bucket compartido entre hilos: ``rate`` pedidos/s con ráfagas de hasta ``burst`` (por defecto, parejo)."""
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_s = (1 - self.tokens) / self.rate
+            time.sleep(wait_s)
+
+    def pause(self, seconds: float):
+        """Tras un 429: nadie pide de nuevo hasta que pase ``seconds``."""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class IgaClient:
+    """Cliente HTTP (urllib, sin dependencias extra) del API de casos; reintenta 429/5xx con backoff."""
+
+    def __init__(self, base_url: str = IGA_API_URL, token: str = IGA_API_TOKEN, timeout: float = IGA_TIMEOUT,
+                 rate: float = IGA_RATE_LIMIT, retries: int = IGA_MAX_RETRIES):
+        if not base_url:
+            raise IgaError("Falta IGA_API_URL")
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+        self.retries = retries
+        self.limiter = RateLimiter(rate)
+
+    def _get(self, path: str, params: dict) -> dict:
+        url = f"{self.base_url}{path}?{urlencode(params)}"
+        headers = {"Accept": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        error = None
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout) as resp:
+                    return json.load(resp)
+            except urllib.error.HTTPError as e:
+                if e.code != 429 and e.code < 500:
+                    raise IgaError(f"{EXTERNAL_SYSTEM_NAME} respondió {e.code} en {path}") from e
+                error = e
+                try:
+                    delay = float(e.headers.get("Retry-After") or 0)
+                except ValueError:
+                    delay = 0
+                delay = delay or min(2 ** attempt, 30)
+                if e.code == 429:
+                    self.limiter.pause(delay)
+            except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+                error = e
+                delay = min(2 ** attempt, 30)
+            if attempt < self.retries:
+                time.sleep(delay)
+        raise IgaError(f"{EXTERNAL_SYSTEM_NAME} no respondió en {path}: {error}")
+
+    def changes(self, since: int, limit: int) -> dict:
+        return self._get("/cases/changes", {"since": since, "limit": limit})
+
+    def lookup(self, ticket_ids: list[int]) -> dict:
+        return self._get("/cases", {"ticket_ids": ",".join(map(str, ticket_ids))})
+
+
+def apply_iga_cases(conn, cases: list[dict]) -> dict:
+    """Vuelca una página de casos en los tickets (por ticket_id o, si no viene, por N° de caso). No commitea.
+
+    Actualiza N° de caso, link y estado externo; si el caso está en un estado de
+    IGA_CLOSED_STATUSES cierra el ticket (y suma a los rollups). Las filas sin cambios
+    no se tocan, así una página repetida no mueve la generación.
+    """
+    stats = {"received": len(cases), "matched": 0, "updated": 0, "closed": 0}
+    # Un mismo caso puede venir más de una vez en el feed: gana la última versión
+    latest = {}
+    for case in cases:
+        key = ("id", int(case["ticket_id"])) if case.get("ticket_id") else ("case", case.get("case_number"))
+        if key[1]:
+            latest[key] = case
+    rows = {r["id"]: r for r in _lock_tickets(conn, sorted(k[1] for k in latest if k[0] == "id"))}
+    numbers = sorted(k[1] for k in latest if k[0] == "case")
+    if numbers:
+        rows.update((r["id"], r) for r in _lock_tickets(conn, numbers, column="iga_case_number"))
+    by_case = {r["iga_case_number"]: r for r in rows.values() if r["iga_case_number"]}
+    now_iso = datetime.now().isoformat(timespec='seconds')
+    updates, closes, changes, seen = [], [], [], set()
+    for (kind, key), case in latest.items():
+        row = rows.get(key) if kind == "id" else by_case.get(key)
+        if row is None or row["id"] in seen:
+            continue
+        seen.add(row["id"])
+        stats["matched"] += 1
+        status = (case.get("status") or "").strip() or row["iga_status"]
+        values = (case.get("case_number") or row["iga_case_number"], case.get("link") or row["iga_link"], status)
+        closing = row["status"] == "Abierto" and (status or "").lower() in IGA_CLOSED_STATUSES
+        change = {"iga_case_number": values[0], "iga_link": values[1], "iga_status": values[2],
+                  "updated_at": now_iso, "version": row["version"] + 1}
+        if closing:
+            closes.append((*values, now_iso, now_iso, row["id"]))
+            rollup_ticket_closed(conn, row["created_at"], now_iso, row["assignee_id"], row["modernization_type_id"])
+            changes.append(("close", row["id"], dict(change, status="Cerrado", closed_at=now_iso)))
+        elif values != (row["iga_case_number"], row["iga_link"], row["iga_status"]):
+            updates.append((*values, now_iso, row["id"]))
+            changes.append(("update", row["id"], change))
+    if updates:
+        conn.executemany("UPDATE tickets SET iga_case_number=?, iga_link=?, iga_status=?, updated_at=?, "
+                         "version=version+1 WHERE id=?", updates)
+    if closes:
+        conn.executemany("UPDATE tickets SET iga_case_number=?, iga_link=?, iga_status=?, status='Cerrado', "
+                         "updated_at=?, closed_at=?, version=version+1 WHERE id=?", closes)
+    for op in ("update", "close"):
+        log_ticket_changes(conn, op, [(ticket_id, data) for kind, ticket_id, data in changes if kind == op], now_iso)
+    stats["updated"] = len(updates) + len(closes)
+    stats["closed"] = len(closes)
+    return stats
+
+
+def _set_iga_cursor(conn, cursor: int):
+    conn.execute("INSERT INTO portal_meta(key, value) VALUES ('iga_cursor', ?) "
+                 "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (int(cursor),))
+
+
+def _open_ticket_id_batches(conn, batch_size: int):
+    # Keyset por id: nunca se cargan todos los ids en memoria
+    last = 0
+    while True:
+        ids = [r[0] for r in conn.execute("SELECT id FROM tickets WHERE status='Abierto' AND id > ? "
+                                          "ORDER BY id LIMIT ?", (last, batch_size))]
+        if not ids:
+            return
+        yield ids
+        last = ids[-1]
+
+
+def sync_iga(client: IgaClient | None = None, full: bool = False, batch_size: int = IGA_SYNC_BATCH,
+             concurrency: int = IGA_SYNC_CONCURRENCY, progress=None) -> dict:
+    """Sincroniza estados de casos desde IGA. Devuelve contadores de la corrida.
+
+    Incremental: recorre el feed de cambios desde el cursor guardado, una página por
+    transacción. Completa (``full`` o sin cursor todavía): consulta por lotes los tickets
+    abiertos, con hasta ``concurrency`` pedidos en vuelo, y deja el cursor en la cabeza
+    del feed que informó IGA al empezar.
+    """
+    client = client or IgaClient()
+    totals = {"mode": "full", "requests": 0, "received": 0, "matched": 0, "updated": 0, "closed": 0}
+
+    def add(stats):
+        for k, v in stats.items():
+            totals[k] += v
+        if progress:
+            progress(totals)
+
+    conn = db_connect()
+    try:
+        row = conn.execute("SELECT value FROM portal_meta WHERE key='iga_cursor'").fetchone()
+        cursor = None if row is None else row[0]
+        if cursor is not None and not full:
+            totals["mode"] = "incremental"
+            while True:
+                page = client.changes(cursor, batch_size)
+                totals["requests"] += 1
+                add(apply_iga_cases(conn, page.get("cases") or []))
+                cursor = int(page["next"])
+                _set_iga_cursor(conn, cursor)
+                conn.commit()
+                if not page.get("has_more"):
+                    break
+        else:
+            head = None
+            with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="iga-sync") as pool:
+                in_flight = []
+
+                def apply_oldest():
+                    nonlocal head
+                    result = in_flight.pop(0).result()
+                    totals["requests"] += 1
+                    if result.get("head") is not None:
+                        head = int(result["head"]) if head is None else min(head, int(result["head"]))
+                    add(apply_iga_cases(conn, result.get("cases") or []))
+                    conn.commit()
+
+                try:
+                    for ids in _open_ticket_id_batches(conn, batch_size):
+                        in_flight.append(pool.submit(client.lookup, ids))
+                        # Acota lo pendiente: se aplica el más viejo antes de pedir más
+                        if len(in_flight) >= concurrency:
+                            apply_oldest()
+                    while in_flight:
+                        apply_oldest()
+                except BaseException:
+                    for future in in_flight:
+                        future.cancel()
+                    raise
+            if head is None:
+                # Sin tickets abiertos: una consulta vacía igual informa la cabeza del feed
+                head = client.lookup([]).get("head")
+                totals["requests"] += 1
+            _set_iga_cursor(conn, max(int(head or 0), cursor or 0))
+            conn.commit()
+        totals["cursor"] = int(conn.execute("SELECT value FROM portal_meta WHERE key='iga_cursor'").fetchone()[0])
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    logger.info(f"[IGA] Sincronización {totals['mode']}: {totals['matched']} tickets con caso, "
+                f"{totals['updated']} actualizados, {totals['closed']} cerrados ({totals['requests']} pedidos)")
+    return totals
+
+
+def start_iga_sync_scheduler(check_every: float = 30):
+    """Hilo que corre la sincronización incremental cada IGA_SYNC_INTERVAL_MINUTES (lo llama gunicorn.conf.py)."""
+    if IGA_SYNC_INTERVAL_MINUTES <= 0 or not IGA_API_URL:
+        return None
+    interval = IGA_SYNC_INTERVAL_MINUTES * 60
+
+    def loop():
+        while not _draining.wait(min(check_every, interval)):
+            try:
+                conn = db_connect()
+                try:
+                    due = claim_periodic_run(conn, "iga_sync_claimed_at", interval)
+                finally:
+                    conn.close()
+                if due:
+                    sync_iga()
+            except Exception as e:
+                logger.error(f"[IGA] Falló la sincronización programada: {e}")
+
+    thread = threading.Thread(target=loop, name="iga-sync-scheduler", daemon=True)
+    thread.start()
+    return thread
+
+
+@app.cli.command("iga-sync")
+@click.option("--full", is_flag=True, help="Consultar todos los tickets abiertos en lugar del feed de cambios.")
+@click.option("--url", default=None, help="URL base del API (por defecto IGA_API_URL).")
+def iga_sync_command(full, url):
+    """Sincroniza el estado de los casos del sistema externo con los tickets."""
+    try:
+        client = IgaClient(base_url=url or IGA_API_URL)
+        totals = sync_iga(client, full=full,
+                          progress=lambda t: click.echo(f"\r{t['received']} casos, {t['updated']} actualizados", nl=False))
+    except IgaError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"\nListo ({totals['mode']}): {totals['matched']} tickets con caso, {totals['updated']} actualizados, "
+               f"{totals['closed']} cerrados, {totals['requests']} pedidos; cursor {totals['cursor']}")
+
+
+# ------------------------------
+# Compresión de respuestas (gzip / brotli)
+# ------------------------------
+def _compressor(encoding: str):
+    """Objeto con compress(chunk)/flush() para comprimir de a pedazos."""
+    if encoding == "br":
+        import brotli
+        comp = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        return comp.process, comp.finish
+    comp = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)  # wbits 31: formato gzip
+    return comp.compress, comp.flush
+
+
+def _brotli_available() -> bool:
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _negotiate_encoding() -> str | None:
+    accept = request.accept_encodings
+    if COMPRESS_BROTLI and accept.quality("br") > 0 and _brotli_available():
+        return "br"
+    if accept.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+
+def _compress_stream(chunks, encoding: str):
+    """Comprime un iterable de respuesta a medida que se consume: nunca junta el cuerpo entero."""
+    compress, finish = _compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            out = compress(chunk)
+            if out:
+                yield out
+        yield finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+
+
+@app.after_request
+def compress_response(resp):
+    """Comprime HTML/CSV/JSON según Accept-Encoding.
+
+    Las respuestas en memoria se comprimen si superan COMPRESS_MIN_SIZE; las
+    streameadas (export.csv) se comprimen por pedazos, salvo que declaren un
+    Content-Length menor. PDF/XLSX y los archivos servidos con send_file
+    quedan como están.
+    """
+    if (not COMPRESS_ENABLED or request.method == "HEAD" or resp.status_code < 200
+            or resp.status_code in (204, 206, 304) or resp.direct_passthrough
+            or "Content-Encoding" in resp.headers or resp.mimetype not in COMPRESS_MIMETYPES
+            or "no-transform" in resp.headers.get("Cache-Control", "")):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    encoding = _negotiate_encoding()
+    if not encoding or (resp.content_length is not None and resp.content_length < COMPRESS_MIN_SIZE):
+        return resp
+    if resp.is_streamed:
+        resp.response = _compress_stream(resp.response, encoding)
+        resp.headers.pop("Content-Length", None)
+    else:
+        data = resp.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return resp
+        compress, finish = _compressor(encoding)
+        resp.set_data(compress(data) + finish())
+    resp.headers["Content-Encoding"] = encoding
+    # La representación comprimida no es byte a byte la misma: el ETag pasa a débil
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+# ------------------------------
+# Salud, readiness y apagado ordenado
+# ------------------------------
+class Readiness:
+    """Estado que responde /readyz sin tocar la base en cada sondeo.
+
+    El ping a la base se repite a lo sumo cada READY_CHECK_INTERVAL s y lo hace
+    un solo hilo; los demás devuelven el último resultado. Cola de correo y
+    trabajo en curso salen de contadores en memoria.
+    """
+
+    def __init__(self):
+        self._db = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _check_db(self) -> dict:
+        start = time.perf_counter()
+        try:
+            conn = db_connect()
+            try:
+                conn.execute("SELECT 1").fetchone()
+            finally:
+                conn.close()
+        except Exception as e:
+            return {"ok": False, "error": str(e)[:300]}
+        return {"ok": True, "ms": round((time.perf_counter() - start) * 1000, 1)}
+
+    def db(self) -> dict:
+        stale = self._db is None or time.monotonic() - self._checked_at >= READY_CHECK_INTERVAL
+        # El primer chequeo espera; después, si otro hilo ya está chequeando se usa el anterior
+        if stale and self._lock.acquire(blocking=self._db is None):
+            try:
+                self._db = dict(self._check_db(), checked_at=datetime.now().isoformat(timespec='seconds'))
+                self._checked_at = time.monotonic()
+            finally:
+                self._lock.release()
+        return self._db
+
+    def state(self) -> dict:
+        db = self.db()
+        work = inflight.snapshot()
+        mail_queue = work.get("mail", 0)
+        # Un error de transporte de correo se informa pero no saca al worker de servicio:
+        # reiniciarlo no lo arregla y las altas/cierres siguen funcionando.
+        mail = dict(mail_status, queue=mail_queue, ok=mail_queue <= READY_MAIL_QUEUE_MAX)
+        draining = _draining.is_set()
+        return {
+            "ready": db["ok"] and mail["ok"] and not draining,
+            "draining": draining,
+            "db": db,
+            "mail": mail,
+            "inflight": work,
+        }
+
+
+readiness = Readiness()
+
+
+def begin_drain():
+    """El worker va a salir: /readyz pasa a 503 y se rechazan altas/cierres nuevos."""
+    if not _draining.is_set():
+        _draining.set()
+        logger.info(f"[SHUTDOWN] Drenando trabajo en curso: {inflight.snapshot()}")
+
+
+def drain_background_work(timeout: float = SHUTDOWN_DRAIN_TIMEOUT) -> bool:
+    """Espera subidas, correos e indexación pendientes hasta ``timeout`` segundos.
+
+    Vencido el plazo cancela lo que no empezó: los correos perdidos quedan en el
+    log (asunto y destinatarios) y los PDF siguen "pending" para ``flask index-pdfs``.
+    Devuelve True si terminó todo.
+    """
+    begin_drain()
+    deadline = time.monotonic() + timeout
+    done = inflight.wait_idle(timeout)
+    with _mail_jobs_lock:
+        queued = list(_mail_jobs.items())
+    _mail_executor.shutdown(wait=False, cancel_futures=True)
+    _cleanup_executor.shutdown(wait=False, cancel_futures=True)
+    _export_executor.shutdown(wait=False, cancel_futures=True)
+    pdf_indexer.shutdown()
+    if not done:
+        for subject, to in (info for future, info in queued if future.cancelled()):
+            logger.error(f"[SHUTDOWN] Correo no enviado por apagado: subject={subject} to={to}")
+        # Los que ya estaban enviándose tienen lo que queda del plazo
+        done = inflight.wait_idle(deadline - time.monotonic(), kinds=("mail", "upload"))
+    logger.info(f"[SHUTDOWN] Drenado {'completo' if done else 'incompleto'}: {inflight.snapshot()}")
+    return done
+
+
+@app.before_request
+def reject_writes_while_draining():
+    # Un worker que está saliendo no arranca altas/cierres nuevos: el cliente reintenta contra otro
+    if _draining.is_set() and request.method == "POST" and request.endpoint not in ("login", "logout"):
+        resp = make_response("El servidor se está reiniciando; reintentá en unos segundos.", 503)
+        resp.headers["Retry-After"] = "5"
+        return resp
+
+
+@app.route("/healthz")
+def healthz():
+    return jsonify({"status": "ok", "pid": os.getpid()})
+
+
+@app.route("/readyz")
+def readyz():
+    state = readiness.state()
+    return jsonify(state), (200 if state["ready"] else 503)
+
+
+# ------------------------------
+# Perfilado por request (admin)
+# ------------------------------
+# Se pide con el header "X-Profile: <password admin>". No se acepta por query string:
+# la URL queda en el access log de gunicorn (stdout) y en los de cualquier proxy.
+# El perfil cubre también el cuerpo de las respuestas en streaming (export.csv).
+# Categorías por archivo de cada función (tiempo propio, no se superponen)
+PROFILE_CATEGORIES = (
+    ("jinja", ("jinja2", "<template>", ".html")),
+    ("pandas", ("pandas", "numpy", "openpyxl")),
+)
+_PROFILE_SQL_METHODS = {"execute", "executemany", "executescript", "fetchone", "fetchmany", "fetchall", "commit"}
+
+
+def _is_sql_function(key) -> bool:
+    """Funciones donde el tiempo es de la base: métodos C de sqlite3 o el cursor de psycopg.
+
+    Con sqlite3 la iteración directa del cursor (``for r in conn.execute(...)``) no
+    la ve cProfile y queda como tiempo propio del llamador.
+    """
+    filename, _, func = key
+    if filename == "~":
+        m = re.match(r"<method '(\w+)' of 'sqlite3\.", func)
+        return bool(m) and m.group(1) in _PROFILE_SQL_METHODS
+    return "psycopg" in filename and filename.endswith("cursor.py") and func in _PROFILE_SQL_METHODS
+
+
+def _profile_label(key) -> str:
+    filename, line, func = key
+    if filename == "~":
+        return func
+    for marker in ("site-packages/", "lib/python"):
+        if marker in filename:
+            filename = filename.split(marker, 1)[1]
+            break
+    else:
+        filename = os.path.relpath(filename, BASE_DIR) if os.path.isabs(filename) else filename
+    return f"{filename}:{line}({func})"
+
+
+def summarize_profile(stats: pstats.Stats, top: int = 25) -> dict:
+    """Funciones más caras, tiempo por categoría y tiempo de SQL por función llamadora."""
+    raw = stats.stats
+    categories = {"sql": 0.0, "jinja": 0.0, "pandas": 0.0, "python": 0.0}
+    sql_callers = {}
+    sql_calls = 0
+    for key, (cc, nc, tt, ct, callers) in raw.items():
+        if _is_sql_function(key):
+            categories["sql"] += tt
+            sql_calls += nc
+            for caller, (_, c_nc, _, c_ct) in callers.items():
+                entry = sql_callers.setdefault(caller, [0, 0.0])
+                entry[0] += c_nc
+                entry[1] += c_ct
+            continue
+        name = key[0]
+        for category, markers in PROFILE_CATEGORIES:
+            if any(m in name for m in markers):
+                categories[category] += tt
+                break
+        else:
+            categories["python"] += tt
+
+    def rows(sort_index):
+        ordered = sorted(raw.items(), key=lambda kv: kv[1][sort_index], reverse=True)[:top]
+        return [{"func": _profile_label(k), "calls": v[1], "tottime_ms": round(v[2] * 1000, 2),
+                 "cumtime_ms": round(v[3] * 1000, 2)} for k, v in ordered]
+
+    return {
+        "total_ms": round(stats.total_tt * 1000, 2),
+        "categories_ms": {k: round(v * 1000, 2) for k, v in categories.items()},
+        "sql_calls": sql_calls,
+        "sql_by_caller": [{"func": _profile_label(k), "calls": n, "ms": round(t * 1000, 2)}
+                          for k, (n, t) in sorted(sql_callers.items(), key=lambda kv: kv[1][1], reverse=True)[:10]],
+        "top_tottime": rows(2),
+        "top_cumtime": rows(3),
+    }
 
 
-def get_type_name(conn, type_id):
-    if not type_id:
-        return None
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM modernization_types WHERE id=?", (type_id,))
-    row = cur.fetchone()
-    return row["name"] if row else None
+def _prune_profiles(keep: int = PROFILE_KEEP):
+    summaries = sorted(PROFILE_DIR.glob("*.json"))
+    for path in summaries[:max(len(summaries) - keep, 0)]:
+        path.unlink(missing_ok=True)
+        path.with_suffix(".prof").unlink(missing_ok=True)
 
 
-def get_assignee(conn, assignee_id):
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, email FROM assignees WHERE id=?", (assignee_id,))
-    row = cur.fetchone()
-    return dict(row) if row else None
+def save_profile(profiler: cProfile.Profile, meta: dict) -> str:
+    """Guarda el .prof (para snakeviz/pstats) y un resumen JSON; conserva los últimos PROFILE_KEEP."""
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}"
+    profiler.dump_stats(PROFILE_DIR / f"{name}.prof")
+    summary = dict(meta, name=name, **summarize_profile(pstats.Stats(profiler)))
+    tmp = PROFILE_DIR / f".{name}.json.part"
+    tmp.write_text(json.dumps(summary), encoding="utf-8")
+    os.replace(tmp, PROFILE_DIR / f"{name}.json")
+    _prune_profiles()
+    return name
 
 
-def send_mail(subject: str, to: str | list[str], body_html: str, cc: str | list[str] | None = None, attachments: list[str] | None = None):
-    logger.info(f"[MAIL] preparing subject={subject} to={to} cc={cc} attachments={attachments}")
-    recipients = [to] if isinstance(to, str) else list(to)
-    cc_list = []
-    if cc:
-        cc_list = [cc] if isinstance(cc, str) else list(cc)
-    attachments = attachments or []
+def _profiled_body(body, profiler: cProfile.Profile, finish):
+    """Itera el cuerpo con el profiler activo solo mientras se genera cada pedazo.
 
-    # Intento Outlook
-    if USE_OUTLOOK:
-        try:
-            # Inicializa COM en el hilo actual (cada request puede usar un hilo distinto)
-            if pythoncom:
-                try:
-                    pythoncom.CoInitialize()
-                except Exception:
-                    pass
-            import win32com.client as win32
-            outlook = win32.Dispatch("Outlook.Application")
-            mail = outlook.CreateItem(0)  # olMailItem
-            mail.To = "; ".join([r for r in recipients if r])
-            if cc_list:
-                mail.CC = "; ".join([c for c in cc_list if c])
-            mail.Subject = subject
-            mail.HTMLBody = body_html
-            for path in attachments:
-                try:
-                    if path and os.path.exists(path):
-                        mail.Attachments.Add(str(path))
-                except Exception as e:
-                    logger.warning(f"[MAIL] No se pudo adjuntar {path} a Outlook: {e}")
-            # Seleccionar cuenta si coincide con MAIL_FROM
+    ``finish`` corre al cerrar la respuesta aunque el servidor no llegue a iterarla
+    (un generador sin arrancar no ejecuta su finally en close()).
+    """
+    def chunks():
+        it = iter(body)
+        while True:
+            profiler.enable()
             try:
-                if MAIL_FROM:
-                    session_out = outlook.Session
-                    for account in session_out.Accounts:
-                        try:
-                            smtp = account.SmtpAddress
-                        except Exception:
-                            smtp = None
-                        if smtp and smtp.lower() == MAIL_FROM.lower():
-                            mail._oleobj_.Invoke(64209, 0, 8, 0, account)  # PR_SEND_USING_ACCOUNT
-                            break
-            except Exception as e2:
-                logger.warning(f"[MAIL] No se pudo seleccionar la cuenta {MAIL_FROM}: {e2}")
-            mail.Send()
-            logger.info("[MAIL] Sent via Outlook")
-            return
-        except ImportError:
-            logger.warning("[MAIL] pywin32 no instalado; usando SMTP fallback.")
-        except Exception as e:
-            logger.warning(f"[MAIL] Error enviando por Outlook: {e}; usando SMTP fallback.")
+                chunk = next(it)
+            except StopIteration:
+                return
+            finally:
+                profiler.disable()
+            yield chunk
 
-    # SMTP fallback
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = MAIL_FROM
-    msg["To"] = ", ".join([r for r in recipients if r])
-    if cc_list:
-        msg["Cc"] = ", ".join([c for c in cc_list if c])
-    msg.set_content("Este mensaje requiere un cliente compatible con HTML.")
-    msg.add_alternative(body_html, subtype="html")
+    def close():
+        try:
+            if hasattr(body, "close"):
+                body.close()
+        finally:
+            finish()
+
+    return ClosingIterator(chunks(), close)
+
+
+# Desde Python 3.12 cProfile usa sys.monitoring y admite un solo profiler activo por proceso:
+# un segundo request perfilado en paralelo (gthread) fallaría con ValueError
+_profile_lock = threading.Lock()
 
-    for path in attachments:
+
+class ProfilingMiddleware:
+    """Perfila con cProfile los requests que lo piden con la password de admin (de a uno por proceso)."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        password = environ.get("HTTP_X_PROFILE")
+        if not password:
+            return self.wsgi_app(environ, start_response)
+        if not hmac.compare_digest(password.encode("utf-8"), ADMIN_PASSWORD.encode("utf-8")):
+            start_response("403 FORBIDDEN", [("Content-Type", "text/plain; charset=utf-8")])
+            return ["Password admin incorrecta para perfilar.".encode("utf-8")]
+        if not _profile_lock.acquire(blocking=False):
+            start_response("409 CONFLICT", [("Content-Type", "text/plain; charset=utf-8")])
+            return ["Ya hay un perfil en curso; reintentar en unos segundos.".encode("utf-8")]
         try:
-            if path and os.path.exists(path):
-                ctype, encoding = mimetypes.guess_type(str(path))
-                if ctype is None:
-                    ctype = "application/octet-stream"
-                maintype, subtype = ctype.split("/", 1)
-                with open(path, "rb") as f:
-                    msg.add_attachment(
-                        f.read(), maintype=maintype, subtype=subtype, filename=os.path.basename(path)
-                    )
-        except Exception as e:
-            logger.warning(f"[MAIL] No se pudo adjuntar {path}: {e}")
+            return self._profile(environ, start_response)
+        except BaseException:
+            _profile_lock.release()
+            raise
 
-    # Si no hay SMTP configurado, omitimos fallback
-    if not SMTP_HOST:
-        logger.warning("[MAIL] SMTP no configurado (SMTP_HOST vacío); se omite fallback. Email NO enviado.")
-        return
-    try:
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as s:
-            s.starttls()
-            if SMTP_USER:
-                s.login(SMTP_USER, SMTP_PASS)
-            s.send_message(msg)
-            logger.info("[MAIL] Sent via SMTP")
-    except Exception as e:
-        logger.warning(f"[MAIL] Error enviando por SMTP: {e}")
+    def _profile(self, environ, start_response):
+        # El lock se suelta en finish(), cuando terminó de generarse el cuerpo
+        status_holder = {}
 
+        def capture_status(status, headers, exc_info=None):
+            status_holder["status"] = status
+            return start_response(status, headers, exc_info)
 
-def human_date(d: str) -> str:
-    try:
-        return datetime.strptime(d, "%Y-%m-%d").strftime("%d/%m/%Y")
-    except Exception:
-        return d
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            body = self.wsgi_app(environ, capture_status)
+        finally:
+            profiler.disable()
 
+        def finish():
+            meta = {
+                "method": environ.get("REQUEST_METHOD"),
+                "path": environ.get("PATH_INFO"),
+                "query": environ.get("QUERY_STRING", ""),
+                "status": status_holder.get("status", "").split(" ")[0],
+                "wall_ms": round((time.perf_counter() - started) * 1000, 2),
+                "created_at": datetime.now().isoformat(timespec='seconds'),
+            }
+            try:
+                name = save_profile(profiler, meta)
+                logger.info(f"[PROFILE] {meta['method']} {meta['path']} {meta['wall_ms']} ms -> {name}")
+            except Exception as e:
+                logger.warning(f"[PROFILE] No se pudo guardar el perfil: {e}")
+            finally:
+                _profile_lock.release()
+
+        return _profiled_body(body, profiler, finish)
+
+
+if PROFILING_ENABLED:
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app)
+
+
+def list_profiles(limit: int = PROFILE_KEEP) -> list[dict]:
+    out = []
+    for path in sorted(PROFILE_DIR.glob("*.json"), reverse=True)[:limit]:
+        try:
+            out.append(json.loads(path.read_text(encoding="utf-8")))
+        except (OSError, ValueError):
+            continue
+    return out
 
-def query_tickets(conn, q=None, status=None, priority=None, assignee_id=None):
-    sql = (
-        "SELECT t.*, mt.name AS modernization_type_name, "
-        "a.name AS assignee_name, a.email AS assignee_email "
-        "FROM tickets t "
-        "LEFT JOIN modernization_types mt ON mt.id = t.modernization_type_id "
-        "LEFT JOIN assignees a ON a.id = t.assignee_id "
-        "WHERE 1=1 "
-    )
-    params = []
-    if q:
-        if q.isdigit():
-            sql += "AND t.id = ? "
-            params.append(int(q))
-        else:
-            sql += "AND t.site_name LIKE ? "
-            params.append(f"%{q}%")
-    if status:
-        sql += "AND t.status = ? "
-        params.append(status)
-    if priority:
-        sql += "AND t.priority = ? "
-        params.append(priority)
-    if assignee_id:
-        sql += "AND t.assignee_id = ? "
-        params.append(int(assignee_id))
-    sql += "ORDER BY t.id DESC"
-    cur = conn.cursor()
-    cur.execute(sql, params)
-    return [dict(r) for r in cur.fetchall()]
 
 # ------------------------------
 # Autenticación básica (placeholder LDAP)
@@ -746,10 +4935,12 @@ def logout():
 # ------------------------------
 # Rutas principales
 # ------------------------------
-@app.route("/")
-@login_required
-def home():
-    conn = db_connect()
+HOME_TOP_SITES = int(os.getenv("HOME_TOP_SITES", "5"))
+HOME_REFRESH_SECONDS = int(os.getenv("HOME_REFRESH_SECONDS", "60"))  # 0 = sin refresco automático
+
+
+def home_summary(conn):
+    """Contadores y últimos tickets que muestra el inicio."""
     cur = conn.cursor()
     cur.execute("SELECT COUNT(*) FROM tickets WHERE status='Abierto'")
     open_count = cur.fetchone()[0]
@@ -757,49 +4948,75 @@ def home():
     closed_count = cur.fetchone()[0]
     cur.execute("SELECT COUNT(*) FROM tickets")
     total_count = cur.fetchone()[0]
+    archived_closed, archived_total = archived_counts(conn)
+    closed_count += archived_closed
+    total_count += archived_total
 
-    cur.execute(
-        """
-        SELECT t.*, mt.name as modernization_type_name, a.name as assignee_name
-        FROM tickets t
-        LEFT JOIN modernization_types mt ON mt.id = t.modernization_type_id
-        LEFT JOIN assignees a ON a.id = t.assignee_id
-        ORDER BY t.id DESC LIMIT 10
-        """
-    )
-    rows = cur.fetchall()
-    last_tickets = []
-    for r in rows:
-        last_tickets.append({
-            "id": r["id"],
-            "site_name": r["site_name"],
-            "created_at": datetime.fromisoformat(r["created_at"]).strftime("%d/%m/%Y %H:%M"),
-            "modernization_type_name": r["modernization_type_name"],
-            "priority": r["priority"],
-            "assignee_name": r["assignee_name"],
-            "status": r["status"],
-        })
-
-    conn.close()
+    last_tickets = query_tickets(conn, limit=10, view="list")
+    top_sites = site_summary(conn, limit=HOME_TOP_SITES)
 
     summary_cards = [
         {"title": "Abiertos", "count": open_count, "desc": "Tickets en curso"},
         {"title": "Cerrados", "count": closed_count, "desc": "Tickets completados"},
         {"title": "Total", "count": total_count, "desc": "Acumulado histórico"},
     ]
+    return summary_cards, last_tickets, top_sites
+
+
+def _fragment_response(html, etag: str):
+    """Respuesta de un fragmento: validable con ETag (la generación) para que el refresco sea un 304."""
+    resp = make_response(html)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+
+def render_home_summary(conn, generation: int) -> Markup:
+    """Tarjetas, sitios y últimos tickets del inicio, cacheados ya renderizados."""
+    def render():
+        summary_cards, last_tickets, top_sites = home_summary(conn)
+        return render_template("_home_summary.html", summary_cards=summary_cards, last_tickets=last_tickets,
+                               top_sites=top_sites)
+    return Markup(result_cache.get_or_set("home", generation, (), render))
+
+
+@app.route("/")
+@login_required
+def home():
+    conn = db_connect()
+    summary_html = render_home_summary(conn, get_generation(conn))
+    conn.close()
+
+    return render_template("home.html", title="Inicio", summary_html=summary_html,
+                           home_refresh_seconds=HOME_REFRESH_SECONDS)
+
 
-    return render_template("home.html", title="Inicio", summary_cards=summary_cards, last_tickets=last_tickets)
+@app.route("/home/summary")
+@login_required
+def home_summary_fragment():
+    conn = db_connect()
+    try:
+        generation = get_generation(conn)
+        etag = f"home-{generation}"
+        if not is_resource_modified(request.environ, etag=etag):
+            resp = _fragment_response("", etag)
+            resp.status_code = 304
+            return resp
+        return _fragment_response(render_home_summary(conn, generation), etag)
+    finally:
+        conn.close()
 
 
 @app.route("/tickets/new", methods=["GET", "POST"])
 @login_required
 def new_ticket():
     conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name FROM modernization_types ORDER BY name ASC")
-    modernization_types = [dict(row) for row in cur.fetchall()]
-    cur.execute("SELECT id, name, email FROM assignees ORDER BY name ASC")
-    assignees = [dict(row) for row in cur.fetchall()]
+    modernization_types = list_modernization_types(conn)
+    assignees = list_assignees(conn)
+    # Clave de idempotencia: header (clientes API) o campo oculto del formulario
+    idem_header = (request.headers.get("Idempotency-Key") or "").strip()[:128]
+    idem_key = idem_header or (request.form.get("idempotency_key") or "").strip()[:128]
+    form_key = idem_key or uuid.uuid4().hex
 
     if request.method == "POST":
         site_name = request.form.get("site_name", "").strip()
@@ -812,23 +5029,26 @@ def new_ticket():
 
         if not site_name or not request_date or not priority or not assignee_id or not creator_email or not file:
             flash("Completá todos los campos.", "warning")
-            return render_template("new_ticket.html", modernization_types=modernization_types, priorities=PRIORITIES, assignees=assignees)
+            conn.close()
+            return render_template("new_ticket.html", modernization_types=modernization_types, priorities=PRIORITIES, assignees=assignees, idempotency_key=form_key)
 
         if not allowed_file(file.filename):
             flash("El archivo debe ser PDF.", "warning")
-            return render_template("new_ticket.html", modernization_types=modernization_types, priorities=PRIORITIES, assignees=assignees)
+            conn.close()
+            return render_template("new_ticket.html", modernization_types=modernization_types, priorities=PRIORITIES, assignees=assignees, idempotency_key=form_key)
 
-        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secure_filename(file.filename)}"
-        save_path = UPLOAD_FOLDER / filename
-        file.save(save_path)
+        if idem_key:
+            claimed, existing_id = claim_idempotency_key(conn, idem_key)
+            if not claimed:
+                conn.close()
+                return _idempotent_replay(idem_key, existing_id, api=bool(idem_header))
 
-        now_iso = datetime.now().isoformat(timespec='seconds')
-        cur.execute(
-            """
-            INSERT INTO tickets (site_name, modernization_type_id, request_date, priority, assignee_id, creator_email, pdf_filename, status, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, 'Abierto', ?, ?)
-            """,
-            (
+        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secure_filename(file.filename)}"
+        try:
+            with inflight.track("upload"):
+                storage.put(filename, file.stream, content_type="application/pdf")
+            new_ticket_id = insert_ticket(
+                conn,
                 site_name,
                 int(modernization_type_id) if modernization_type_id else None,
                 request_date,
@@ -836,12 +5056,18 @@ def new_ticket():
                 int(assignee_id),
                 creator_email,
                 filename,
-                now_iso,
-                now_iso,
-            ),
-        )
-        new_ticket_id = cur.lastrowid
-        conn.commit()
+            )
+            if idem_key:
+                complete_idempotency_key(conn, idem_key, new_ticket_id)
+            conn.commit()
+            site_index.add(site_name)
+        except Exception:
+            conn.rollback()
+            if idem_key:
+                release_idempotency_key(conn, idem_key)
+            conn.close()
+            raise
+        index_pdf_async(filename)
 
         # ------- Notificaciones por email (creación) -------
         try:
@@ -863,36 +5089,92 @@ def new_ticket():
             <b>Creado por:</b> {creator_email}</p>
             <p><a href="{ticket_url}">Ver detalles del ticket</a></p>
             """
-            attachments = [str(save_path)] if ENABLE_CREATE_ATTACH_PDF else []
-            send_mail(subject, to=recipients, body_html=body_html, attachments=attachments)
+            attachments = [filename] if ENABLE_CREATE_ATTACH_PDF else []
+            send_mail_async(subject, to=recipients, body_html=body_html, stored_attachments=attachments)
         except Exception as e:
             logger.warning(f"[MAIL] Error envío creación #{new_ticket_id}: {e}")
             flash(f"Ticket #{new_ticket_id} creado, pero hubo un error al enviar la notificación por email.", "warning")
 
-        flash(f'Ticket <a href="{url_for("ticket_detail", ticket_id=new_ticket_id)}">#{new_ticket_id}</a> creado con éxito. Se envió una notificación.', "success")
+        flash(f'Ticket <a href="{url_for("ticket_detail", ticket_id=new_ticket_id)}">#{new_ticket_id}</a> creado con éxito. {MAIL_QUEUED_NOTE}', "success")
         conn.close()
         return redirect(url_for("home"))
 
     conn.close()
-    return render_template("new_ticket.html", title="Nuevo Ticket", modernization_types=modernization_types, priorities=PRIORITIES, assignees=assignees)
+    return render_template("new_ticket.html", title="Nuevo Ticket", modernization_types=modernization_types, priorities=PRIORITIES, assignees=assignees, idempotency_key=form_key)
+
+
+def _idempotent_replay(key: str, ticket_id, api: bool = False):
+    """Respuesta a un reintento de creación: no crea nada, lleva al ticket ya creado.
+
+    Si la creación original sigue en curso (doble click), espera hasta
+    IDEMPOTENCY_WAIT segundos a que termine.
+    """
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    while ticket_id is None and time.monotonic() < deadline:
+        time.sleep(0.2)
+        conn = db_connect()
+        row = conn.execute("SELECT ticket_id FROM idempotency_keys WHERE key=?", (key,)).fetchone()
+        conn.close()
+        if row is None:
+            break  # la creación original falló y liberó la clave
+        ticket_id = row[0]
+    if ticket_id is None:
+        if api:
+            resp = make_response("Creación en curso con la misma Idempotency-Key", 409)
+            resp.headers["Retry-After"] = "1"
+            return resp
+        flash("Ese ticket se está creando; revisá los últimos tickets en un momento.", "info")
+        return redirect(url_for("home"))
+    logger.info(f"[IDEMPOTENCY] Reintento de creación con clave {key} -> ticket #{ticket_id} (no se duplicó)")
+    if not api:
+        flash(f'El ticket <a href="{url_for("ticket_detail", ticket_id=ticket_id)}">#{ticket_id}</a> ya había sido creado; no se duplicó.', "info")
+    return redirect(url_for("ticket_detail", ticket_id=ticket_id), code=303)
+
+
+def _ticket_row_version(conn, ticket_id: int) -> tuple[str | None, str | None]:
+    """(versión de la fila, updated_at del archivo) del ticket, o (None, None) si no existe.
+
+    En la tabla caliente la versión es la columna ``version`` (cada escritura la incrementa;
+    updated_at tiene resolución de un segundo). Los archivados ya no cambian: alcanza updated_at.
+    """
+    row = conn.execute("SELECT version FROM tickets WHERE id=?", (ticket_id,)).fetchone()
+    if row:
+        return f"v{row[0]}", None
+    if attach_archive(conn):
+        row = conn.execute("SELECT updated_at FROM archive.tickets WHERE id=?", (ticket_id,)).fetchone()
+    return (f"a{row[0]}", row[0]) if row else (None, None)
+
+
+def _fetch_ticket_dict(conn, ticket_id: int):
+    # sqlite3.Row no se puede serializar para la caché compartida
+    r, archived = fetch_ticket(conn, ticket_id)
+    return (dict(r) if r else None), archived
 
 
 @app.route("/tickets/<int:ticket_id>")
 @login_required
 def ticket_detail(ticket_id: int):
     conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT t.*, mt.name as modernization_type_name, a.name as assignee_name, a.email as assignee_email
-        FROM tickets t
-        LEFT JOIN modernization_types mt ON mt.id = t.modernization_type_id
-        LEFT JOIN assignees a ON a.id = t.assignee_id
-        WHERE t.id=?
-        """,
-        (ticket_id,),
-    )
-    r = cur.fetchone()
+    # Validación condicional barata (PK) antes del join y el render.
+    # La fecha del día entra en el ETag porque la página muestra "días transcurridos".
+    row_version, archived_at = _ticket_row_version(conn, ticket_id)
+    etag = last_modified = version = None
+    if row_version:
+        # Versión de la fila (y de los nombres de catálogo que muestra): clave de la caché y del ETag
+        version = f"{row_version}-c{get_generation(conn, 'catalog_generation')}"
+        etag = f"t{ticket_id}-{version}-{date.today().isoformat()}"
+        if archived_at:
+            last_modified = datetime.fromisoformat(archived_at).astimezone()
+        if "_flashes" not in session and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            conn.close()
+            resp = make_response("", 304)
+            resp.set_etag(etag)
+            resp.headers["Cache-Control"] = "private, no-cache"
+            return resp
+    if version:
+        r, archived = result_cache.get_or_set("ticket", version, ticket_id, lambda: _fetch_ticket_dict(conn, ticket_id))
+    else:
+        r, archived = None, False
     conn.close()
     if not r:
         flash("Ticket no encontrado.", "warning")
@@ -906,10 +5188,16 @@ def ticket_detail(ticket_id: int):
 
     t = dict(r)
     t["days_passed"] = days_passed
+    t["archived"] = archived
     t["request_date"] = human_date(t["request_date"])
     t["created_at"] = datetime.fromisoformat(t["created_at"]).strftime("%d/%m/%Y %H:%M")
 
-    return render_template("ticket_detail.html", t=t)
+    resp = make_response(render_template("ticket_detail.html", t=t))
+    if etag:
+        resp.set_etag(etag)
+        resp.last_modified = last_modified
+        resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 
 @app.route("/tickets/<int:ticket_id>/close", methods=["POST"])
@@ -919,7 +5207,6 @@ def close_ticket(ticket_id: int):
     iga_link = request.form.get("iga_link", "").strip() or None
 
     conn = db_connect()
-    cur = conn.cursor()
 
     data = query_tickets(conn, q=str(ticket_id))
     if not data:
@@ -928,10 +5215,18 @@ def close_ticket(ticket_id: int):
         return redirect(url_for("search"))
     t = data[0]
 
-    cur.execute(
-        "UPDATE tickets SET status='Cerrado', iga_case_number=?, iga_link=?, updated_at=? WHERE id=?",
-        (iga_case, iga_link, datetime.now().isoformat(timespec='seconds'), ticket_id),
-    )
+    version = request.form.get("version")
+    if not mark_ticket_closed(conn, ticket_id, iga_case, iga_link,
+                              expected_version=int(version) if version and version.isdigit() else None):
+        # Otro request lo cerró/modificó antes: no se repite la notificación
+        conn.rollback()
+        current = conn.execute("SELECT status FROM tickets WHERE id=?", (ticket_id,)).fetchone()
+        conn.close()
+        if current and current["status"] == "Cerrado":
+            flash(f"El ticket #{ticket_id} ya estaba cerrado; no se reenvió la notificación.", "info")
+        else:
+            flash(f"El ticket #{ticket_id} fue modificado por otra persona. Revisá los datos y volvé a intentar.", "warning")
+        return redirect(url_for("ticket_detail", ticket_id=ticket_id))
     conn.commit()
 
     # ------- Notificaciones por email (cierre) -------
@@ -943,9 +5238,8 @@ def close_ticket(ticket_id: int):
         cc_list = [email.strip() for email in MAIL_CC_ON_CLOSE.split(',') if email.strip()]
         attachments = []
         if ENABLE_CLOSE_ATTACH_PDF and t.get('pdf_filename'):
-            pdf_path = UPLOAD_FOLDER / t['pdf_filename']
-            if pdf_path.exists():
-                attachments.append(str(pdf_path))
+            if storage.exists(t['pdf_filename']):
+                attachments.append(t['pdf_filename'])
         ticket_url = url_for('ticket_detail', ticket_id=ticket_id, _external=True)
         body_html = f"""
         <h3>El ticket fue cerrado (Completado)</h3>
@@ -956,12 +5250,12 @@ def close_ticket(ticket_id: int):
         <b>Link {EXTERNAL_SYSTEM_NAME}:</b> {f'<a href="{iga_link}">Abrir link</a>' if iga_link else 'No informado'}</p>
         <p><a href="{ticket_url}">Ver detalles del ticket</a></p>
         """
-        send_mail(subject, to=recipients, cc=cc_list, body_html=body_html, attachments=attachments)
+        send_mail_async(subject, to=recipients, cc=cc_list, body_html=body_html, stored_attachments=attachments)
     except Exception as e:
         logger.warning(f"[MAIL] Error envío cierre #{ticket_id}: {e}")
         flash(f"Ticket #{ticket_id} cerrado, pero hubo un error al enviar la notificación por email.", "warning")
     else:
-        flash(f"Ticket #{ticket_id} cerrado con éxito. Se envió una notificación.", "success")
+        flash(f"Ticket #{ticket_id} cerrado con éxito. {MAIL_QUEUED_NOTE}", "success")
 
     conn.close()
     return redirect(url_for("ticket_detail", ticket_id=ticket_id))
@@ -977,63 +5271,244 @@ def delete_ticket(ticket_id: int):
         flash("Password admin incorrecta.", "warning")
         return redirect(url_for("ticket_detail", ticket_id=ticket_id))
 
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT pdf_filename, site_name FROM tickets WHERE id=?", (ticket_id,))
-    row = cur.fetchone()
+    conn = db_connect()
+    cur = conn.cursor()
+    table = "tickets"
+    cur.execute("SELECT * FROM tickets WHERE id=?", (ticket_id,))
+    row = cur.fetchone()
+    if not row and attach_archive(conn):
+        table = "archive.tickets"
+        cur.execute("SELECT * FROM archive.tickets WHERE id=?", (ticket_id,))
+        row = cur.fetchone()
+
+    if not row:
+        conn.close()
+        flash("Ticket no encontrado.", "warning")
+        return redirect(url_for("home"))
+
+    pdf_filename = row["pdf_filename"]
+    site_name = row["site_name"]
+
+    cur.execute(f"DELETE FROM {table} WHERE id=?", (ticket_id,))
+    rollup_ticket_removed(conn, row)
+    log_ticket_changes(conn, "delete", [(ticket_id, None)])
+    if table == "archive.tickets":
+        bump_generation(conn)
+    if pdf_filename:
+        forget_pdf_text(conn, pdf_filename)
+    conn.commit()
+    conn.close()
+
+    # Borrar archivo PDF si existe
+    if pdf_filename:
+        try:
+            storage.delete(pdf_filename)
+        except Exception as e:
+            logger.warning(f"[DELETE] No se pudo borrar el archivo {pdf_filename}: {e}")
+
+    flash(f"Ticket #{ticket_id} ({site_name}) eliminado definitivamente.", "success")
+    return redirect(url_for("home"))
+
+def _bulk_ticket_table(rows: list[dict], assignees: dict) -> str:
+    lines = "".join(
+        f"<tr><td><a href=\"{url_for('ticket_detail', ticket_id=r['id'], _external=True)}\">#{r['id']}</a></td>"
+        f"<td>{escape(r['site_name'])}</td><td>{escape(assignees.get(r['assignee_id'], {}).get('name') or '—')}</td></tr>"
+        for r in rows
+    )
+    return f"<table border=\"1\" cellpadding=\"4\"><tr><th>Ticket</th><th>Sitio</th><th>Asignado a</th></tr>{lines}</table>"
+
+
+def notify_bulk_close(rows: list[dict], assignees: dict, iga_case, iga_link):
+    """Un correo por destinatario (creador/responsable) con todos sus tickets cerrados, y uno solo a la copia."""
+    by_recipient = {}
+    for r in rows:
+        for email in {r["creator_email"], assignees.get(r["assignee_id"], {}).get("email")}:
+            if email:
+                by_recipient.setdefault(email, []).append(r)
+    link_html = f'<a href="{escape(iga_link)}">Abrir link</a>' if iga_link else "No informado"
+    iga = (f"<p><b>N° Caso {EXTERNAL_SYSTEM_NAME}:</b> {escape(iga_case or 'No informado')}<br>"
+           f"<b>Link {EXTERNAL_SYSTEM_NAME}:</b> {link_html}</p>")
+    for email, tickets in by_recipient.items():
+        send_mail_async(f"[Portal Ingeniería] {len(tickets)} ticket(s) CERRADOS", to=email,
+                        body_html=f"<h3>Se cerraron tickets (Completado)</h3>{iga}{_bulk_ticket_table(tickets, assignees)}")
+    cc_list = [email.strip() for email in MAIL_CC_ON_CLOSE.split(',') if email.strip()]
+    if cc_list:
+        send_mail_async(f"[Portal Ingeniería] {len(rows)} ticket(s) CERRADOS", to=cc_list,
+                        body_html=f"<h3>Se cerraron tickets (Completado)</h3>{iga}{_bulk_ticket_table(rows, assignees)}")
+    return len(by_recipient) + (1 if cc_list else 0)
+
+
+@app.post("/tickets/bulk")
+@login_required
+def bulk_tickets():
+    """Cerrar, reasignar o borrar varios tickets en una transacción. Protegido por password de administrador."""
+    back = request.form.get("next") or ""
+    if not back.startswith("/search"):
+        back = url_for("search")
+    if request.form.get("admin_password", "") != ADMIN_PASSWORD:
+        flash("Password admin incorrecta.", "warning")
+        return redirect(back)
+    ids = sorted({int(i) for i in request.form.getlist("ids") if i.isdigit()})
+    action = request.form.get("action")
+    if not ids:
+        flash("No se seleccionó ningún ticket.", "warning")
+        return redirect(back)
+    if len(ids) > BULK_MAX_TICKETS:
+        flash(f"Se pueden procesar hasta {BULK_MAX_TICKETS} tickets por vez.", "warning")
+        return redirect(back)
+    if action not in ("close", "reassign", "delete"):
+        flash("Acción desconocida.", "warning")
+        return redirect(back)
+
+    conn = db_connect()
+    try:
+        assignees = {a["id"]: a for a in list_assignees(conn)}
+        if action == "reassign":
+            new_assignee = request.form.get("assignee_id", type=int)
+            if new_assignee not in assignees:
+                flash("Elegí el responsable al que se reasignan los tickets.", "warning")
+                return redirect(back)
+        if action == "close":
+            iga_case = request.form.get("iga_case_number", "").strip() or None
+            iga_link = request.form.get("iga_link", "").strip() or None
+            rows = bulk_close_tickets(conn, ids, iga_case, iga_link)
+        elif action == "reassign":
+            rows = bulk_reassign_tickets(conn, ids, new_assignee)
+        else:
+            rows = bulk_delete_tickets(conn, ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    skipped = len(ids) - len(rows)
+    note = f" ({skipped} sin cambios)" if skipped else ""
+    if action == "close":
+        try:
+            mails = notify_bulk_close(rows, assignees, iga_case, iga_link) if rows else 0
+        except Exception as e:
+            logger.warning(f"[MAIL] Error envío cierre masivo: {e}")
+            flash(f"{len(rows)} tickets cerrados{note}, pero hubo un error al enviar las notificaciones.", "warning")
+        else:
+            flash(f"{len(rows)} tickets cerrados{note}. Se enviaron {mails} notificaciones.", "success")
+    elif action == "reassign":
+        target = assignees[new_assignee]
+        if rows and target.get("email"):
+            try:
+                send_mail_async(f"[Portal Ingeniería] Se te asignaron {len(rows)} ticket(s)", to=target["email"],
+                                body_html=f"<h3>Tickets reasignados a {escape(target['name'])}</h3>"
+                                          f"{_bulk_ticket_table([dict(r, assignee_id=new_assignee) for r in rows], assignees)}")
+            except Exception as e:
+                logger.warning(f"[MAIL] Error envío reasignación masiva: {e}")
+        flash(f"{len(rows)} tickets reasignados a {target['name']}{note}.", "success")
+    else:
+        delete_files_async([r["pdf_filename"] for r in rows if r["pdf_filename"]])
+        flash(f"{len(rows)} tickets eliminados definitivamente{note}.", "success")
+    logger.info(f"[BULK] {action} {len(rows)}/{len(ids)} tickets")
+    return redirect(back)
+
 
-    if not row:
-        conn.close()
-        flash("Ticket no encontrado.", "warning")
-        return redirect(url_for("home"))
+def _list_assignees(conn) -> list[dict]:
+    cur = conn.cursor()
+    cur.execute("SELECT id, name FROM assignees ORDER BY name ASC")
+    return [dict(row) for row in cur.fetchall()]
 
-    pdf_filename = row["pdf_filename"]
-    site_name = row["site_name"]
 
-    cur.execute("DELETE FROM tickets WHERE id=?", (ticket_id,))
-    conn.commit()
-    conn.close()
+def render_search_results(conn, generation: int) -> Markup:
+    """Región de resultados de /search (acciones masivas, lista y paginado), cacheada ya
+    renderizada por generación y parámetros: la comparten la página completa y el fragmento."""
+    def render():
+        q = request.args.get("q", "").strip()
+        status = request.args.get("status") or None
+        priority = request.args.get("priority") or None
+        assignee_id = request.args.get("assignee_id") or None
+        include_archive = request.args.get("include_archive") == "1"
+        mode = "doc" if request.args.get("mode") == "doc" else "site"
+        page = max(request.args.get("page", 1, type=int), 1)
+        # Se pide una fila de más para saber si hay página siguiente sin COUNT(*)
+        finder = search_documents if mode == "doc" else partial(query_tickets, view="list")
+        rows = finder(conn, q=q, status=status, priority=priority, assignee_id=assignee_id,
+                      include_archive=include_archive, limit=SEARCH_PAGE_SIZE + 1,
+                      offset=(page - 1) * SEARCH_PAGE_SIZE)
+        return render_template("_search_results.html", results=rows[:SEARCH_PAGE_SIZE],
+                               has_next=len(rows) > SEARCH_PAGE_SIZE, page=page,
+                               assignees=_list_assignees(conn) if rows else [])
 
-    # Borrar archivo PDF si existe
-    if pdf_filename:
-        pdf_path = UPLOAD_FOLDER / pdf_filename
-        try:
-            if pdf_path.exists():
-                pdf_path.unlink()
-        except Exception as e:
-            logger.warning(f"[DELETE] No se pudo borrar el archivo {pdf_path}: {e}")
+    # Los enlaces del paginado y el "next" de las acciones repiten los parámetros tal cual
+    cache_key = tuple(sorted(request.args.items(multi=True)))
+    return Markup(result_cache.get_or_set("search", generation, cache_key, render))
 
-    flash(f"Ticket #{ticket_id} ({site_name}) eliminado definitivamente.", "success")
-    return redirect(url_for("home"))
 
 @app.route("/search")
 @login_required
 def search():
-    q = request.args.get("q", "").strip()
-    status = request.args.get("status") or None
-    priority = request.args.get("priority") or None
-    assignee_id = request.args.get("assignee_id") or None
-
     conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name FROM modernization_types ORDER BY name ASC")
-    modernization_types = [dict(row) for row in cur.fetchall()]
-    cur.execute("SELECT id, name FROM assignees ORDER BY name ASC")
-    assignees = [dict(row) for row in cur.fetchall()]
+    assignees = _list_assignees(conn)
+    results_html = render_search_results(conn, get_generation(conn))
+    conn.close()
 
-    results = query_tickets(conn, q=q, status=status, priority=priority, assignee_id=assignee_id)
-    for r in results:
-        r["created_at"] = datetime.fromisoformat(r["created_at"]).strftime("%d/%m/%Y %H:%M")
+    return render_template("search.html", results_html=results_html, priorities=PRIORITIES, assignees=assignees)
+
+
+@app.route("/search/results")
+@login_required
+def search_results():
+    conn = db_connect()
+    try:
+        generation = get_generation(conn)
+        etag = f"search-{generation}"
+        if not is_resource_modified(request.environ, etag=etag):
+            resp = _fragment_response("", etag)
+            resp.status_code = 304
+            return resp
+        return _fragment_response(render_search_results(conn, generation), etag)
+    finally:
+        conn.close()
 
-    conn.close()
 
-    return render_template("search.html", results=results, priorities=PRIORITIES, assignees=assignees)
+@app.route("/api/sites/suggest")
+@login_required
+def api_sites_suggest():
+    prefix = request.args.get("prefix", "")
+    limit = min(request.args.get("limit", SITE_SUGGEST_LIMIT, type=int), 50)
+    conn = db_connect()
+    try:
+        sites = site_index.suggest(prefix, limit, conn=conn)
+    finally:
+        conn.close()
+    resp = jsonify({"prefix": prefix, "sites": sites})
+    resp.headers["Cache-Control"] = "private, max-age=30"
+    return resp
 
 
 @app.route('/uploads/<path:filename>')
 @login_required
 def download_pdf(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
+    if filename != secure_filename(filename):
+        return ("Archivo no encontrado", 404)
+    if isinstance(storage, LocalStorage):
+        return send_from_directory(storage.root, filename, as_attachment=True)
+    url = storage.presigned_url(filename)
+    if url:
+        return redirect(url)
+    # Backend sin URL firmada: se sirve en streaming, con soporte de un rango simple
+    obj = storage.stat(filename)
+    if obj is None:
+        return ("Archivo no encontrado", 404)
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "Accept-Ranges": "bytes"}
+    rng = request.range
+    if rng and rng.units == "bytes" and len(rng.ranges) == 1:
+        bounds = rng.range_for_length(obj.size)
+        if bounds is None:
+            return Response(status=416, headers={"Content-Range": f"bytes */{obj.size}"})
+        start, stop = bounds
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{obj.size}"
+        headers["Content-Length"] = str(stop - start)
+        return Response(storage.get(filename, start, stop - 1), status=206, mimetype="application/pdf", headers=headers)
+    headers["Content-Length"] = str(obj.size)
+    return Response(storage.get(filename), mimetype="application/pdf", headers=headers)
 
 
 # ---------- Admin: Tipos ----------
@@ -1041,7 +5516,6 @@ def download_pdf(filename):
 @login_required
 def admin_types():
     conn = db_connect()
-    cur = conn.cursor()
 
     if request.method == 'POST':
         password = request.form.get('password', '')
@@ -1050,17 +5524,15 @@ def admin_types():
             flash('Password incorrecto.', 'warning')
         else:
             if new_type:
-                try:
-                    cur.execute('INSERT INTO modernization_types(name) VALUES (?)', (new_type,))
+                if add_modernization_type(conn, new_type):
                     conn.commit()
                     flash('Tipo agregado.', 'success')
-                except sqlite3.IntegrityError:
+                else:
                     flash('Ese tipo ya existe.', 'info')
             else:
                 flash('Indicá un nombre de tipo.', 'warning')
 
-    cur.execute('SELECT id, name FROM modernization_types ORDER BY name ASC')
-    types = [dict(row) for row in cur.fetchall()]
+    types = list_modernization_types(conn)
     conn.close()
     return render_template('admin_types.html', modernization_types=types)
 
@@ -1069,14 +5541,16 @@ def admin_types():
 @login_required
 def delete_type(type_id: int):
     conn = db_connect()
-    cur = conn.cursor()
     password = request.form.get('password', '')
     if password != ADMIN_PASSWORD:
         conn.close()
         flash('Password incorrecto.', 'warning')
         return redirect(url_for('admin_types'))
 
-    cur.execute('DELETE FROM modernization_types WHERE id=?', (type_id,))
+    if not delete_modernization_type(conn, type_id):
+        conn.close()
+        flash('El tipo tiene tickets asociados.', 'warning')
+        return redirect(url_for('admin_types'))
     conn.commit()
     conn.close()
     flash('Tipo eliminado.', 'success')
@@ -1088,7 +5562,6 @@ def delete_type(type_id: int):
 @login_required
 def admin_assignees():
     conn = db_connect()
-    cur = conn.cursor()
 
     if request.method == 'POST':
         password = request.form.get('password','')
@@ -1098,23 +5571,13 @@ def admin_assignees():
             flash('Password incorrecto.', 'warning')
         else:
             if name:
-                try:
-                    cur.execute('INSERT INTO assignees(name, email) VALUES(?, ?) ON CONFLICT(name) DO UPDATE SET email=excluded.email', (name, email))
-                except sqlite3.OperationalError:
-                    cur.execute('SELECT id FROM assignees WHERE name=?', (name,))
-                    row = cur.fetchone()
-                    if row:
-                        cur.execute('UPDATE assignees SET email=? WHERE id=?', (email, row['id']))
-                    else:
-                        cur.execute('INSERT INTO assignees(name, email) VALUES(?, ?)', (name, email))
+                upsert_assignee(conn, name, email)
                 conn.commit()
                 flash('Responsable agregado/actualizado.', 'success')
             else:
                 flash('Indicá el nombre.', 'warning')
 
-    cur.execute('SELECT id, name, email FROM assignees ORDER BY name ASC')
-    rows = cur.fetchall()
-    assignees = [dict(r) for r in rows]
+    assignees = list_assignees(conn)
     conn.close()
     return render_template('admin_assignees.html', assignees=assignees)
 
@@ -1123,13 +5586,15 @@ def admin_assignees():
 @login_required
 def delete_assignee(assignee_id: int):
     conn = db_connect()
-    cur = conn.cursor()
     password = request.form.get('password','')
     if password != ADMIN_PASSWORD:
         conn.close()
         flash('Password incorrecto.', 'warning')
         return redirect(url_for('admin_assignees'))
-    cur.execute('DELETE FROM assignees WHERE id=?', (assignee_id,))
+    if not delete_assignee_row(conn, assignee_id):
+        conn.close()
+        flash('El responsable tiene tickets asignados.', 'warning')
+        return redirect(url_for('admin_assignees'))
     conn.commit()
     conn.close()
     flash('Responsable eliminado.', 'success')
@@ -1138,48 +5603,110 @@ def delete_assignee(assignee_id: int):
 
 # ---------- Exportaciones ----------
 
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+# Parquet / Arrow IPC (requieren pyarrow): filas por record batch (y por row group de Parquet)
+EXPORT_COLUMNAR_BATCH = int(os.getenv("EXPORT_COLUMNAR_BATCH", "20000"))
+EXPORT_PARQUET_COMPRESSION = os.getenv("EXPORT_PARQUET_COMPRESSION", "zstd")
+# CSV/Excel con más de EXPORT_ASYNC_THRESHOLD filas se generan en segundo plano (0 = siempre en el request)
+EXPORT_ASYNC_THRESHOLD = int(os.getenv("EXPORT_ASYNC_THRESHOLD", "20000"))
+EXPORT_DIR = Path(os.getenv("EXPORT_DIR", BASE_DIR / "exports"))
+EXPORT_JOB_WORKERS = int(os.getenv("EXPORT_JOB_WORKERS", "1"))
+EXPORT_JOB_KEEP_HOURS = float(os.getenv("EXPORT_JOB_KEEP_HOURS", "24"))
+EXPORT_JOB_STALE_SECONDS = 300  # job en proceso sin latido en este plazo: su worker murió, se vuelve a encolar
+EXPORT_JOB_HEARTBEAT_SECONDS = 5
+EXPORT_JOB_MIMETYPES = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+EXPORT_FIELDS = list(TicketExportRow._fields)
+
+
+def _iter_export_batches(filters: dict, batch_size: int = EXPORT_BATCH_SIZE):
+    """Recorre el resultado en lotes de ``batch_size`` filas sin materializarlo entero.
+
+    Usa la conexión de solo lectura: todo el export ve el mismo instante de la base.
+    En PostgreSQL el cursor es del lado del servidor, así que cada fetchmany trae
+    un lote por la red en vez de todo el resultado.
+    """
+    include_archive = filters.get('include_archive', False)
+    conn = db_connect_readonly(with_archive=include_archive)
+    try:
+        source = tickets_source(conn, include_archive)
+        sql, params = _tickets_query(conn, filters.get('q'), filters.get('status'), filters.get('priority'),
+                                     filters.get('assignee_id'), source=source, columns=ticket_view(conn, "export")[1],
+                                     site=filters.get('site'))
+        cur = conn.server_cursor()
+        cur.row_factory = None
+        run_blocking(cur.execute, sql, params)
+        while True:
+            rows = run_blocking(cur.fetchmany, batch_size)
+            if not rows:
+                break
+            yield list(map(TicketExportRow._make, rows))
+    finally:
+        conn.close()
+
+
 def _rows_for_export(filters: dict):
-    conn = db_connect()
-    rows = query_tickets(conn, **filters)
-    conn.close()
     out = []
-    for r in rows:
-        out.append({
-            'id': r['id'],
-            'site_name': r['site_name'],
-            'modernization_type': r.get('modernization_type_name'),
-            'request_date': r['request_date'],
-            'priority': r['priority'],
-            'assignee': r.get('assignee_name'),
-            'assignee_email': r.get('assignee_email'),
-            'creator_email': r.get('creator_email'),
-            'iga_case_number': r.get('iga_case_number'),
-            'iga_link': r.get('iga_link'),
-            'status': r['status'],
-            'created_at': r['created_at'],
-            'updated_at': r['updated_at'],
-        })
+    for batch in _iter_export_batches(filters):
+        out.extend(batch)
     return out
 
-@app.route('/export.csv')
-@login_required
-def export_csv():
-    filters = {
+
+def _export_filters() -> dict:
+    return {
         'q': request.args.get('q') or None,
         'status': request.args.get('status') or None,
         'priority': request.args.get('priority') or None,
         'assignee_id': request.args.get('assignee_id') or None,
+        'site': request.args.get('site') or None,
+        'include_archive': request.args.get('include_archive') == '1',
     }
-    rows = _rows_for_export(filters)
+
+
+def _iter_csv_export(filters: dict, on_batch=None):
     si = StringIO()
-    if rows:
-        writer = csv.DictWriter(si, fieldnames=list(rows[0].keys()))
-        writer.writeheader()
-        writer.writerows(rows)
-    else:
-        writer = csv.writer(si)
+    writer = csv.writer(si)
+    empty = True
+    for batch in _iter_export_batches(filters):
+        if empty:
+            writer.writerow(EXPORT_FIELDS)
+            empty = False
+        writer.writerows(batch)
+        if on_batch:
+            on_batch(len(batch))
+        yield si.getvalue()
+        si.seek(0)
+        si.truncate(0)
+    if empty:
         writer.writerow(["Sin datos"])
-    resp = make_response(si.getvalue())
+        yield si.getvalue()
+
+
+def _write_xlsx(filters: dict, out, on_batch=None) -> int:
+    import pandas as pd
+
+    rows = []
+    for batch in _iter_export_batches(filters):
+        rows.extend(batch)
+        if on_batch:
+            on_batch(len(batch))
+    df = pd.DataFrame(rows, columns=EXPORT_FIELDS)
+    with pd.ExcelWriter(out, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='Tickets')
+    return len(rows)
+
+
+@app.route('/export.csv')
+@login_required
+def export_csv():
+    queued = _enqueue_large_export('csv')
+    if queued is not None:
+        return queued
+    resp = Response(_iter_csv_export(_export_filters()), mimetype='text/csv')
     resp.headers['Content-Type'] = 'text/csv; charset=utf-8'
     resp.headers['Content-Disposition'] = f"attachment; filename=\"tickets_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv\""
     return resp
@@ -1187,28 +5714,502 @@ def export_csv():
 @app.route('/export.xlsx')
 @login_required
 def export_xlsx():
-    filters = {
-        'q': request.args.get('q') or None,
-        'status': request.args.get('status') or None,
-        'priority': request.args.get('priority') or None,
-        'assignee_id': request.args.get('assignee_id') or None,
-    }
-    rows = _rows_for_export(filters)
     try:
-        import pandas as pd
+        import pandas  # noqa: F401
     except Exception:
         flash('Para exportar a Excel instalá pandas y openpyxl: <code>pip install pandas openpyxl</code>. Se descargará CSV.', 'warning')
         return redirect(url_for('export_csv', **request.args))
-
-    df = pd.DataFrame(rows)
+    queued = _enqueue_large_export('xlsx')
+    if queued is not None:
+        return queued
     bio = BytesIO()
-    with pd.ExcelWriter(bio, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Tickets')
+    _write_xlsx(_export_filters(), bio)
     resp = make_response(bio.getvalue())
     resp.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     resp.headers['Content-Disposition'] = f"attachment; filename=\"tickets_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx\""
     return resp
 
+
+def _parse_iso_date(value):
+    try:
+        return date.fromisoformat(value[:10]) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_iso_datetime(value):
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _arrow_schema(pa):
+    """Columnas tipadas del export: enteros, fechas y estado/prioridad como categóricas (dictionary)."""
+    category = pa.dictionary(pa.int32(), pa.string())
+    types = {
+        "id": pa.int64(),
+        "request_date": pa.date32(),
+        "priority": category,
+        "status": category,
+        "created_at": pa.timestamp("s"),
+        "updated_at": pa.timestamp("s"),
+    }
+    return pa.schema([pa.field(name, types.get(name, pa.string())) for name in EXPORT_FIELDS])
+
+
+def _arrow_batch(pa, schema, rows: list) -> "pa.RecordBatch":
+    columns = list(zip(*rows))
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pa.types.is_date32(field.type):
+            values = [_parse_iso_date(v) for v in values]
+        elif pa.types.is_timestamp(field.type):
+            values = [_parse_iso_datetime(v) for v in values]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class _ChunkSink:
+    """Destino de escritura para pyarrow que acumula lo escrito hasta que el generador lo entrega.
+
+    Lleva su propia posición: el writer de Parquet usa tell() para los offsets del footer.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self) -> bool:
+        return True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _iter_columnar_export(filters: dict, fmt: str):
+    """Genera el export en Parquet o Arrow IPC (stream) de a EXPORT_COLUMNAR_BATCH filas.
+
+    Cada lote del cursor se convierte a un RecordBatch y se escribe enseguida (un row
+    group por lote en Parquet): la memoria queda acotada por el tamaño de lote.
+    """
+    import pyarrow as pa
+
+    schema = _arrow_schema(pa)
+    sink = _ChunkSink()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression=EXPORT_PARQUET_COMPRESSION)
+    else:
+        writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+    try:
+        for rows in _iter_export_batches(filters, EXPORT_COLUMNAR_BATCH):
+            batch = _arrow_batch(pa, schema, rows)
+            if fmt == "parquet":
+                writer.write_batch(batch, row_group_size=len(rows))
+            else:
+                writer.write_batch(batch)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+COLUMNAR_EXPORTS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+
+def _columnar_export_response(fmt: str):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        flash('Para exportar a Parquet/Arrow instalá pyarrow: <code>pip install pyarrow</code>. Se descargará CSV.', 'warning')
+        return redirect(url_for('export_csv', **request.args))
+    mimetype, ext = COLUMNAR_EXPORTS[fmt]
+    resp = Response(_iter_columnar_export(_export_filters(), fmt), mimetype=mimetype)
+    resp.headers['Content-Disposition'] = f"attachment; filename=\"tickets_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{ext}\""
+    return resp
+
+
+@app.route('/export.parquet')
+@login_required
+def export_parquet():
+    return _columnar_export_response("parquet")
+
+
+@app.route('/export.arrow')
+@login_required
+def export_arrow():
+    """Arrow IPC en formato stream (pyarrow.ipc.open_stream / pandas / polars lo leen directo)."""
+    return _columnar_export_response("arrow")
+
+
+# ---------- Exportaciones en segundo plano ----------
+# Un CSV/Excel grande ocupa un worker todo lo que dura la descarga. Por encima de
+# EXPORT_ASYNC_THRESHOLD filas el request encola un job, un hilo lo escribe en EXPORT_DIR
+# y el usuario sigue el estado en /exports/<id>. Un pedido idéntico (mismos filtros y
+# formato) reutiliza el archivo mientras la generación de tickets no cambie.
+
+_export_executor = ThreadPoolExecutor(max_workers=EXPORT_JOB_WORKERS, thread_name_prefix="export")
+
+
+class _ExportInterrupted(Exception):
+    pass
+
+
+def _export_cache_key(filters: dict, fmt: str, generation: int) -> str:
+    raw = json.dumps([filters, fmt, generation], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _export_job_path(job_id: str, fmt: str) -> Path:
+    return EXPORT_DIR / f"{job_id}.{fmt}"
+
+
+def _count_export_rows(filters: dict, limit: int) -> tuple[int, int]:
+    """Filas del export (contando hasta ``limit`` + 1) y la generación de tickets en la misma foto."""
+    include_archive = filters.get('include_archive', False)
+    conn = db_connect_readonly(with_archive=include_archive)
+    try:
+        sql, params = _tickets_query(conn, filters.get('q'), filters.get('status'), filters.get('priority'),
+                                     filters.get('assignee_id'), source=tickets_source(conn, include_archive),
+                                     limit=limit + 1, columns="1", site=filters.get('site'))
+        count = conn.execute(f"SELECT COUNT(*) FROM ({sql}) s", params).fetchone()[0]
+        return count, get_generation(conn)
+    finally:
+        conn.close()
+
+
+def prune_export_jobs(conn):
+    """Borra jobs (y archivos) de más de EXPORT_JOB_KEEP_HOURS."""
+    cutoff = (datetime.now() - timedelta(hours=EXPORT_JOB_KEEP_HOURS)).isoformat(timespec='seconds')
+    old = conn.execute("SELECT id, format FROM export_jobs WHERE created_at < ?", (cutoff,)).fetchall()
+    for job_id, fmt in old:
+        _export_job_path(job_id, fmt).unlink(missing_ok=True)
+    if old:
+        conn.executemany("DELETE FROM export_jobs WHERE id=?", [(r[0],) for r in old])
+
+
+_HOSTNAME = socket.gethostname()
+
+
+def _export_job_owner() -> str:
+    return f"{_HOSTNAME}:{os.getpid()}"
+
+
+def _export_owner_alive(owner: str | None) -> bool | None:
+    """¿Vive el proceso dueño del job? None si no se puede saber (otro host o job sin dueño)."""
+    host, _, pid = (owner or "").rpartition(":")
+    if host != _HOSTNAME or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # existe, de otro usuario
+    return True
+
+
+def _export_job_alive(status: str, updated_at: str, owner: str | None, stale_before: str) -> bool:
+    """Un job pendiente sigue vivo mientras viva el proceso que lo encoló (su cola no toca updated_at);
+    uno en proceso, mientras además siga latiendo. Sin forma de ver el proceso, decide el latido."""
+    owner_alive = _export_owner_alive(owner)
+    if owner_alive is False:
+        return False
+    if status == 'pendiente' and owner_alive:
+        return True
+    return updated_at >= stale_before
+
+
+def find_or_create_export_job(filters: dict, fmt: str, generation: int) -> tuple[str, bool]:
+    """Job que sirve a (filtros, formato, generación): uno terminado o en curso, o uno nuevo. Devuelve (id, nuevo)."""
+    key = _export_cache_key(filters, fmt, generation)
+    now = datetime.now()
+    stale_before = (now - timedelta(seconds=EXPORT_JOB_STALE_SECONDS)).isoformat(timespec='seconds')
+    conn = db_connect()
+    try:
+        rows = conn.execute(
+            "SELECT id, status, updated_at, owner FROM export_jobs WHERE cache_key=? AND "
+            "status IN ('listo', 'pendiente', 'procesando') ORDER BY created_at DESC", (key,)).fetchall()
+        for job_id, status, updated_at, owner in rows:
+            if status == 'listo':
+                if _export_job_path(job_id, fmt).exists():
+                    return job_id, False
+            elif _export_job_alive(status, updated_at, owner, stale_before):
+                return job_id, False
+        prune_export_jobs(conn)
+        job_id = uuid.uuid4().hex
+        now_iso = now.isoformat(timespec='seconds')
+        conn.execute("INSERT INTO export_jobs (id, cache_key, format, filters, status, created_at, updated_at, owner) "
+                     "VALUES (?, ?, ?, ?, 'pendiente', ?, ?, ?)",
+                     (job_id, key, fmt, json.dumps(filters), now_iso, now_iso, _export_job_owner()))
+        conn.commit()
+        return job_id, True
+    finally:
+        conn.close()
+
+
+def _update_export_job(job_id: str, **fields):
+    fields["updated_at"] = datetime.now().isoformat(timespec='seconds')
+    conn = db_connect()
+    try:
+        conn.execute(f"UPDATE export_jobs SET {', '.join(f'{k}=?' for k in fields)} WHERE id=?",
+                     [*fields.values(), job_id])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def run_export_job(job_id: str):
+    """Escribe el archivo del job (a un .part y rename) y deja el estado en export_jobs."""
+    conn = db_connect()
+    try:
+        job = conn.execute("SELECT format, filters FROM export_jobs WHERE id=?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if job is None:
+        return
+    fmt, filters = job["format"], json.loads(job["filters"])
+    path = _export_job_path(job_id, fmt)
+    tmp = path.with_name(f".{path.name}.part")
+    progress = {"rows": 0}
+    finished = threading.Event()
+
+    def on_batch(n):
+        # Corta si el worker se está apagando
+        if _draining.is_set():
+            raise _ExportInterrupted("interrumpida por reinicio del servidor")
+        progress["rows"] += n
+
+    def heartbeat():
+        # Latido también mientras pandas arma el Excel (sin lotes de por medio)
+        while not finished.wait(EXPORT_JOB_HEARTBEAT_SECONDS):
+            try:
+                _update_export_job(job_id, rows_written=progress["rows"])
+            except Exception as e:
+                logger.warning(f"[EXPORT] Latido del job {job_id}: {e}")
+
+    with inflight.track("export"):
+        _update_export_job(job_id, status="procesando", owner=_export_job_owner())
+        beat = threading.Thread(target=heartbeat, name=f"export-beat-{job_id[:8]}", daemon=True)
+        beat.start()
+        try:
+            EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+            if fmt == "xlsx":
+                with open(tmp, "wb") as out:
+                    progress["rows"] = _write_xlsx(filters, out, on_batch)
+            else:
+                with open(tmp, "w", newline="", encoding="utf-8") as out:
+                    for chunk in _iter_csv_export(filters, on_batch):
+                        out.write(chunk)
+            os.replace(tmp, path)
+        except Exception as e:
+            finished.set()
+            beat.join()
+            tmp.unlink(missing_ok=True)
+            logger.error(f"[EXPORT] Falló el job {job_id} ({fmt}): {e}")
+            _update_export_job(job_id, status="error", error=str(e), rows_written=progress["rows"],
+                               finished_at=datetime.now().isoformat(timespec='seconds'))
+            return
+        finished.set()
+        beat.join()
+        _update_export_job(job_id, status="listo", rows_written=progress["rows"], size=path.stat().st_size,
+                           finished_at=datetime.now().isoformat(timespec='seconds'))
+        logger.info(f"[EXPORT] Job {job_id} listo: {progress['rows']} filas {fmt}")
+
+
+def _enqueue_large_export(fmt: str):
+    """Si el export supera EXPORT_ASYNC_THRESHOLD filas, lo encola y devuelve la redirección al estado."""
+    if EXPORT_ASYNC_THRESHOLD <= 0:
+        return None
+    filters = _export_filters()
+    count, generation = _count_export_rows(filters, EXPORT_ASYNC_THRESHOLD)
+    if count <= EXPORT_ASYNC_THRESHOLD:
+        return None
+    job_id, created = find_or_create_export_job(filters, fmt, generation)
+    if created:
+        try:
+            _export_executor.submit(run_export_job, job_id)
+        except RuntimeError:
+            # Executor cerrado (apagando): el próximo pedido idéntico lo vuelve a encolar
+            _update_export_job(job_id, status="error", error="servidor reiniciándose, reintentar")
+    return redirect(url_for('export_job', job_id=job_id))
+
+
+@app.route('/exports/<job_id>')
+@login_required
+def export_job(job_id: str):
+    conn = db_connect()
+    job = conn.execute("SELECT * FROM export_jobs WHERE id=?", (job_id,)).fetchone()
+    conn.close()
+    if job is None:
+        flash('La exportación no existe o ya venció.', 'warning')
+        return redirect(url_for('home'))
+    job = dict(job)
+    args = {k: ('1' if v is True else v) for k, v in json.loads(job['filters']).items() if v}
+    return render_template('export_job.html', title='Exportación', job=job,
+                           retry_url=url_for(f"export_{job['format']}", **args))
+
+
+@app.route('/exports/<job_id>/download')
+@login_required
+def export_job_download(job_id: str):
+    conn = db_connect()
+    job = conn.execute("SELECT format, created_at FROM export_jobs WHERE id=? AND status='listo'", (job_id,)).fetchone()
+    conn.close()
+    if job is None or not _export_job_path(job_id, job["format"]).exists():
+        flash('La exportación no está disponible.', 'warning')
+        return redirect(url_for('home'))
+    stamp = job["created_at"].replace("-", "").replace(":", "").replace("T", "_")
+    return send_from_directory(EXPORT_DIR, f"{job_id}.{job['format']}", as_attachment=True,
+                               mimetype=EXPORT_JOB_MIMETYPES[job["format"]],
+                               download_name=f"tickets_{stamp}.{job['format']}")
+
+# ---------- Sitios ----------
+@app.route("/sites")
+@login_required
+def sites():
+    include_archive = request.args.get("include_archive") == "1"
+    conn = db_connect()
+    rows = site_summary(conn, include_archive=include_archive)
+    conn.close()
+    return render_template("sites.html", title="Sitios", rows=rows, include_archive=include_archive)
+
+
+@app.route("/sites/export.csv")
+@login_required
+def sites_export_csv():
+    include_archive = request.args.get("include_archive") == "1"
+    conn = db_connect()
+    rows = site_summary(conn, include_archive=include_archive)
+    conn.close()
+    si = StringIO()
+    writer = csv.writer(si)
+    writer.writerow(["code", "name", "total", "open"])
+    writer.writerows((r["code"], r["name"], r["total"], r["open"]) for r in rows)
+    resp = make_response(si.getvalue())
+    resp.headers['Content-Type'] = 'text/csv; charset=utf-8'
+    resp.headers['Content-Disposition'] = f"attachment; filename=\"sitios_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv\""
+    return resp
+
+
+@app.route("/sites/<code>")
+@login_required
+def site_detail(code):
+    page = max(request.args.get("page", 1, type=int), 1)
+    conn = db_connect()
+    site = get_site(conn, code)
+    if not site:
+        conn.close()
+        flash("Sitio no encontrado.", "warning")
+        return redirect(url_for("sites"))
+    if site["code"] != code:
+        conn.close()
+        return redirect(url_for("site_detail", code=site["code"]))
+    rows = query_tickets(conn, site=code, include_archive=True, view="list", limit=SEARCH_PAGE_SIZE + 1,
+                         offset=(page - 1) * SEARCH_PAGE_SIZE)
+    counts = (site_summary(conn, include_archive=True, site_id=site["id"]) or [{"total": 0, "open": 0}])[0]
+    conn.close()
+    return render_template("site_detail.html", title=site["name"], site=site, rows=rows[:SEARCH_PAGE_SIZE],
+                           has_next=len(rows) > SEARCH_PAGE_SIZE, page=page, counts=counts)
+
+
+# ---------- Reportes ----------
+REPORT_DEFAULT_WEEKS = 12
+
+
+def _report_range() -> tuple[str, str]:
+    """Semanas (lunes ISO) pedidas en ?from=&to=; por defecto las últimas REPORT_DEFAULT_WEEKS."""
+    try:
+        week_to = _week_of(request.args.get("to") or date.today().isoformat())
+    except ValueError:
+        week_to = _week_of(date.today().isoformat())
+    try:
+        week_from = _week_of(request.args["from"])
+    except (KeyError, ValueError):
+        week_from = (date.fromisoformat(week_to) - timedelta(weeks=REPORT_DEFAULT_WEEKS - 1)).isoformat()
+    return week_from, week_to
+
+
+def _report_group(default: str, param: str = "group") -> str:
+    group = request.args.get(param, default)
+    return group if group in REPORT_GROUPS else default
+
+
+@app.route("/reports")
+@login_required
+def reports():
+    week_from, week_to = _report_range()
+    group = _report_group("assignee")
+    ttc_group = _report_group("type", "ttc_group")
+    conn = db_connect()
+    throughput = report_throughput(conn, week_from, week_to, group)
+    ttc = report_time_to_close(conn, week_from, week_to, ttc_group)
+    backlog = report_backlog(conn, week_from, week_to)
+    conn.close()
+    # Pivot semana x responsable/tipo para la tabla de cierres
+    weeks = sorted({r["week"] for r in throughput})
+    names = sorted({r["name"] for r in throughput})
+    closed = {(r["week"], r["name"]): r["closed"] for r in throughput}
+    max_backlog = max([b["backlog"] for b in backlog] or [1]) or 1
+    return render_template("reports.html", title="Reportes", week_from=week_from, week_to=week_to, group=group,
+                           ttc_group=ttc_group, weeks=weeks, names=names, closed=closed, ttc=ttc, backlog=backlog, max_backlog=max_backlog)
+
+
+@app.route("/api/reports/throughput")
+@login_required
+def api_report_throughput():
+    week_from, week_to = _report_range()
+    conn = db_connect()
+    data = report_throughput(conn, week_from, week_to, _report_group("assignee"))
+    conn.close()
+    return jsonify(data)
+
+
+@app.route("/api/reports/time-to-close")
+@login_required
+def api_report_time_to_close():
+    week_from, week_to = _report_range()
+    conn = db_connect()
+    data = report_time_to_close(conn, week_from, week_to, _report_group("type"))
+    conn.close()
+    return jsonify({"buckets_hours": CLOSE_HOURS_BUCKETS, "groups": data})
+
+
+@app.route("/api/reports/backlog")
+@login_required
+def api_report_backlog():
+    week_from, week_to = _report_range()
+    conn = db_connect()
+    data = report_backlog(conn, week_from, week_to)
+    conn.close()
+    return jsonify(data)
+
+
 # ---------- Debug de correo y logs (opcional) ----------
 @app.get('/debug/mail-test')
 @login_required
@@ -1235,6 +6236,29 @@ def debug_log():
     except Exception as e:
         return (f'No se pudo leer portal.log: {e}', 500)
 
+@app.get('/debug/profiles')
+@login_required
+def debug_profiles():
+    if not PROFILING_ENABLED:
+        return ("Perfilado deshabilitado. Setea PROFILING_ENABLED=1", 403)
+    return render_template("profiles.html", title="Perfiles", profiles=list_profiles())
+
+
+@app.get('/debug/profiles/<name>')
+@login_required
+def debug_profile_detail(name):
+    if not PROFILING_ENABLED:
+        return ("Perfilado deshabilitado. Setea PROFILING_ENABLED=1", 403)
+    name = secure_filename(name)
+    if request.args.get("download"):
+        return send_from_directory(str(PROFILE_DIR), f"{name}.prof", as_attachment=True)
+    try:
+        profile = json.loads((PROFILE_DIR / f"{name}.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        flash("Perfil no encontrado (puede haber rotado).", "warning")
+        return redirect(url_for("debug_profiles"))
+    return render_template("profile_detail.html", title=f"Perfil {name}", p=profile)
+
 # ------------------------------
 # Inicialización
 # ------------------------------
@@ -1261,6 +6285,9 @@ def bootstrap_db():
         ])
     conn.commit()
     conn.close()
+    # Primera vez con rollups (base existente): se calculan desde los tickets
+    backfill_rollups(force=False)
+    backfill_ticket_changes()
 
 
 # Ejecutar siempre que se importe el módulo (local y en Render)
@@ -1268,5 +6295,6 @@ bootstrap_db()
 
 
 if __name__ == "__main__":
-    # Solo para ejecución local directa
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5006")), debug=True, threaded=False, use_reloader=False)
+    # Solo para ejecución local directa. En servidor usar gunicorn (ver Procfile / gunicorn.conf.py)
+    threaded = os.getenv("FLASK_THREADED", "1").lower() in ("1", "true", "yes", "y", "on")
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5006")), debug=True, threaded=threaded, use_reloader=False)
@@ -0,0 +1,933 @@
+"""Micro-benchmarks de las funciones calientes del portal.
+
+Genera bases sintéticas con semilla fija (10k/100k/1M tickets por defecto),
+mide cada función y guarda el resultado como JSON. El comando ``compare``
+falla (exit 1) si alguna función empeora más allá de la tolerancia.
+
+    python bench.py run --out bench_baseline.json
+    python bench.py run --sizes 10000 --out bench_current.json
+    python bench.py compare bench_baseline.json bench_current.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.cookiejar import CookieJar
+from datetime import datetime, timedelta
+from functools import partial
+from pathlib import Path
+
+BENCH_DIR = Path(os.getenv("BENCH_DATA_DIR", Path(__file__).resolve().parent / "bench_data"))
+BENCH_DIR.mkdir(exist_ok=True)
+
+# La app hace bootstrap al importarse: la apuntamos a una base descartable
+os.environ.setdefault("DB_PATH", str(BENCH_DIR / "bootstrap.db"))
+os.environ.setdefault("UPLOAD_FOLDER", str(BENCH_DIR / "uploads"))
+# export_csv mide el streaming en el request; el job en segundo plano tiene su propio escenario
+os.environ.setdefault("EXPORT_ASYNC_THRESHOLD", "0")
+os.environ.setdefault("EXPORT_DIR", str(BENCH_DIR / "exports"))
+os.environ.setdefault("SHARED_CACHE_PATH", str(BENCH_DIR / "cache.db"))
+
+import app as portal  # noqa: E402
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+DEFAULT_SEED = 875
+SITES = ["AMBA_UTN_MEDRANO", "CPU875", "NPU122", "CABALLITO_2", "PALERMO_SOHO", "LANUS_ESTE", "QUILMES_CENTRO"]
+
+
+# ------------------------------
+# Datos sintéticos
+# ------------------------------
+def build_synthetic_db(path: Path, rows: int, seed: int = DEFAULT_SEED):
+    """Crea (una sola vez) una base con ``rows`` tickets reproducibles."""
+    if path.exists():
+        return path
+    tmp = path.with_suffix(".tmp")
+    if tmp.exists():
+        tmp.unlink()
+    previous = portal.DB_PATH
+    portal.DB_PATH = tmp
+    try:
+        portal.bootstrap_db()
+    finally:
+        portal.DB_PATH = previous
+
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(tmp)
+    type_ids = [r[0] for r in conn.execute("SELECT id FROM modernization_types")]
+    assignee_ids = [r[0] for r in conn.execute("SELECT id FROM assignees")]
+    start = datetime(2023, 1, 1, 8, 0, 0)
+
+    def gen():
+        for i in range(rows):
+            created = start + timedelta(minutes=rnd.randrange(0, 60 * 24 * 900))
+            closed = rnd.random() < 0.7
+            site = f"{rnd.choice(SITES)}_{rnd.randrange(0, 500)}"
+            yield (
+                site,
+                rnd.choice(type_ids),
+                created.date().isoformat(),
+                rnd.choice(portal.PRIORITIES),
+                rnd.choice(assignee_ids),
+                f"user{rnd.randrange(0, 200)}@telecom.com.ar",
+                f"{created.strftime('%Y%m%d_%H%M%S')}_{site}.pdf",
+                f"IGA-{i}" if closed else None,
+                f"https://iga.telecom.local/case/{i}" if closed else None,
+                "Cerrado" if closed else "Abierto",
+                created.isoformat(timespec="seconds"),
+                (created + timedelta(days=rnd.randrange(0, 60))).isoformat(timespec="seconds"),
+            )
+
+    conn.executemany(
+        """
+        INSERT INTO tickets (site_name, modernization_type_id, request_date, priority, assignee_id, creator_email,
+                             pdf_filename, iga_case_number, iga_link, status, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        gen(),
+    )
+    conn.commit()
+    conn.close()
+    portal.DB_PATH = tmp
+    try:
+        conn = portal.db_connect()
+        portal.link_ticket_sites(conn, include_archive=False)
+        conn.close()
+    finally:
+        portal.DB_PATH = previous
+    tmp.rename(path)
+    return path
+
+
+def synthetic_attachments(count: int = 2, size: int = 512 * 1024, seed: int = DEFAULT_SEED):
+    rnd = random.Random(seed)
+    out = []
+    for i in range(count):
+        p = BENCH_DIR / f"attachment_{i}_{size}.pdf"
+        if not p.exists():
+            p.write_bytes(b"%PDF-1.4\n" + rnd.randbytes(size))
+        out.append(str(p))
+    return out
+
+
+# ------------------------------
+# Escenarios
+# ------------------------------
+QUERY_FILTERS = {
+    "none": {},
+    "q_text": {"q": "CPU875"},
+    "q_id": {"q": "4242"},
+    "status": {"status": "Abierto"},
+    "priority": {"priority": "Urgente"},
+    "assignee": {"assignee_id": "2"},
+    "status+priority": {"status": "Abierto", "priority": "Urgente"},
+    "all": {"q": "NPU", "status": "Cerrado", "priority": "Normal", "assignee_id": "1"},
+}
+
+SCENARIOS = []
+
+
+def scenario(name: str, sized: bool = True):
+    def deco(fn):
+        SCENARIOS.append((name, sized, fn))
+        return fn
+    return deco
+
+
+def _client():
+    client = portal.app.test_client()
+    with client.session_transaction() as sess:
+        sess["logged_in"] = True
+    return client
+
+
+def _query_factory(filters: dict):
+    def factory():
+        def run():
+            conn = portal.db_connect()
+            try:
+                portal.query_tickets(conn, **filters)
+            finally:
+                conn.close()
+        return run
+    return factory
+
+
+for _label, _filters in QUERY_FILTERS.items():
+    scenario(f"query_tickets[{_label}]")(_query_factory(_filters))
+
+
+@scenario("_rows_for_export[none]")
+def _bench_rows_for_export():
+    return lambda: portal._rows_for_export({"q": None, "status": None, "priority": None, "assignee_id": None})
+
+
+@scenario("export_csv")
+def _bench_export_csv():
+    client = _client()
+
+    def run():
+        resp = client.get("/export.csv")
+        assert resp.status_code == 200
+        resp.get_data()
+    return run
+
+
+def _bench_export_columnar(path: str):
+    def factory():
+        client = _client()
+
+        def run():
+            resp = client.get(path)
+            assert resp.status_code == 200, "export columnar requiere pyarrow"
+            resp.get_data()
+        return run
+    return factory
+
+
+try:
+    import pyarrow  # noqa: F401  (opcional: /export.parquet y /export.arrow)
+except ImportError:
+    pass
+else:
+    scenario("export_parquet")(_bench_export_columnar("/export.parquet"))
+    scenario("export_arrow")(_bench_export_columnar("/export.arrow"))
+
+
+@scenario("export_job[csv]")
+def _bench_export_job_csv():
+    def run():
+        # Generación distinta en cada corrida: siempre un job nuevo, nunca el archivo cacheado
+        run.n += 1
+        job_id, _ = portal.find_or_create_export_job({"bench": run.n, "include_archive": False}, "csv", -run.n)
+        portal.run_export_job(job_id)
+    run.n = 0
+    return run
+
+
+@scenario("home_summary")
+def _bench_home_summary():
+    def run():
+        conn = portal.db_connect()
+        try:
+            portal.home_summary(conn)
+        finally:
+            conn.close()
+    return run
+
+
+@scenario("SiteIndex.suggest[50k sitios]", sized=False)
+def _bench_site_suggest():
+    rnd = random.Random(DEFAULT_SEED)
+    index = portal.SiteIndex()
+    index._build([f"{rnd.choice(SITES)}_{i}_{rnd.randrange(100)}" for i in range(50_000)], 0)
+    prefixes = ["AMBA", "cpu8", "npu12", "medrano", "CABALLITO_2_1", "ZZZ"]
+
+    def run():
+        for p in prefixes:
+            index.suggest(p)
+    return run
+
+
+@scenario("build_mail_message[2x512KiB]", sized=False)
+def _bench_mail_message():
+    attachments = synthetic_attachments()
+    body = "<h3>Se creó un ticket de ingeniería</h3>" + "<p>detalle</p>" * 50
+
+    def run():
+        msg = portal.build_mail_message("[Portal Ingeniería] Bench", ["a@telecom.com.ar", "b@telecom.com.ar"],
+                                        body, ["iga-notify@telecom.com.ar"], attachments)
+        msg.as_bytes()
+    return run
+
+
+# ------------------------------
+# Medición
+# ------------------------------
+def measure(fn, repeat: int, warmup: int = 1):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return {
+        "median_s": statistics.median(samples),
+        "min_s": min(samples),
+        "max_s": max(samples),
+        "runs": repeat,
+    }
+
+
+def select_scenarios(only):
+    if not only:
+        return SCENARIOS
+    return [s for s in SCENARIOS if any(o in s[0] for o in only)]
+
+
+def cmd_run(args):
+    results = {}
+    selected = select_scenarios(args.only)
+    unsized = [s for s in selected if not s[1]]
+    sized = [s for s in selected if s[1]]
+    for name, _, factory in unsized:
+        results[name] = measure(factory(), args.repeat)
+        print(f"{name:<45} {results[name]['median_s'] * 1000:10.2f} ms")
+    for size in args.sizes:
+        db = build_synthetic_db(BENCH_DIR / f"synthetic_{size}_{args.seed}.db", size, args.seed)
+        portal.DB_PATH = db
+        portal.init_db()  # aplica migraciones de esquema a bases generadas con versiones anteriores
+        for name, _, factory in sized:
+            key = f"{name}@{size}"
+            results[key] = measure(factory(), args.repeat)
+            print(f"{key:<45} {results[key]['median_s'] * 1000:10.2f} ms")
+    payload = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "sizes": args.sizes,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.out:
+        Path(args.out).write_text(json.dumps(payload, indent=2, sort_keys=True), encoding="utf-8")
+        print(f"Resultados guardados en {args.out}")
+    return 0
+
+
+def cmd_compare(args):
+    baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))["results"]
+    current = json.loads(Path(args.current).read_text(encoding="utf-8"))["results"]
+    regressions = 0
+    for key in sorted(set(baseline) & set(current)):
+        base = baseline[key]["median_s"]
+        cur = current[key]["median_s"]
+        ratio = cur / base if base else float("inf")
+        regressed = ratio > 1 + args.tolerance and (cur - base) > args.min_delta
+        regressions += regressed
+        flag = "REGRESIÓN" if regressed else "ok"
+        print(f"{key:<45} {base * 1000:10.2f} ms -> {cur * 1000:10.2f} ms  x{ratio:5.2f}  {flag}")
+    for key in sorted(set(baseline) - set(current)):
+        print(f"{key:<45} (sin medición actual)")
+    if regressions:
+        print(f"{regressions} función(es) empeoraron más de {args.tolerance:.0%}.")
+        return 1
+    print("Sin regresiones.")
+    return 0
+
+
+def _login_opener(base_url: str, password: str):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+    data = urllib.parse.urlencode({"password": password}).encode()
+    opener.open(f"{base_url}/login", data=data).read()
+    return opener
+
+
+def cmd_load(args):
+    """Carga concurrente contra un servidor ya levantado (gunicorn/flask run)."""
+    local = threading.local()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        if not hasattr(local, "opener"):
+            local.opener = _login_opener(args.url, args.password)
+        path = args.paths[i % len(args.paths)]
+        t0 = time.perf_counter()
+        try:
+            with local.opener.open(f"{args.url}{path}", timeout=args.timeout) as resp:
+                while resp.read(64 * 1024):
+                    pass
+            ok = True
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - t0
+        with lock:
+            if ok:
+                latencies.append((path, elapsed))
+            else:
+                errors += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.requests)))
+    wall = time.perf_counter() - t0
+    print(f"{args.requests} requests, concurrencia {args.concurrency}: {wall:.2f} s, "
+          f"{len(latencies) / wall:.1f} req/s, errores {errors}")
+    for path in args.paths:
+        samples = sorted(e for p, e in latencies if p == path)
+        if samples:
+            p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+            print(f"  {path:<30} p50 {statistics.median(samples) * 1000:8.1f} ms  p95 {p95 * 1000:8.1f} ms")
+    return 1 if errors else 0
+
+
+def cmd_snapshot(args):
+    """Export completo mientras un loop escribe: verifica snapshot y mide la espera de los writers."""
+    import shutil
+    src = build_synthetic_db(BENCH_DIR / f"synthetic_{args.size}_{args.seed}.db", args.size, args.seed)
+    work = BENCH_DIR / f"snapshot_{args.size}.db"
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{work}{suffix}").unlink(missing_ok=True)
+    shutil.copy(src, work)
+    portal.DB_PATH = work
+    portal.init_db()
+
+    conn = portal.db_connect()
+    expected = conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+    conn.close()
+
+    stop = threading.Event()
+    write_latencies = []
+
+    def writer():
+        conn = portal.db_connect()
+        i = 0
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            now = datetime.now().isoformat(timespec="seconds")
+            conn.execute(
+                "INSERT INTO tickets (site_name, modernization_type_id, request_date, priority, assignee_id, "
+                "creator_email, status, created_at, updated_at) VALUES (?, 1, ?, 'Normal', 1, 'w@x', 'Abierto', ?, ?)",
+                (f"WRITER_{i}", now[:10], now, now),
+            )
+            conn.execute("UPDATE tickets SET status='Cerrado', updated_at=? WHERE id=?", (now, (i % expected) + 1))
+            conn.commit()
+            write_latencies.append(time.perf_counter() - t0)
+            i += 1
+        conn.close()
+
+    filters = {"q": None, "status": None, "priority": None, "assignee_id": None}
+    thread = threading.Thread(target=writer)
+    t0 = time.perf_counter()
+    thread.start()
+    exported = 0
+    try:
+        for batch in portal._iter_export_batches(filters):
+            exported += len(batch)
+    finally:
+        stop.set()
+        thread.join()
+    elapsed = time.perf_counter() - t0
+
+    lat = sorted(write_latencies)
+    p99 = lat[min(len(lat) - 1, int(len(lat) * 0.99))] if lat else 0.0
+    print(f"export de {exported} filas en {elapsed:.2f} s; snapshot esperado {expected}")
+    print(f"writes durante el export: {len(lat)}, p50 {statistics.median(lat) * 1000 if lat else 0:.2f} ms, "
+          f"p99 {p99 * 1000:.2f} ms, máx {max(lat, default=0) * 1000:.2f} ms")
+    if exported != expected:
+        print("ERROR: el export no vio un snapshot consistente.")
+        return 1
+    if not lat:
+        print("ERROR: el writer no pudo commitear durante el export.")
+        return 1
+    return 0
+
+
+def _rollup_rows(conn) -> list[tuple]:
+    weekly = conn.execute("SELECT week, assignee_id, modernization_type_id, opened, closed FROM rollup_weekly "
+                          "ORDER BY 1, 2, 3").fetchall()
+    hist = conn.execute("SELECT week, assignee_id, modernization_type_id, bucket, count FROM rollup_close_hist "
+                        "ORDER BY 1, 2, 3, 4").fetchall()
+    return [tuple(r) for r in weekly] + [tuple(r) for r in hist]
+
+
+def cmd_postgres(args):
+    """Migración SQLite → PostgreSQL y caminos principales del DAL contra un PostgreSQL real (opt-in).
+
+    Trabaja en un esquema descartable dentro de DATABASE_URL (o --url) y lo borra al final.
+    Antes de migrar archiva los tickets cerrados viejos, así la migración también copia archive.db.
+    Compara cada resultado con la base SQLite de origen; exit 1 si algo no coincide.
+    """
+    url = args.url or os.getenv("DATABASE_URL")
+    if not url:
+        raise SystemExit("bench.py postgres requiere DATABASE_URL (o --url) apuntando a un PostgreSQL de prueba")
+    try:
+        import psycopg
+        from psycopg.conninfo import make_conninfo
+    except ImportError:
+        raise SystemExit("Falta psycopg: pip install 'psycopg[binary]' psycopg_pool")
+
+    synthetic = build_synthetic_db(BENCH_DIR / f"synthetic_{args.size}_{args.seed}.db", args.size, args.seed)
+    src = BENCH_DIR / "postgres_source.db"
+    archive = BENCH_DIR / "postgres_source_archive.db"
+    for path in (src, archive):
+        path.unlink(missing_ok=True)
+    with sqlite3.connect(synthetic) as a, sqlite3.connect(src) as b:
+        a.backup(b)
+    previous_paths = portal.DB_PATH, portal.ARCHIVE_DB_PATH
+    portal.DB_PATH, portal.ARCHIVE_DB_PATH = src, archive
+    portal.init_db()
+    schema = f"portal_bench_{os.getpid()}"
+    target = make_conninfo(url, options=f"-c search_path={schema}")
+    with psycopg.connect(url, autocommit=True) as admin:
+        admin.execute(f"CREATE SCHEMA {schema}")
+    errors = []
+    timings = []
+
+    def check(ok, message):
+        if not ok:
+            errors.append(message)
+
+    def step(label, fn, *a, **kw):
+        t0 = time.perf_counter()
+        result = fn(*a, **kw)
+        timings.append((label, time.perf_counter() - t0))
+        return result
+
+    # Referencia tomada antes de archivar: en PostgreSQL todo vuelve a estar en tickets
+    sqlite_conn = portal.db_connect()
+    expected_q = len(portal.query_tickets(sqlite_conn, q="cpu875", view="list"))
+    expected_home = portal.home_summary(sqlite_conn)[0]
+    expected_total = sqlite_conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+    sqlite_conn.close()
+    archived = step("archivar", portal.archive_closed_tickets, args.archive_days)
+    check(archived > 0, f"no se archivó ningún ticket con --archive-days {args.archive_days}")
+    try:
+        migrate = partial(portal.migrate_sqlite_to_postgres, str(src), target, args.batch_size, archive_path=archive)
+        copied = step("migración", migrate)
+        again = step("migración (reanudar)", migrate)
+        check(again == copied, f"la segunda corrida de la migración cambió los conteos: {again} vs {copied}")
+        source = sqlite3.connect(src)
+        for table in ("modernization_types", "assignees", "sites", "tickets"):
+            n = source.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            check(copied.get(table) == n, f"{table}: {copied.get(table)} filas migradas, {n} en SQLite")
+        source.close()
+        check(copied.get("archive.tickets") == archived,
+              f"archive.tickets: {copied.get('archive.tickets')} filas migradas, {archived} archivadas")
+        with psycopg.connect(target) as pg:
+            total = pg.execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+        check(total == expected_total, f"tickets en PostgreSQL: {total}, {expected_total} antes de archivar")
+
+        # De acá en adelante la app habla con el esquema de prueba
+        portal.DB_ENGINE, portal.DATABASE_URL, portal._pg_pool = "postgresql", target, None
+        portal.result_cache.clear()
+        step("rollups-backfill", portal.backfill_rollups, force=True)
+        conn = portal.db_connect()
+        check(conn.dialect == "postgresql", "db_connect no devolvió una conexión PostgreSQL")
+        got_q = len(step("query_tickets q", portal.query_tickets, conn, q="cpu875", view="list"))
+        check(got_q == expected_q, f"búsqueda por sitio (ILIKE): {got_q} tickets, SQLite {expected_q}")
+        got_home = step("home_summary", portal.home_summary, conn)[0]
+        check(got_home == expected_home, f"home_summary: {got_home} vs SQLite {expected_home}")
+
+        since = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM ticket_changes").fetchone()[0]
+        tid = step("insert_ticket", portal.insert_ticket, conn, "CPU875_BENCH", 1, "2025-01-02", "Alta", 1,
+                   "bench@telecom.com.ar", None)
+        conn.commit()
+        check(step("mark_ticket_closed", portal.mark_ticket_closed, conn, tid, "IGA-B", None), "no cerró el ticket")
+        conn.commit()
+        check(not portal.mark_ticket_closed(conn, tid, "IGA-B", None), "cerró dos veces el mismo ticket")
+        conn.rollback()
+        open_ids = [r[0] for r in conn.execute("SELECT id FROM tickets WHERE status='Abierto' ORDER BY id LIMIT 20")]
+        closed = step("bulk_close", portal.bulk_close_tickets, conn, open_ids[:10], "IGA-BULK", None)
+        conn.commit()
+        moved = step("bulk_reassign", portal.bulk_reassign_tickets, conn, open_ids[10:], 2)
+        conn.commit()
+        deleted = step("bulk_delete", portal.bulk_delete_tickets, conn, open_ids[:5])
+        conn.commit()
+        check(len(closed) == 10 and len(deleted) == 5 and moved, f"masivos: {len(closed)}/{len(moved)}/{len(deleted)}")
+        incremental = _rollup_rows(conn)
+        conn.close()
+        step("rollups-backfill", portal.backfill_rollups, force=True)
+        conn = portal.db_connect()
+        check(_rollup_rows(conn) == incremental, "los rollups incrementales no coinciden con el recálculo")
+        feed = portal.read_ticket_changes(conn, since, 1000)
+        ops = {(c["ticket_id"], c["op"]) for c in feed["changes"]}
+        check({(tid, "insert"), (tid, "close"), (open_ids[0], "delete")} <= ops, f"feed de cambios incompleto: {sorted(ops)[:20]}")
+        conn.close()
+
+        client = _client()
+        for path in ("/", "/search?q=cpu875", f"/tickets/{tid}", "/api/changes?since=0", "/reports"):
+            resp = step(f"GET {path}", client.get, path)
+            check(resp.status_code == 200, f"GET {path}: {resp.status_code}")
+        lines = step("GET /export.csv", lambda: client.get("/export.csv").get_data().count(b"\n"))
+        conn = portal.db_connect()
+        total = conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+        conn.close()
+        check(lines == total + 1, f"export.csv: {lines} líneas para {total} tickets")
+    finally:
+        if portal._pg_pool is not None:
+            portal._pg_pool.close()
+        portal.DB_ENGINE, portal._pg_pool = "sqlite", None
+        portal.DB_PATH, portal.ARCHIVE_DB_PATH = previous_paths
+        if not args.keep:
+            with psycopg.connect(url, autocommit=True) as admin:
+                admin.execute(f"DROP SCHEMA {schema} CASCADE")
+
+    for label, elapsed in timings:
+        print(f"{label:<28} {elapsed * 1000:10.1f} ms")
+    print(f"esquema {schema} {'conservado' if args.keep else 'borrado'}")
+    for message in errors:
+        print(f"ERROR: {message}")
+    return 1 if errors else 0
+
+
+def _storage_backend(args):
+    """(backend, limpieza) para ``bench.py storage``: local en un directorio temporal, S3 real o moto."""
+    import shutil
+    import tempfile
+    if args.backend == "local":
+        root = Path(tempfile.mkdtemp(prefix="bench_storage_"))
+        return portal.LocalStorage(root), lambda: shutil.rmtree(root, ignore_errors=True)
+    if args.backend == "moto":
+        try:
+            import boto3
+            from moto import mock_aws
+        except ImportError:
+            raise SystemExit("--backend moto requiere boto3 y moto: pip install boto3 moto")
+        for var in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+            os.environ.setdefault(var, "bench")
+        mock = mock_aws()
+        mock.start()
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="portal-bench")
+        return portal.S3Storage("portal-bench", "bench/", region="us-east-1"), mock.stop
+    # S3/MinIO real (S3_BUCKET, S3_ENDPOINT_URL, S3_REGION): prefijo propio, se borra al final
+    backend = portal.S3Storage(portal.S3_BUCKET, f"{portal.S3_PREFIX}bench-{os.getpid()}/", portal.S3_ENDPOINT_URL,
+                               portal.S3_REGION)
+    return backend, lambda: backend.delete_many([o.name for o in backend.iter_objects()])
+
+
+def cmd_storage(args):
+    """Contrato de AttachmentStorage contra un backend: put/get (con rangos), stat, iter_objects,
+    local_copy y delete/delete_many. Verifica cada resultado y mide la latencia; exit 1 si algo no coincide."""
+    import io
+    backend, cleanup = _storage_backend(args)
+    rnd = random.Random(args.seed)
+    sizes = [0, 1, portal.STORAGE_CHUNK_SIZE + 7] + [args.object_size] * args.objects
+    if args.big:
+        sizes.append(9 * 2**20)  # pasa el umbral multipart de S3Storage (8 MiB)
+    blobs = {f"bench_{i:04d}.pdf": rnd.randbytes(n) for i, n in enumerate(sizes)}
+    timings = {}
+    errors = []
+
+    def timed(op, fn, *a, **kw):
+        t0 = time.perf_counter()
+        result = fn(*a, **kw)
+        timings.setdefault(op, []).append(time.perf_counter() - t0)
+        return result
+
+    def check(ok, message):
+        if not ok:
+            errors.append(message)
+
+    try:
+        for name, data in blobs.items():
+            timed("put", backend.put, name, io.BytesIO(data), "application/pdf")
+        for name, data in blobs.items():
+            got = timed("get", lambda: b"".join(backend.get(name)))
+            check(got == data, f"get {name}: {len(got)} bytes, esperaba {len(data)}")
+            st = timed("stat", backend.stat, name)
+            check(st is not None and st.size == len(data), f"stat {name}: {st}")
+            if len(data) > 2:
+                # Rangos inclusive: interior, desde un offset hasta el final y desde el principio
+                start, end = sorted(rnd.sample(range(len(data)), 2))
+                for lo, hi in ((start, end), (start, None), (None, end)):
+                    got = timed("get (rango)", lambda: b"".join(backend.get(name, lo, hi)))
+                    want = data[lo or 0:None if hi is None else hi + 1]
+                    check(got == want, f"get {name} [{lo}, {hi}]: {len(got)} bytes, esperaba {len(want)}")
+        check(timed("stat", backend.stat, "no_existe.pdf") is None, "stat de un adjunto inexistente no es None")
+        check(not backend.exists("no_existe.pdf"), "exists de un adjunto inexistente")
+        listed = {o.name: o.size for o in timed("iter_objects", lambda: list(backend.iter_objects()))}
+        check(listed == {n: len(d) for n, d in blobs.items()}, f"iter_objects: {len(listed)} de {len(blobs)} adjuntos")
+        name = next(n for n, d in blobs.items() if len(d) > 1)
+        with timed("local_copy", backend.local_copy, name) as path:
+            check(Path(path).read_bytes() == blobs[name], f"local_copy {name}")
+        names = list(blobs)
+        check(timed("delete", backend.delete, names[0]) is True, f"delete {names[0]} no devolvió True")
+        check(timed("delete", backend.delete, names[0]) is False, f"delete repetido de {names[0]} no devolvió False")
+        removed = timed("delete_many", backend.delete_many, names[1:] + ["no_existe.pdf"])
+        check(sorted(removed) == sorted(names[1:]), f"delete_many devolvió {removed}, esperaba {names[1:]}")
+        check(not list(backend.iter_objects()), "quedaron adjuntos después de delete_many")
+    finally:
+        cleanup()
+
+    print(f"backend {args.backend}: {len(blobs)} adjuntos, {sum(map(len, blobs.values())) / 2**20:.1f} MiB")
+    print(f"{'operación':<14} {'n':>5} {'p50':>10} {'máx':>10}")
+    for op, samples in timings.items():
+        print(f"{op:<14} {len(samples):5d} {statistics.median(samples) * 1000:8.2f}ms {max(samples) * 1000:8.2f}ms")
+    for message in errors:
+        print(f"ERROR: {message}")
+    return 1 if errors else 0
+
+
+def cmd_rows(args):
+    """Tiempo y memoria por cada 100k filas: SELECT t.* -> dict + formato en Python vs proyección de lista."""
+    import tracemalloc
+    db = build_synthetic_db(BENCH_DIR / f"synthetic_{args.size}_{args.seed}.db", args.size, args.seed)
+    portal.DB_PATH = db
+    portal.init_db()
+    scale = 100_000 / args.size
+
+    def legacy():
+        conn = portal.db_connect()
+        rows = portal.query_tickets(conn)
+        for r in rows:
+            r["created_at"] = datetime.fromisoformat(r["created_at"]).strftime("%d/%m/%Y %H:%M")
+        conn.close()
+        return rows
+
+    def projected():
+        conn = portal.db_connect()
+        rows = portal.query_tickets(conn, view="list")
+        conn.close()
+        return rows
+
+    for label, fn in (("t.* -> dict", legacy), ("proyección list", projected)):
+        timing = measure(fn, args.repeat)
+        tracemalloc.start()
+        rows = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:<18} {timing['median_s'] * scale * 1000:9.1f} ms/100k filas  "
+              f"pico {peak * scale / 2**20:7.1f} MiB/100k filas  ({len(rows)} filas)")
+    return 0
+
+
+def _cache_workload(rnd: random.Random, size: int, n: int) -> list[str]:
+    """Mezcla típica: inicio, unas pocas búsquedas frecuentes y detalles con ids "calientes"."""
+    searches = ["/search", "/search?status=Abierto", "/search?status=Cerrado", "/search?q=CPU875",
+                "/search?q=AMBA", "/search?page=2", "/search?priority=Urgente", "/search?status=Abierto&page=2"]
+    hot = max(1, min(size, 500))
+    paths = []
+    for _ in range(n):
+        r = rnd.random()
+        if r < 0.2:
+            paths.append("/")
+        elif r < 0.6:
+            paths.append(rnd.choice(searches))
+        else:
+            # Zipf aproximado: la mayoría de los detalles piden pocos tickets
+            paths.append(f"/tickets/{int(hot ** rnd.random())}")
+    return paths
+
+
+def _cache_worker(db: str, cache_path: str | None, size: int, n: int, seed: int) -> tuple[dict, float]:
+    """Un "worker de gunicorn": proceso propio, L1 vacío, mismo archivo de caché compartida."""
+    portal.DB_PATH = Path(db)
+    portal.result_cache = portal.SharedCache(Path(cache_path) if cache_path else None, portal.SHARED_CACHE_MAX_ENTRIES,
+                                             portal.SHARED_CACHE_TTL,
+                                             portal.LRUCache(portal.SEARCH_CACHE_SIZE, portal.SEARCH_CACHE_TTL))
+    client = _client()
+    paths = _cache_workload(random.Random(seed), size, n)
+    t0 = time.perf_counter()
+    for path in paths:
+        resp = client.get(path)
+        assert resp.status_code == 200, (path, resp.status_code)
+        resp.get_data()
+    return portal.result_cache.stats, time.perf_counter() - t0
+
+
+def _print_hit_rates(label: str, results: list[tuple[dict, float]], requests: int):
+    totals = {}
+    for stats, _ in results:
+        for ns, c in stats.items():
+            acc = totals.setdefault(ns, {"local": 0, "shared": 0, "miss": 0})
+            for k, v in c.items():
+                acc[k] += v
+    wall = max(elapsed for _, elapsed in results)
+    print(f"{label}: {requests * len(results) / wall:.0f} req/s ({len(results)} proceso(s))")
+    for ns, c in sorted(totals.items()):
+        total = sum(c.values())
+        print(f"  {ns:<8} {total:6d} pedidos  aciertos {100 * (c['local'] + c['shared']) / total:5.1f}%  "
+              f"(L1 {100 * c['local'] / total:5.1f}%, compartida {100 * c['shared'] / total:5.1f}%)")
+
+
+def cmd_cache(args):
+    """Tasa de aciertos de la caché de resultados con varios procesos, con y sin el nivel compartido."""
+    db = build_synthetic_db(BENCH_DIR / f"synthetic_{args.size}_{args.seed}.db", args.size, args.seed)
+    portal.DB_PATH = db
+    portal.init_db()
+    cache_path = BENCH_DIR / "cache_bench.db"
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx) as pool:
+        for shared in (False, True):
+            mode = "compartida" if shared else "solo L1"
+            for suffix in ("", "-wal", "-shm"):
+                Path(f"{cache_path}{suffix}").unlink(missing_ok=True)
+            path = str(cache_path) if shared else None
+            # Reinicio: un worker calienta la caché y otro arranca en frío después
+            pool.submit(_cache_worker, str(db), path, args.size, args.requests, args.seed).result()
+            cold = pool.submit(_cache_worker, str(db), path, args.size, args.requests, args.seed + 1).result()
+            _print_hit_rates(f"[{mode}] worker recién arrancado (otro ya calentó)", [cold], args.requests)
+            futures = [pool.submit(_cache_worker, str(db), path, args.size, args.requests, args.seed + 10 + i)
+                       for i in range(args.workers)]
+            _print_hit_rates(f"[{mode}] {args.workers} workers en paralelo", [f.result() for f in futures],
+                             args.requests)
+    return 0
+
+
+def cmd_fragments(args):
+    """Página completa vs. fragmento (solo la región que cambia): bytes y tiempo de respuesta."""
+    db = build_synthetic_db(BENCH_DIR / f"synthetic_{args.size}_{args.seed}.db", args.size, args.seed)
+    portal.DB_PATH = db
+    portal.init_db()
+    client = _client()
+    pairs = [
+        ("inicio", "/", "/home/summary"),
+        ("search", "/search?status=Abierto", "/search/results?status=Abierto"),
+        ("search pág. 2", "/search?status=Abierto&page=2", "/search/results?status=Abierto&page=2"),
+        ("search q=CPU875", "/search?q=CPU875", "/search/results?q=CPU875"),
+    ]
+
+    def timed(path, headers=None):
+        samples = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            resp = client.get(path, headers=headers or {})
+            body = resp.get_data()
+            samples.append(time.perf_counter() - t0)
+        return resp, body, statistics.median(samples) * 1000
+
+    print(f"{'región':<16} {'pedido':<10} {'bytes':>9} {'sin caché':>10} {'con caché':>10}")
+    for label, page, fragment in pairs:
+        for kind, path in (("completa", page), ("fragmento", fragment)):
+            portal.result_cache.clear()
+            t0 = time.perf_counter()
+            client.get(path).get_data()
+            cold_ms = (time.perf_counter() - t0) * 1000
+            resp, body, warm_ms = timed(path)
+            print(f"{label:<16} {kind:<10} {len(body):9d} {cold_ms:8.2f}ms {warm_ms:8.2f}ms")
+        # Refresco sin cambios: el navegador revalida con If-None-Match y recibe un 304 vacío
+        resp, body, ms = timed(fragment, {"If-None-Match": resp.headers["ETag"]})
+        print(f"{label:<16} {'304':<10} {len(body):9d} {'':>10} {ms:8.2f}ms")
+    return 0
+
+
+def cmd_compress(args):
+    """Bytes ahorrados y CPU de compresión por página típica, para cada nivel gzip/brotli."""
+    db = build_synthetic_db(BENCH_DIR / f"synthetic_{args.size}_{args.seed}.db", args.size, args.seed)
+    portal.DB_PATH = db
+    portal.init_db()
+    client = _client()
+    pages = {
+        "home": "/",
+        "search (50 filas)": "/search",
+        "search q=CPU875": "/search?q=CPU875",
+        "detalle": "/tickets/1",
+        "export.csv": "/export.csv",
+    }
+    settings = [("gzip", 1), ("gzip", 6), ("gzip", 9)]
+    if portal._brotli_available():
+        settings += [("br", 4), ("br", 6)]
+    else:
+        print("(brotli no instalado: solo gzip)")
+    print(f"{'página':<18} {'original':>10} {'codec':>8} {'comprimido':>11} {'ahorro':>7} {'CPU':>9} {'MB/s':>7}")
+    for label, path in pages.items():
+        raw = client.get(path).get_data()
+        # Pedazos de 64 KiB: mismo camino que una respuesta streameada
+        chunks = [raw[i:i + 65536] for i in range(0, len(raw), 65536)] or [b""]
+        for encoding, level in settings:
+            portal.COMPRESS_LEVEL = level
+            portal.COMPRESS_BROTLI_QUALITY = level
+            cpu = []
+            for _ in range(args.repeat):
+                t0 = time.process_time()
+                out = b"".join(portal._compress_stream(iter(chunks), encoding))
+                cpu.append(time.process_time() - t0)
+            cpu_s = statistics.median(cpu)
+            print(f"{label:<18} {len(raw) / 1024:8.1f}Ki {encoding + '-' + str(level):>8} {len(out) / 1024:9.1f}Ki "
+                  f"{100 * (1 - len(out) / max(len(raw), 1)):6.1f}% {cpu_s * 1000:7.2f}ms "
+                  f"{len(raw) / 2**20 / max(cpu_s, 1e-9):7.1f}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks del Portal Ingeniería")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_run = sub.add_parser("run", help="Mide los escenarios y guarda JSON")
+    p_run.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    p_run.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    p_run.add_argument("--repeat", type=int, default=5)
+    p_run.add_argument("--only", nargs="*", help="Filtra escenarios por substring del nombre")
+    p_run.add_argument("--out", help="Archivo JSON de salida")
+    p_run.set_defaults(func=cmd_run)
+
+    p_cmp = sub.add_parser("compare", help="Compara contra un baseline; exit 1 si hay regresiones")
+    p_cmp.add_argument("baseline")
+    p_cmp.add_argument("current")
+    p_cmp.add_argument("--tolerance", type=float, default=0.20, help="Empeoramiento relativo permitido (0.20 = 20%%)")
+    p_cmp.add_argument("--min-delta", type=float, default=0.0005, help="Ignora diferencias absolutas menores (segundos)")
+    p_cmp.set_defaults(func=cmd_compare)
+
+    p_snap = sub.add_parser("snapshot", help="Export concurrente con un loop de escrituras (consistencia + latencia)")
+    p_snap.add_argument("--size", type=int, default=1_000_000)
+    p_snap.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    p_snap.set_defaults(func=cmd_snapshot)
+
+    p_rows = sub.add_parser("rows", help="Memoria y tiempo por 100k filas de listado (dict vs proyección)")
+    p_rows.add_argument("--size", type=int, default=100_000)
+    p_rows.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    p_rows.add_argument("--repeat", type=int, default=3)
+    p_rows.set_defaults(func=cmd_rows)
+
+    p_comp = sub.add_parser("compress", help="Bytes ahorrados y CPU de gzip/brotli en páginas típicas")
+    p_comp.add_argument("--size", type=int, default=100_000)
+    p_comp.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    p_comp.add_argument("--repeat", type=int, default=5)
+    p_comp.set_defaults(func=cmd_compress)
+
+    p_frag = sub.add_parser("fragments", help="Página completa vs. fragmento de resultados/tarjetas")
+    p_frag.add_argument("--size", type=int, default=100_000)
+    p_frag.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    p_frag.add_argument("--repeat", type=int, default=20)
+    p_frag.set_defaults(func=cmd_fragments)
+
+    p_pg = sub.add_parser("postgres", help="Migración y DAL contra PostgreSQL (opt-in: requiere DATABASE_URL)")
+    p_pg.add_argument("--url", help="PostgreSQL de prueba (por defecto DATABASE_URL)")
+    p_pg.add_argument("--size", type=int, default=10_000)
+    p_pg.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    p_pg.add_argument("--batch-size", type=int, default=2000)
+    p_pg.add_argument("--archive-days", type=int, default=180,
+                      help="Archiva antes de migrar los cerrados sin cambios hace más de estos días")
+    p_pg.add_argument("--keep", action="store_true", help="No borrar el esquema de prueba al terminar")
+    p_pg.set_defaults(func=cmd_postgres)
+
+    p_sto = sub.add_parser("storage", help="Verifica y mide el backend de adjuntos (local, S3/MinIO o moto)")
+    p_sto.add_argument("--backend", choices=["local", "s3", "moto"], default="local",
+                       help="s3 usa S3_BUCKET/S3_ENDPOINT_URL; moto simula S3 en proceso")
+    p_sto.add_argument("--objects", type=int, default=20)
+    p_sto.add_argument("--object-size", type=int, default=256 * 1024)
+    p_sto.add_argument("--big", action="store_true", help="Agrega un adjunto de 9 MiB (subida multipart)")
+    p_sto.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    p_sto.set_defaults(func=cmd_storage)
+
+    p_cache = sub.add_parser("cache", help="Aciertos de la caché de resultados entre procesos (L1 vs compartida)")
+    p_cache.add_argument("--size", type=int, default=100_000)
+    p_cache.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    p_cache.add_argument("--workers", type=int, default=4)
+    p_cache.add_argument("--requests", type=int, default=400, help="Pedidos por proceso")
+    p_cache.set_defaults(func=cmd_cache)
+
+    p_load = sub.add_parser("load", help="Carga HTTP concurrente contra un servidor levantado")
+    p_load.add_argument("--url", default="http://127.0.0.1:5006")
+    p_load.add_argument("--password", default=os.getenv("PORTAL_PASSWORD", "portal123"))
+    p_load.add_argument("--paths", nargs="+", default=["/", "/search?status=Abierto", "/export.csv"])
+    p_load.add_argument("--concurrency", type=int, default=16)
+    p_load.add_argument("--requests", type=int, default=200)
+    p_load.add_argument("--timeout", type=float, default=120)
+    p_load.set_defaults(func=cmd_load)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
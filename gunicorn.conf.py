@@ -0,0 +1,82 @@
+"""Configuración de gunicorn para el Portal Ingeniería.
+
+Modo por defecto: ``gthread`` (varios hilos por worker). Un envío lento a
+Outlook/SMTP o una exportación grande ocupa un hilo, no el worker entero.
+Es el modo recomendado: el correo sale por el pool de ``send_mail_async()`` y
+las consultas a sqlite3 bloquean solo su hilo.
+
+gevent (``GUNICORN_WORKER_CLASS=gevent``) no se recomienda: solo el cursor de
+exportación, el envío de correo y el borrado de adjuntos pasan por ``run_blocking()``;
+el resto de las llamadas a sqlite3 corre en el loop del hub y frena todo el worker.
+
+Mediciones (1 worker, 1 vCPU, base sintética de 100k tickets, ``bench.py load``):
+- 40 cierres concurrentes con un SMTP que tarda 2 s en responder, gthread x8:
+  MAIL_ASYNC=0 -> 10.4 s totales, p50 2069 ms; MAIL_ASYNC=1 -> 0.43 s, p50 74 ms.
+  Con sync + envío en el request serían ~80 s (40 x 2 s en serie).
+- Mezcla inicio/detalle/export.csv, concurrencia 16: sync 8.9 req/s -> gthread 10.1 req/s
+  (p95 de "/" 2.0 s -> 1.6 s). Con trabajo CPU puro la ganancia es chica: para eso
+  subir WEB_CONCURRENCY.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5006')}"
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", min(4, multiprocessing.cpu_count() * 2 + 1)))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# Solo aplica a gevent: conexiones simultáneas por worker
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "200"))
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+accesslog = os.getenv("GUNICORN_ACCESSLOG", "-")
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOGLEVEL", "info")
+
+# Apagado ordenado: al recibir SIGTERM el worker deja de estar listo (/readyz 503) y,
+# antes de salir, espera subidas/correos/indexación pendientes. El plazo es lo que
+# queda de graceful_timeout (menos un margen), acotado por SHUTDOWN_DRAIN_TIMEOUT.
+_term_received_at = None
+
+
+def post_worker_init(worker):
+    import signal
+    import sys
+    import time
+
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def on_term(signum, frame):
+        global _term_received_at
+        _term_received_at = time.monotonic()
+        portal = sys.modules.get("app")
+        if portal is not None:
+            portal.begin_drain()
+        if callable(previous):
+            previous(signum, frame)
+
+    signal.signal(signal.SIGTERM, on_term)
+
+    # Respaldo (BACKUP_INTERVAL_HOURS), sincronización con IGA (IGA_SYNC_INTERVAL_MINUTES) y barrido
+    # de adjuntos huérfanos (ORPHAN_SWEEP_INTERVAL_HOURS) programados: cada worker revisa,
+    # portal_meta decide quién los corre
+    portal = sys.modules.get("app")
+    if portal is not None:
+        portal.start_backup_scheduler()
+        portal.start_iga_sync_scheduler()
+        portal.start_orphan_sweeper()
+
+
+def worker_exit(server, worker):
+    import sys
+    import time
+
+    portal = sys.modules.get("app")
+    if portal is None:
+        return
+    remaining = graceful_timeout - 2
+    if _term_received_at is not None:
+        remaining -= time.monotonic() - _term_received_at
+    portal.drain_background_work(min(portal.SHUTDOWN_DRAIN_TIMEOUT, max(remaining, 0)))
@@ -0,0 +1,188 @@
+"""Servidor HTTP de prueba que imita el API de casos de IGA.
+
+Implementa el contrato que usa ``IgaClient`` en app.py (feed de cambios con cursor y
+consulta por tickets), con casos generados en memoria, un límite de pedidos por
+segundo (responde 429 con Retry-After) y contadores en ``/_stats`` para comprobar
+que una sincronización no satura el sistema externo::
+
+    python iga_stub.py --cases 5000 --closed 0.6 --port 8765
+    IGA_API_URL=http://127.0.0.1:8765/api flask iga-sync --full
+
+``POST /_touch?n=100`` cambia el estado de ``n`` casos (para probar el incremental).
+Solo usa la biblioteca estándar.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+OPEN_STATUSES = ["Nuevo", "En curso", "Pendiente proveedor"]
+CLOSED_STATUSES = ["Resuelto", "Cerrado"]
+
+
+class CaseStore:
+    """Casos en memoria; cada cambio toma el siguiente número de secuencia (el cursor del feed)."""
+
+    def __init__(self, cases: int = 0, closed_ratio: float = 0.5, seed: int = 1):
+        self.lock = threading.Lock()
+        self.rand = random.Random(seed)
+        self.seq = 0
+        self.cases = {}  # case_number -> caso
+        self.closed_ratio = closed_ratio
+        for ticket_id in range(1, cases + 1):
+            self.upsert(ticket_id, self._status())
+
+    def _status(self) -> str:
+        pool = CLOSED_STATUSES if self.rand.random() < self.closed_ratio else OPEN_STATUSES
+        return self.rand.choice(pool)
+
+    def upsert(self, ticket_id: int | None, status: str, case_number: str | None = None) -> dict:
+        with self.lock:
+            self.seq += 1
+            case_number = case_number or f"IGA-{100000 + (ticket_id or self.seq)}"
+            case = {
+                "case_number": case_number,
+                "ticket_id": ticket_id,
+                "status": status,
+                "link": f"https://iga.example/casos/{case_number}",
+                "seq": self.seq,
+            }
+            self.cases[case_number] = case
+            return case
+
+    def touch(self, n: int) -> int:
+        """Cambia el estado de ``n`` casos al azar (los pasa a cerrados o los reabre)."""
+        numbers = self.rand.sample(sorted(self.cases), min(n, len(self.cases)))
+        for number in numbers:
+            case = self.cases[number]
+            status = self.rand.choice(OPEN_STATUSES if case["status"] in CLOSED_STATUSES else CLOSED_STATUSES)
+            self.upsert(case["ticket_id"], status, number)
+        return len(numbers)
+
+    def changes(self, since: int, limit: int) -> dict:
+        with self.lock:
+            newer = sorted((c for c in self.cases.values() if c["seq"] > since), key=lambda c: c["seq"])
+            page = newer[:limit]
+            return {
+                "cases": page,
+                "next": page[-1]["seq"] if page else since,
+                "has_more": len(newer) > len(page),
+            }
+
+    def lookup(self, ticket_ids: set[int]) -> dict:
+        with self.lock:
+            return {
+                "cases": [c for c in self.cases.values() if c["ticket_id"] in ticket_ids],
+                "head": self.seq,
+            }
+
+
+class StubState:
+    def __init__(self, store: CaseStore, rate_limit: float, latency: float, token: str):
+        self.store = store
+        self.rate_limit = rate_limit
+        self.latency = latency
+        self.token = token
+        self.lock = threading.Lock()
+        self.window = []  # instantes de los pedidos del último segundo
+        self.stats = {"requests": 0, "throttled": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def admit(self) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            self.stats["requests"] += 1
+            self.window = [t for t in self.window if now - t < 1.0]
+            if self.rate_limit and len(self.window) >= self.rate_limit:
+                self.stats["throttled"] += 1
+                return False
+            self.window.append(now)
+            self.stats["in_flight"] += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+            return True
+
+    def release(self):
+        with self.lock:
+            self.stats["in_flight"] -= 1
+
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, code: int, payload: dict, headers: dict | None = None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            if url.path == "/_stats":
+                with state.lock:
+                    return self._send(200, dict(state.stats, head=state.store.seq))
+            if state.token and self.headers.get("Authorization") != f"Bearer {state.token}":
+                return self._send(401, {"error": "unauthorized"})
+            if not state.admit():
+                return self._send(429, {"error": "rate limited"}, {"Retry-After": "1"})
+            try:
+                if state.latency:
+                    time.sleep(state.latency)
+                if url.path == "/api/cases/changes":
+                    return self._send(200, state.store.changes(int(params.get("since", 0)), int(params.get("limit", 100))))
+                if url.path == "/api/cases":
+                    ids = {int(i) for i in params.get("ticket_ids", "").split(",") if i.strip().isdigit()}
+                    return self._send(200, state.store.lookup(ids))
+                return self._send(404, {"error": "not found"})
+            finally:
+                state.release()
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path == "/_touch":
+                n = int(parse_qs(url.query).get("n", ["1"])[-1])
+                return self._send(200, {"touched": state.store.touch(n), "head": state.store.seq})
+            return self._send(404, {"error": "not found"})
+
+    return Handler
+
+
+def start_stub(store: CaseStore, host: str = "127.0.0.1", port: int = 0, rate_limit: float = 0,
+               latency: float = 0, token: str = "") -> tuple[ThreadingHTTPServer, str]:
+    """Levanta el stub en un hilo; devuelve (servidor, URL base del API). Cerrar con ``server.shutdown()``."""
+    server = ThreadingHTTPServer((host, port), make_handler(StubState(store, rate_limit, latency, token)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="iga-stub", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/api"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub HTTP del API de casos de IGA")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cases", type=int, default=1000, help="casos a generar (ticket_id 1..N)")
+    parser.add_argument("--closed", type=float, default=0.5, help="proporción de casos cerrados")
+    parser.add_argument("--rate-limit", type=float, default=10, help="pedidos/s antes de responder 429 (0 = sin límite)")
+    parser.add_argument("--latency", type=float, default=0.05, help="demora por pedido en segundos")
+    parser.add_argument("--token", default="", help="exigir Authorization: Bearer <token>")
+    args = parser.parse_args()
+    server, url = start_stub(CaseStore(args.cases, args.closed), args.host, args.port, args.rate_limit,
+                             args.latency, args.token)
+    print(f"Stub de IGA en {url} ({args.cases} casos); Ctrl+C para salir")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""Extracción de texto de los PDF de ingeniería.
+
+Vive en un módulo aparte para que los procesos del pool (``spawn``) importen
+solo esto y no app.py con su bootstrap de base y logging.
+Requiere ``pypdf`` (opcional): ``pip install pypdf``.
+"""
+
+
+def extract_text(path: str, max_chars: int = 2_000_000) -> tuple[str, int]:
+    """Devuelve (texto, páginas). Corta en ``max_chars`` para acotar el índice."""
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    parts = []
+    total = 0
+    for page in reader.pages:
+        try:
+            text = page.extract_text() or ""
+        except Exception:
+            text = ""
+        if text:
+            parts.append(text)
+            total += len(text)
+            if total >= max_chars:
+                break
+    return "\n".join(parts)[:max_chars], len(reader.pages)